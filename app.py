@@ -1,12 +1,21 @@
+import os
+
 from flask import Flask, Response, jsonify, request, send_from_directory
 
-from camera import mjpeg_stream, start_camera_thread
+from camera import start_camera_thread
 from chassis import CENTER_POSITION
-from control import PARAM_TYPES, latest_overlay, latest_status, lock, params, save_params
+from control import PARAM_TYPES, current_params, latest_overlay, latest_status, lock, params, publish_params, save_params
+import metrics
+from recorder import FORMATS, recorder
+from rtproc import realtime
+from stream import STATUS_DEFAULT_RATE, STREAM_NAMES, client_stats, mjpeg_stream, status_events
 import vision
 
 app = Flask(__name__)
 
+# 数值列表参数允许的元素个数（空列表表示不用）；roi_points 单独按点对解析
+_LIST_SIZES = {"camera_matrix": (9,), "dist_coeffs": (4, 5, 8, 12, 14)}
+
 
 @app.route("/")
 def index():
@@ -30,16 +39,38 @@ def assets(name: str):
 
 @app.route("/stream/<name>")
 def stream(name: str):
-    if name not in {"raw", "gray", "blur", "canny", "roi", "processed"}:
+    """MJPEG 视频流；?fps= / ?quality= / ?scale= 为该客户端的帧率、JPEG 质量和缩放上限。"""
+    if name not in STREAM_NAMES:
         return "unknown stream", 404
-    return Response(mjpeg_stream(name),
-                    mimetype="multipart/x-mixed-replace; boundary=frame")
+    gen = mjpeg_stream(name,
+                       fps=request.args.get("fps", type=float),
+                       quality=request.args.get("quality", type=int),
+                       scale=request.args.get("scale", type=float),
+                       peer=request.remote_addr or "",
+                       sock=request.environ.get("werkzeug.socket"))
+    return Response(gen, mimetype="multipart/x-mixed-replace; boundary=frame")
 
 
 @app.route("/api/params", methods=["GET"])
 def get_params():
-    with lock:
-        return jsonify(dict(params))
+    return jsonify(dict(current_params().values))
+
+
+def _flatten(value):
+    for v in value:
+        if isinstance(v, (list, tuple)):
+            yield from _flatten(v)
+        else:
+            yield v
+
+
+def _reshape_like(template, values):
+    """把展平的 values 按 template 的嵌套结构还原。"""
+    it = iter(values)
+
+    def build(t):
+        return [build(v) if isinstance(v, (list, tuple)) else next(it) for v in t]
+    return build(template)
 
 
 @app.route("/api/params", methods=["POST"])
@@ -54,6 +85,14 @@ def set_params():
             try:
                 if t == "int":
                     params[k] = int(float(data[k]))
+                elif t == "list" and k in _LIST_SIZES:
+                    # 内参 3x3（可嵌套或展平）/ 畸变系数：元素个数不对时忽略，保持原形状并归一化为 float
+                    if not isinstance(data[k], list):
+                        continue
+                    values = [float(x) for x in _flatten(data[k])]
+                    if values and len(values) not in _LIST_SIZES[k]:
+                        continue
+                    params[k] = _reshape_like(data[k], values)
                 elif t == "list":
                     # 只接受二维点列表，并归一化为 float
                     pts = []
@@ -70,17 +109,39 @@ def set_params():
                 changed[k] = params[k]
             except Exception:
                 pass
+        snap = publish_params() if changed else current_params()
 
     save_params()
-    return jsonify({"ok": True, "changed": changed, "params": params})
+    if changed:
+        realtime.send_params(snap.values)
+    return jsonify({"ok": True, "changed": changed, "params": dict(snap.values)})
 
 
 @app.route("/api/status", methods=["GET"])
 def get_status():
     with lock:
         data = dict(latest_status)
-        data["overlay"] = latest_overlay
-        return jsonify(data)
+        data["overlay"] = dict(latest_overlay)
+    data["stream_clients"] = client_stats()
+    return jsonify(data)
+
+
+@app.route("/api/status/stream", methods=["GET"])
+def status_stream():
+    """状态推送（SSE）：首条为完整状态，之后只推变化字段；?rate= 限制每秒最多推送次数。"""
+    rate = request.args.get("rate", type=float) or STATUS_DEFAULT_RATE
+    with lock:
+        initial = dict(latest_status)
+        initial["overlay"] = dict(latest_overlay)
+    return Response(status_events(initial, rate), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """各阶段耗时分位数（Prometheus 文本格式）。"""
+    extra = realtime.metrics if realtime.active else None
+    return Response(metrics.render_prometheus(extra), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/api/estop", methods=["POST"])
@@ -90,20 +151,63 @@ def estop():
         params["auto_drive"] = 0
         params["manual_motor"] = 0.0
         params["manual_servo"] = CENTER_POSITION
+        snap = publish_params()
     save_params()
+    realtime.send_params(snap.values)
     return jsonify({"ok": True, "auto_drive": 0, "manual_motor": 0.0, "manual_servo": CENTER_POSITION})
 
 
 @app.route("/api/vision/reset", methods=["POST"])
 def vision_reset():
     """清空视觉缓存，避免卡住时需要重启。"""
-    vision.reset_vision_state()
+    if realtime.active:
+        realtime.reset_vision()
+    else:
+        vision.reset_vision_state()
     return jsonify({"ok": True, "msg": "vision state cleared"})
 
 
+@app.route("/api/record", methods=["GET"])
+def record_status():
+    if realtime.active:
+        # 录制在实时进程里进行，状态随帧同步过来
+        with lock:
+            data = {k: latest_status[k] for k in recorder.stats()}
+    else:
+        data = recorder.stats()
+    data["path"] = data.pop("record_path")
+    return jsonify(data)
+
+
+@app.route("/api/record", methods=["POST"])
+def record_control():
+    """开始/停止录制：{"enable": true, "format": "jpeg"|"raw"}"""
+    data = request.get_json(force=True, silent=True) or {}
+    if data.get("enable"):
+        fmt = data.get("format", "jpeg")
+        if fmt not in FORMATS:
+            return jsonify({"ok": False, "msg": f"unknown format: {fmt}"}), 400
+        if realtime.active:
+            realtime.record(fmt)
+            return jsonify({"ok": True, "recording": True, "path": ""})
+        path = recorder.start(fmt)
+        return jsonify({"ok": True, "recording": True, "path": str(path)})
+    if realtime.active:
+        realtime.record(None)
+        with lock:
+            frames, dropped = latest_status["record_frames"], latest_status["record_dropped"]
+        return jsonify({"ok": True, "recording": False, "frames": frames, "dropped": dropped})
+    recorder.stop()
+    return jsonify({"ok": True, "recording": False, "frames": recorder.frames, "dropped": recorder.dropped})
+
+
 if __name__ == "__main__":
     try:
-        start_camera_thread()
+        # RT_PROCESS=1：采集/视觉/控制/底盘放到独立进程，本进程只做 Web 服务
+        if os.environ.get("RT_PROCESS", "0") == "1":
+            realtime.start()
+        else:
+            start_camera_thread()
     except Exception as e:
         with lock:
             latest_status["camera_connected"] = False
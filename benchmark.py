@@ -0,0 +1,212 @@
+"""
+视觉 / 控制 / 协议热路径基准测试。
+
+    python3 benchmark.py --out bench.json --board jetson-nano
+    python3 benchmark.py --filter vision. --iterations 500
+
+每个用例报告单次调用耗时（均值/中位数/p95/最小/最大，微秒）和 tracemalloc 统计的
+单次调用峰值分配字节数、调用结束后仍未释放的字节数（稳态下应接近 0），结果写成 JSON，
+便于跨提交、跨板子比较。
+"""
+import argparse
+import itertools
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import cv2 as cv
+import numpy as np
+
+import control
+import vision
+from chassis import send_data_import
+from control.lqr import build_default_lqr
+from stream import STREAM_NAMES
+from synthetic import SCENES, render_lane_frame
+
+ROOT = Path(__file__).resolve().parent
+
+W, H = 320, 240
+PARAMS = {"binary_value": 60}
+HALF_PARAMS = {"binary_value": 60, "vision_scale": 0.5}
+
+
+class _NullUart:
+    """只计字节数的假串口。"""
+    is_open = True
+
+    def __init__(self):
+        self.nbytes = 0
+
+    def write(self, data: bytes):
+        self.nbytes += len(data)
+
+
+def _measure(fn: Callable[[], Any], iterations: int, warmup: int, alloc_iterations: int) -> Dict[str, Any]:
+    for _ in range(warmup):
+        fn()
+
+    times = np.empty(iterations, dtype=np.float64)
+    for i in range(iterations):
+        t0 = time.perf_counter()
+        fn()
+        times[i] = time.perf_counter() - t0
+
+    # 分配统计单独跑，避免 tracemalloc 的开销混进耗时
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    try:
+        for _ in range(alloc_iterations):
+            base, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            fn()
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - base)
+            retained.append(current - base)
+    finally:
+        tracemalloc.stop()
+
+    us = times * 1e6
+    return {
+        "iterations": iterations,
+        "mean_us": float(np.mean(us)),
+        "median_us": float(np.median(us)),
+        "p95_us": float(np.percentile(us, 95)),
+        "min_us": float(np.min(us)),
+        "max_us": float(np.max(us)),
+        "alloc_peak_bytes": int(np.median(peaks)) if peaks else 0,
+        "alloc_retained_bytes": int(np.median(retained)) if retained else 0,
+    }
+
+
+def _vision_cases() -> List[Dict[str, Any]]:
+    cases = []
+    for scene in SCENES:
+        frames = [render_lane_frame(scene, W, H, offset=8 * np.sin(i / 5), phase=4 * i, seed=i) for i in range(16)]
+        frame = frames[0]
+        det = vision.LaneDetector(background_rebuild=False)
+        maps = det.warp_maps(W, H, PARAMS)
+        binary = vision._fast_binary(frame, PARAMS["binary_value"], maps.bounds)
+        warped = maps.warp(binary)
+
+        cases.append({"name": "vision.fast_binary.full", "scene": scene,
+                      "fn": lambda f=frame: vision._fast_binary(f, PARAMS["binary_value"])})
+        cases.append({"name": "vision.fast_binary.roi", "scene": scene,
+                      "fn": lambda f=frame, b=maps.bounds: vision._fast_binary(f, PARAMS["binary_value"], b)})
+        cases.append({"name": "vision.warp", "scene": scene,
+                      "fn": lambda b=binary, m=maps: m.warp(b)})
+
+        cases.append({"name": "vision.sliding_window_fit.search", "scene": scene,
+                      "fn": lambda d=det, img=warped: d.fit_lanes(img, allow_track=False),
+                      "setup": lambda d=det: d.reset(background_rebuild=False)})
+        cases.append({"name": "vision.sliding_window_fit.track", "scene": scene,
+                      "fn": lambda d=det, img=warped: d.fit_lanes(img),
+                      "setup": lambda d=det, img=warped: (d.reset(background_rebuild=False), d.fit_lanes(img))})
+
+        cases.append({"name": "vision.process_image", "scene": scene,
+                      "fn": lambda d=det, it=itertools.cycle(frames): d.process(next(it), PARAMS),
+                      "setup": lambda d=det: d.reset(background_rebuild=False)})
+        cases.append({"name": "vision.process_image.half", "scene": scene,
+                      "fn": lambda d=det, it=itertools.cycle(frames): d.process(next(it), HALF_PARAMS),
+                      "setup": lambda d=det: d.reset(background_rebuild=False)})
+        cases.append({"name": "vision.process_image.all_streams", "scene": scene,
+                      "fn": lambda d=det, it=itertools.cycle(frames): d.process(next(it), PARAMS, STREAM_NAMES),
+                      "setup": lambda d=det: d.reset(background_rebuild=False)})
+    return cases
+
+
+def _control_cases() -> List[Dict[str, Any]]:
+    cases = []
+    for steer_mode in (0, 1):
+        for speed_mode in (0, 1):
+            def _setup(steer_mode=steer_mode, speed_mode=speed_mode):
+                control.reset_control_state()
+                with control.lock:
+                    control.params.update({"auto_drive": 1, "steer_mode": steer_mode, "speed_mode": speed_mode})
+                    control.publish_params()
+
+            errs = itertools.cycle(np.linspace(-40, 40, 64).tolist())
+
+            cases.append({"name": f"control.compute_control.steer{steer_mode}_speed{speed_mode}",
+                          "scene": "", "fn": lambda it=errs: control.compute_control(next(it)),
+                          "setup": _setup})
+
+    cases.append({"name": "control.build_default_lqr", "scene": "", "fn": build_default_lqr})
+
+    uart = _NullUart()
+    cases.append({"name": "chassis.send_data_import", "scene": "",
+                  "fn": lambda: send_data_import(uart, 0.12, 1620, 0, 0)})
+    return cases
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+
+def run(iterations: int = 300, warmup: int = 20, alloc_iterations: int = 20, name_filter: str = "",
+        board: str = "") -> Dict[str, Any]:
+    saved_params = dict(control.params)
+    results = []
+    try:
+        for case in _vision_cases() + _control_cases():
+            label = case["name"] + (f"[{case['scene']}]" if case["scene"] else "")
+            if name_filter and name_filter not in label:
+                continue
+            if case.get("setup"):
+                case["setup"]()
+            stats = _measure(case["fn"], iterations, warmup, alloc_iterations)
+            stats.update({"name": case["name"], "scene": case["scene"]})
+            results.append(stats)
+            print(f"{label:60s} {stats['median_us']:10.1f} us  p95 {stats['p95_us']:10.1f} us  "
+                  f"peak {stats['alloc_peak_bytes']:>9d} B  retained {stats['alloc_retained_bytes']:>7d} B")
+    finally:
+        with control.lock:
+            control.params.clear()
+            control.params.update(saved_params)
+            control.publish_params()
+        control.reset_control_state()
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": _git_commit(),
+            "board": board or platform.node(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv.__version__,
+            "cv_threads": cv.getNumThreads(),
+            "frame": [W, H],
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="视觉/控制/协议热路径基准测试")
+    parser.add_argument("--out", default="bench_results.json", help="JSON 结果文件")
+    parser.add_argument("--iterations", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--alloc-iterations", type=int, default=20)
+    parser.add_argument("--filter", default="", help="只跑名字里包含该字符串的用例")
+    parser.add_argument("--board", default="", help="板子标识，写入结果 meta")
+    args = parser.parse_args()
+
+    report = run(args.iterations, args.warmup, args.alloc_iterations, args.filter, args.board)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"wrote {args.out}")
+
+
+if __name__ == "__main__":
+    main()
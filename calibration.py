@@ -0,0 +1,214 @@
+"""
+鸟瞰变换标定：由 ROI 顶点和（可选的）相机内参生成 remap 映射表。
+
+每个 (帧尺寸, ROI, 内参, 畸变) 组合只构建一次映射表，镜头去畸变直接折叠进同一张表，
+逐帧只需要一次 cv.remap。ROI 改变时在后台线程重建，建好后整体替换引用，读取方无需加锁。
+"""
+import threading
+from typing import Any, Optional, Sequence, Tuple
+
+import cv2 as cv
+import numpy as np
+
+
+def default_src_points(w: int, h: int) -> np.ndarray:
+    """默认梯形：[左下, 右下, 左上, 右上]。"""
+    return np.float32([
+        [w * 0.1, h],
+        [w * 0.9, h],
+        [w * 0.4, h * 0.6],
+        [w * 0.6, h * 0.6],
+    ])
+
+
+def dst_points(w: int, h: int) -> np.ndarray:
+    return np.float32([
+        [w * 0.2, h],
+        [w * 0.8, h],
+        [w * 0.2, 0],
+        [w * 0.8, 0],
+    ])
+
+
+def roi_to_src_points(roi_points: Sequence[Sequence[float]], w: int, h: int) -> Optional[np.ndarray]:
+    """把前端的规范化 ROI 顶点（>=4 个）转换成 [左下, 右下, 左上, 右上] 像素坐标，不足 4 点返回 None。"""
+    if not roi_points or len(roi_points) < 4:
+        return None
+    pts = np.array(roi_points, dtype=np.float64) * [w, h]
+    s = pts[:, 0] + pts[:, 1]
+    d = pts[:, 0] - pts[:, 1]
+    tl = pts[np.argmin(s)]
+    br = pts[np.argmax(s)]
+    bl = pts[np.argmin(d)]
+    tr = pts[np.argmax(d)]
+    return np.float32([bl, br, tl, tr])
+
+
+def _intrinsics(camera_matrix: Any, dist_coeffs: Any):
+    """参数里的内参/畸变系数合法时返回 (K, D)，否则 (None, None)。"""
+    try:
+        K = np.array(camera_matrix, dtype=np.float64).reshape(3, 3)
+        D = np.array(dist_coeffs, dtype=np.float64).reshape(-1)
+    except Exception:
+        return None, None
+    if D.size not in (4, 5, 8, 12, 14) or K[0, 0] <= 0 or K[1, 1] <= 0:
+        return None, None
+    return K, D
+
+
+class WarpMaps:
+    """一组构建好的鸟瞰映射表。
+
+    map1/map2 为 float32 的 x/y 坐标表，坐标相对 bounds 左上角，
+    因此 remap 直接从二值化的裁剪区域采样。
+    """
+
+    def __init__(self, key, w: int, h: int, M: np.ndarray, M_inv: np.ndarray, src_pts: np.ndarray,
+                 bounds: Tuple[int, int, int, int], map1: np.ndarray, map2: np.ndarray,
+                 K: Optional[np.ndarray], D: Optional[np.ndarray], custom_roi: bool):
+        self.key = key
+        self.w = w
+        self.h = h
+        self.M = M
+        self.M_inv = M_inv
+        self.src_pts = src_pts
+        self.bounds = bounds
+        self.map1 = map1
+        self.map2 = map2
+        self.K = K
+        self.D = D
+        self.custom_roi = custom_roi
+
+    def warp(self, binary_crop: np.ndarray, dst: np.ndarray = None) -> np.ndarray:
+        """给定 dst（与映射表同尺寸的 uint8）时直接写进去，逐帧复用输出缓冲。"""
+        return cv.remap(binary_crop, self.map1, self.map2, cv.INTER_LINEAR, dst=dst)
+
+    def to_source(self, bird_pts: np.ndarray) -> np.ndarray:
+        """鸟瞰坐标点 (N,1,2) 映射回原始（含畸变）图像坐标。"""
+        pts = cv.perspectiveTransform(bird_pts.astype(np.float32), self.M_inv)
+        if self.K is not None:
+            pts = _distort(pts.reshape(-1, 2), self.K, self.D).reshape(-1, 1, 2)
+        return pts
+
+
+def _distort(pts: np.ndarray, K: np.ndarray, D: np.ndarray) -> np.ndarray:
+    """去畸变像素坐标 -> 原始像素坐标。"""
+    xn = (pts[:, 0] - K[0, 2]) / K[0, 0]
+    yn = (pts[:, 1] - K[1, 2]) / K[1, 1]
+    obj = np.stack([xn, yn, np.ones_like(xn)], axis=-1).reshape(-1, 1, 3)
+    zero = np.zeros(3, dtype=np.float64)
+    img, _ = cv.projectPoints(obj, zero, zero, K, D)
+    return img.reshape(-1, 2)
+
+
+def _perspective(src_raw: np.ndarray, dst: np.ndarray, K, D):
+    """ROI 是在原始画面上选的：先去畸变再求透视矩阵及其逆。"""
+    src = src_raw
+    if K is not None:
+        src = cv.undistortPoints(src_raw.reshape(-1, 1, 2), K, D, P=K).reshape(-1, 2).astype(np.float32)
+    M = cv.getPerspectiveTransform(src, dst)
+    if abs(np.linalg.det(M)) < 1e-9:
+        raise np.linalg.LinAlgError("degenerate roi")
+    return M, np.linalg.inv(M)
+
+
+def make_key(w: int, h: int, roi_points=None, camera_matrix=None, dist_coeffs=None):
+    def _flat(v):
+        try:
+            return tuple(float(x) for x in np.asarray(v, dtype=np.float64).reshape(-1))
+        except Exception:
+            return ()
+    return int(w), int(h), _flat(roi_points or []), _flat(camera_matrix or []), _flat(dist_coeffs or [])
+
+
+def build_warp_maps(w: int, h: int, roi_points=None, camera_matrix=None, dist_coeffs=None) -> WarpMaps:
+    """构建映射表；ROI 无效（点数不足或退化）时回退到默认梯形。"""
+    key = make_key(w, h, roi_points, camera_matrix, dist_coeffs)
+    K, D = _intrinsics(camera_matrix, dist_coeffs)
+
+    dst = dst_points(w, h)
+    src_raw = roi_to_src_points(roi_points, w, h)
+    custom_roi = src_raw is not None
+    try:
+        M, M_inv = _perspective(src_raw, dst, K, D) if custom_roi else (None, None)
+    except (cv.error, np.linalg.LinAlgError):
+        M = None
+    if M is None:
+        custom_roi = False
+        src_raw = default_src_points(w, h)
+        M, M_inv = _perspective(src_raw, dst, K, D)
+
+    # 鸟瞰每个像素 -> 去畸变原图坐标 -> 原始（含畸变）坐标
+    ys, xs = np.mgrid[0:h, 0:w].astype(np.float32)
+    grid = np.stack([xs, ys], axis=-1).reshape(-1, 1, 2)
+    src_xy = cv.perspectiveTransform(grid, M_inv).reshape(-1, 2)
+    if K is not None:
+        src_xy = _distort(src_xy, K, D)
+    map_x = src_xy[:, 0].reshape(h, w).astype(np.float32)
+    map_y = src_xy[:, 1].reshape(h, w).astype(np.float32)
+
+    # remap 会读取到的原图范围（含双线性插值的邻点）
+    inside = (map_x > -1) & (map_x < w) & (map_y > -1) & (map_y < h)
+    if np.any(inside):
+        x0 = int(np.clip(np.floor(map_x[inside].min()), 0, w))
+        x1 = int(np.clip(np.floor(map_x[inside].max()) + 2, 0, w))
+        y0 = int(np.clip(np.floor(map_y[inside].min()), 0, h))
+        y1 = int(np.clip(np.floor(map_y[inside].max()) + 2, 0, h))
+    else:
+        x0, y0, x1, y1 = 0, 0, w, h
+
+    # 实测 320x240 单通道下 float32 双平面表的 remap 比 CV_16SC2 定点表快，也不慢于 warpPerspective
+    map1 = map_x - x0
+    map2 = map_y - y0
+    return WarpMaps(key, w, h, M, M_inv, src_raw, (x0, y0, x1, y1), map1, map2, K, D, custom_roi)
+
+
+class WarpMapCache:
+    """按参数组合缓存映射表：组合变化时后台重建，完成后原子替换。"""
+
+    def __init__(self, background: bool = True):
+        self.background = background
+        self._maps: Optional[WarpMaps] = None
+        self._pending = None
+        self._failed = None
+        self._lock = threading.Lock()
+
+    def get(self, w: int, h: int, roi_points=None, camera_matrix=None, dist_coeffs=None, key=None) -> WarpMaps:
+        """key 可由调用方预先用 make_key 算好并缓存，省去逐帧展开参数。"""
+        if key is None:
+            key = make_key(w, h, roi_points, camera_matrix, dist_coeffs)
+        maps = self._maps
+        if maps is not None and maps.key == key:
+            return maps
+
+        # 首次或分辨率变化时没有可用的旧表，只能同步构建
+        if maps is None or (maps.w, maps.h) != (w, h) or not self.background:
+            maps = build_warp_maps(w, h, roi_points, camera_matrix, dist_coeffs)
+            self._maps = maps
+            return maps
+
+        with self._lock:
+            if self._pending != key and self._failed != key:
+                self._pending = key
+                threading.Thread(
+                    target=self._rebuild,
+                    args=(key, w, h, roi_points, camera_matrix, dist_coeffs),
+                    daemon=True,
+                ).start()
+        return maps
+
+    def _rebuild(self, key, w, h, roi_points, camera_matrix, dist_coeffs):
+        try:
+            maps = build_warp_maps(w, h, roi_points, camera_matrix, dist_coeffs)
+        except Exception:
+            maps = None
+        with self._lock:
+            # 构建期间又有新的组合时，丢弃这次结果，等新组合的线程
+            if self._pending != key:
+                return
+            self._pending = None
+            if maps is not None:
+                self._maps = maps
+            else:
+                # 构建失败就继续用旧表，同一组合不再反复重试
+                self._failed = key
@@ -1,90 +1,157 @@
 import time
 import threading
-from typing import Dict
-import platform
+from collections import deque
 
-import cv2 as cv
 import numpy as np
 
-from chassis import CHASSIS_PORT, chassis
-from control import compute_control, latest_frames, latest_status, latest_overlay, lock, params
-from vision import process_image
-
-
-def _open_capture(preferred_index, width, height):
-    """Try a couple of camera indices/backends and return the first opened capture."""
-    tried = []
-    for idx in ([preferred_index] + ([0] if preferred_index != 0 else [])):
-        # Try with V4L2 first on Linux, otherwise skip to default backend.
-        if platform.system().lower() == "linux":
-            cap = cv.VideoCapture(idx, cv.CAP_V4L2)
-            tried.append(f"{idx}(v4l2)")
-            if cap.isOpened():
-                cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
-                cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
-                cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*"MJPG"))
-                return cap, idx, tried
-            cap.release()
-        # macOS: AVFoundation backend
-        if platform.system().lower() == "darwin":
-            cap = cv.VideoCapture(idx, cv.CAP_AVFOUNDATION)
-            tried.append(f"{idx}(avfoundation)")
-            if cap.isOpened():
-                cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
-                cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
-                cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*"MJPG"))
-                return cap, idx, tried
-            cap.release()
-        cap = cv.VideoCapture(idx)
-        tried.append(f"{idx}(default)")
-        if cap.isOpened():
-            cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
-            cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
-            cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*"MJPG"))
-            return cap, idx, tried
-        cap.release()
-    return None, None, tried
-
-
-def camera_loop(camera_index=0, width=320, height=240):
-    cap, used_idx, tried = _open_capture(camera_index, width, height)
+import metrics
+from chassis import chassis
+from control import compute_control, current_params, latest_frames, latest_status, latest_overlay, lock
+from recorder import recorder
+from sources import CameraSource, FrameSource, make_source
+from stream import active_streams, publish_frames, publish_status, status_wanted
+from vision import fit_stats, frame_state, governor_stats, process_image
 
-    with lock:
-        latest_status["running"] = True
-        ok_open = cap is not None and cap.isOpened()
-        latest_status["camera_connected"] = ok_open
-        if ok_open:
-            latest_status["camera_error"] = ""
-        else:
-            latest_status["camera_error"] = f"open camera failed, tried: {', '.join(tried)}"
 
-    ok = chassis.open()
-    with lock:
-        latest_status["chassis_connected"] = bool(ok)
-        latest_status["chassis_error"] = "" if ok else f"open {CHASSIS_PORT} failed: {chassis.last_error}"
+class _LatestSlot:
+    """有界交接缓冲：写入方从不阻塞，满了就丢最旧的，读取方只取最新一项。"""
 
-    last_t = time.time()
-    frames_in_window = 0
-    fps = 0.0
+    def __init__(self, depth: int = 1):
+        self._items = deque(maxlen=max(1, int(depth)))
+        self._cond = threading.Condition()
+        self.dropped = 0
+
+    def put(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+            self._items.append(item)
+            self._cond.notify()
+
+    def take_latest(self, timeout: float = None):
+        """等待并取出最新一项，其余过期项计入 dropped；超时返回 None。"""
+        with self._cond:
+            if not self._items:
+                self._cond.wait(timeout)
+            if not self._items:
+                return None
+            item = self._items.pop()
+            self.dropped += len(self._items)
+            self._items.clear()
+            self._cond.notify_all()
+            return item
+
+    def wait_space(self, timeout: float = None) -> bool:
+        """等到缓冲有空位（读取方取走了上一项）；用于不需要丢帧的离线源做背压。"""
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self._cond.wait(timeout)
+            return len(self._items) < self._items.maxlen
+
+
+class _LocalPublisher:
+    """进程内发布：画面交给 stream 的编码缓存，有 SSE 客户端时才构造状态快照。
 
+    实时进程模式下换成 rtproc 里写共享内存的发布方，接口相同。
+    """
+
+    def active_streams(self):
+        return active_streams()
+
+    def wants_status(self) -> bool:
+        return status_wanted()
+
+    def publish(self, imgs, status):
+        if status is not None:
+            publish_status(status)
+        publish_frames(imgs)
+
+
+def _capture_stage(source: FrameSource, frame_slot: _LatestSlot):
+    """采集线程：只负责读帧，新帧直接覆盖未被取走的旧帧。"""
+    seq = 0
+    # fast 模式的离线源没有“最新帧”可言：等视觉取走上一帧再读，不空转也不丢帧
+    backpressure = not source.live and not source.realtime
     while True:
         try:
-            ok, frame = cap.read()
+            if backpressure and not frame_slot.wait_space(timeout=0.5):
+                continue
+            t0 = metrics.now()
+            ok, frame = source.read()
+            t_cap = metrics.now()
+            metrics.observe("capture.read", t_cap - t0)
+            if source.finished:
+                # 不循环的视频/图片读完了：停在最后一帧，不再送黑帧
+                with lock:
+                    latest_status["camera_connected"] = False
+                    latest_status["camera_error"] = "end of stream"
+                time.sleep(0.1)
+                continue
             if not ok or frame is None:
-                frame = np.zeros((height, width, 3), dtype=np.uint8)
+                frame = np.zeros((source.height, source.width, 3), dtype=np.uint8)
                 with lock:
                     latest_status["camera_connected"] = False
-                    latest_status["camera_error"] = "no frame"
+                    latest_status["camera_error"] = source.error or "no frame"
+                # 读帧失败时不会阻塞在 read 上，稍微让出 CPU
+                time.sleep(0.01)
             else:
                 with lock:
                     latest_status["camera_connected"] = True
                     latest_status["camera_error"] = ""
+            seq += 1
+            frame_slot.put((seq, t_cap, frame))
+        except Exception as e:
+            with lock:
+                latest_status["camera_error"] = str(e)
+                latest_status["camera_connected"] = False
+            time.sleep(0.05)
+
+
+def _vision_stage(frame_slot: _LatestSlot, result_slot: _LatestSlot, publisher):
+    """视觉线程：取最新帧处理，结果交给执行线程。"""
+    while True:
+        item = frame_slot.take_latest(timeout=0.5)
+        if item is None:
+            continue
+        seq, t_cap, frame = item
+        try:
+            t0 = metrics.now()
+            metrics.observe("vision.queue_wait", t0 - t_cap)
+            # 只取当前快照的引用：不加锁、不复制，控制也用同一份快照
+            snap = current_params()
+            # 录制时连同本帧开始前的跟踪状态一起保存，回放才能从录制中途逐帧复现
+            vstate = frame_state() if recorder.active else None
 
+            imgs, err, overlay = process_image(frame, snap.values, outputs=publisher.active_streams())
+            metrics.observe("vision.total", metrics.now() - t0)
+            result_slot.put((seq, t_cap, frame, snap, imgs, err, overlay, vstate))
+        except Exception as e:
             with lock:
-                local_params: Dict = dict(params)
+                latest_status["camera_error"] = str(e)
+                latest_status["camera_connected"] = False
+            time.sleep(0.05)
 
-            imgs, err, overlay = process_image(frame, local_params)
-            motor_duty, servo_pos, scs_mode, headlight, mode = compute_control(err)
+
+def _actuation_stage(frame_slot: _LatestSlot, result_slot: _LatestSlot, publisher):
+    """执行线程：视觉结果一到就计算控制量并下发底盘，再更新状态。"""
+    last_t = time.time()
+    frames_in_window = 0
+    fps = 0.0
+
+    while True:
+        item = result_slot.take_latest(timeout=0.5)
+        if item is None:
+            continue
+        _seq, t_cap, frame, snap, imgs, err, overlay, vstate = item
+        try:
+            t0 = metrics.now()
+            tel = chassis.latest_telemetry()
+            speed = tel.speed if tel is not None else None
+            motor_duty, servo_pos, scs_mode, headlight, mode = compute_control(err, snap, speed)
+            if recorder.active:
+                recorder.record(t_cap, frame, snap.values,
+                                {"err": float(err), "servo": int(servo_pos), "motor": float(motor_duty), "mode": mode,
+                                 "speed": speed, "vision": vstate})
 
             if not chassis.is_open():
                 if chassis.open():
@@ -95,11 +162,13 @@ def camera_loop(camera_index=0, width=320, height=240):
                     motor_duty = 0.0
                     with lock:
                         latest_status["chassis_connected"] = False
-                        latest_status["chassis_error"] = f"open {CHASSIS_PORT} failed: {chassis.last_error}"
+                        latest_status["chassis_error"] = f"open {chassis.port} failed: {chassis.last_error}"
 
             if chassis.is_open():
                 try:
                     chassis.send(motor_duty, servo_pos, scs_mode, headlight)
+                    # 从采到帧到控制量交给底盘线程的端到端延迟
+                    metrics.observe("pipeline.capture_to_send", metrics.now() - t_cap)
                     with lock:
                         latest_status["chassis_connected"] = True
                         latest_status["chassis_error"] = ""
@@ -116,48 +185,77 @@ def camera_loop(camera_index=0, width=320, height=240):
                 frames_in_window = 0
                 last_t = now
 
+            t1 = metrics.now()
             with lock:
+                metrics.observe("actuation.lock_wait", metrics.now() - t1)
                 latest_frames.update(imgs)
                 latest_status["fps"] = float(fps)
                 latest_status["err"] = float(err)
                 latest_status["servo_position"] = int(servo_pos)
                 latest_status["motor_duty"] = float(motor_duty)
                 latest_status["mode"] = mode
+                latest_status["capture_dropped"] = frame_slot.dropped
+                latest_status["vision_dropped"] = result_slot.dropped
+                stats = fit_stats()
+                latest_status["fit_tracked"] = stats["track"]
+                latest_status["fit_searched"] = stats["search"]
+                latest_status.update(governor_stats())
+                latest_status.update(recorder.stats())
+                latest_status.update(chassis.stats())
                 latest_overlay.update(overlay)
+                snapshot = None
+                if publisher.wants_status():
+                    snapshot = dict(latest_status)
+                    snapshot["overlay"] = dict(latest_overlay)
+            publisher.publish(imgs, snapshot)
+            metrics.observe("actuation.total", metrics.now() - t0)
 
         except Exception as e:
             with lock:
                 latest_status["camera_error"] = str(e)
                 latest_status["camera_connected"] = False
             time.sleep(0.05)
-        time.sleep(0.01)
 
 
-def mjpeg_stream(name: str):
-    while True:
-        with lock:
-            img = latest_frames.get(name, None)
-
-        if img is None:
-            placeholder = np.zeros((240, 320, 3), dtype=np.uint8)
-            cv.putText(placeholder, f"Waiting: {name}", (10, 120),
-                       cv.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
-            ok, jpg = cv.imencode(".jpg", placeholder, [int(cv.IMWRITE_JPEG_QUALITY), 80])
-        else:
-            ok, jpg = cv.imencode(".jpg", img, [int(cv.IMWRITE_JPEG_QUALITY), 80])
-
-        if not ok:
-            continue
+def camera_loop(camera_index=0, width=320, height=240, buffer_depth=1, source: FrameSource = None,
+                publisher=None):
+    """采集 / 视觉 / 执行三级流水线，各级之间用有界缓冲交接，只处理最新帧。
+
+    source 缺省时打开 camera_index 号摄像头；publisher 缺省时画面和状态发布给本进程的 stream 模块。
+    """
+    if source is None:
+        source = CameraSource(camera_index, width, height)
+    if publisher is None:
+        publisher = _LocalPublisher()
+    ok_open = source.open()
+
+    with lock:
+        latest_status["running"] = True
+        latest_status["frame_source"] = source.describe()
+        latest_status["camera_connected"] = ok_open
+        latest_status["camera_error"] = "" if ok_open else source.error
+
+    ok = chassis.open()
+    with lock:
+        latest_status["chassis_connected"] = bool(ok)
+        latest_status["chassis_error"] = "" if ok else f"open {chassis.port} failed: {chassis.last_error}"
+
+    frame_slot = _LatestSlot(buffer_depth)
+    result_slot = _LatestSlot(buffer_depth)
+
+    threading.Thread(target=_capture_stage, args=(source, frame_slot), daemon=True).start()
+    threading.Thread(target=_actuation_stage, args=(frame_slot, result_slot, publisher), daemon=True).start()
 
-        yield (b"--frame\r\n"
-               b"Content-Type: image/jpeg\r\n\r\n" + jpg.tobytes() + b"\r\n")
-        time.sleep(0.03)
+    # 视觉级直接跑在本线程
+    _vision_stage(frame_slot, result_slot, publisher)
 
 
-def start_camera_thread():
+def start_camera_thread(source: FrameSource = None):
+    """source 缺省时按 FRAME_SOURCE / FRAME_SIZE / FRAME_PACING 环境变量构造（默认 0 号摄像头 320x240）。"""
+    source = source or make_source()
     th = threading.Thread(
         target=camera_loop,
-        kwargs={"camera_index": 0, "width": 320, "height": 240},
+        kwargs={"width": source.width, "height": source.height, "source": source},
         daemon=True
     )
     th.start()
@@ -1,13 +1,16 @@
+import os
 import serial
-import time
 import threading
 import struct
 
+import metrics
+
 # ==============================================================================
 # 1. 常量定义
 # ==============================================================================
 
-CHASSIS_PORT = "/dev/ttyTHS1"  
+# 可用环境变量指向其它串口，例如 chassis_emulator.py 建的伪终端
+CHASSIS_PORT = os.environ.get("CHASSIS_PORT", "/dev/ttyTHS1")
 MMWR_BAUD_RATE = 115200
 
 SCS_MODE_ACKERMAN = 0
@@ -24,6 +27,22 @@ MAX_POSITION = 2200
 MIN_DUTY = 0.0
 MAX_DUTY = 0.2
 
+# 协议帧：FF | 方向 | 占空比*100 (u16 LE) | 舵机 (u16 LE) | 模式 | 车灯 | FE，共 9 字节
+PACKET = struct.Struct("<BBHHBBB")
+PACKET_HEADER = 0xFF
+PACKET_ENDER = 0xFE
+
+# 目标不变时的重发频率（Hz），底盘靠它判断上位机仍在线；<=0 表示只在目标变化时发送
+KEEPALIVE_HZ = float(os.environ.get("CHASSIS_KEEPALIVE_HZ", "20"))
+
+# 底盘回传帧（固件未给出文档，按与下发帧对称的格式假定，改协议时只需改这里）：
+# FF | 轮速 (i16 LE) | 电池电压 mV (u16 LE) | 状态 | 校验（中间 5 字节之和低 8 位） | FE，共 8 字节
+TELEMETRY = struct.Struct("<BhHBBB")
+# 轮速原始值换算成与 speed_target 相同的单位（占空比）
+TELEMETRY_SPEED_SCALE = 0.001
+# 超过这个时间没有新回传就视为无反馈（秒）
+TELEMETRY_MAX_AGE = 0.2
+
 # 修复了这里的参数名错误：hi -> high
 def clamp(value, low, high):
     """Clamp value between low/high."""
@@ -47,27 +66,31 @@ def scs_data_deal(scs_steering):
     return steering_input.to_bytes(2, byteorder='little')
 
 
-def send_data_import(uart, motor_value, scs_steering, scs_mode, headlight):
-    protocol_header = b'\xFF'
-    protocol_ender = b'\xFE'
-    
+def _packet_fields(motor_value, scs_steering, scs_mode, headlight):
+    """量化成协议字段 (方向, 占空比*100, 舵机, 模式, 车灯)，与 motor_data_deal / scs_data_deal 规则一致。"""
+    motor_value = float(motor_value)
+    sign = 0
     if motor_value < 0:
         motor_value = -motor_value
-        motor_data_pandn = b'\x01'
-    else:
-        motor_data_pandn = b'\x00'
-        
-    motor_input = motor_data_deal(motor_value)
-    steering_input = scs_data_deal(scs_steering)
-
-    if isinstance(scs_mode, int):
-        scs_mode = bytes([scs_mode])
-    
-    if isinstance(headlight, int):
-        headlight = bytes([headlight])
-
-    data_packet = protocol_header + motor_data_pandn + motor_input + steering_input + scs_mode + headlight + protocol_ender
-    
+        sign = 1
+    motor_int = int(clamp(motor_value, MIN_DUTY, MAX_DUTY) * 100)
+    steering = clamp(int(scs_steering), MIN_POSITION, MAX_POSITION)
+    if isinstance(scs_mode, (bytes, bytearray)):
+        scs_mode = scs_mode[0]
+    if isinstance(headlight, (bytes, bytearray)):
+        headlight = headlight[0]
+    return sign, motor_int, steering, int(scs_mode), int(headlight)
+
+
+def pack_packet(buf, fields):
+    """把 _packet_fields 的结果打包进预分配的 buf（至少 PACKET.size 字节）。"""
+    PACKET.pack_into(buf, 0, PACKET_HEADER, *fields, PACKET_ENDER)
+
+
+def send_data_import(uart, motor_value, scs_steering, scs_mode, headlight):
+    data_packet = bytearray(PACKET.size)
+    pack_packet(data_packet, _packet_fields(motor_value, scs_steering, scs_mode, headlight))
+
     try:
         if uart and uart.is_open:
             uart.write(data_packet)
@@ -75,6 +98,49 @@ def send_data_import(uart, motor_value, scs_steering, scs_mode, headlight):
         pass
 
 
+class Telemetry:
+    """一帧解析后的底盘回传，只读；t 为 metrics.now() 时间戳。"""
+
+    __slots__ = ("t", "speed", "battery", "state")
+
+    def __init__(self, t: float, speed: float, battery: float, state: int):
+        self.t = t
+        self.speed = speed
+        self.battery = battery
+        self.state = state
+
+
+def parse_telemetry(buf: bytearray, t: float):
+    """从接收缓冲头部增量解析回传帧，已处理的字节从 buf 中删除。
+
+    返回 (最后一帧 Telemetry 或 None, 有效帧数, 丢弃的坏帧数)。
+    """
+    size = TELEMETRY.size
+    latest = None
+    frames = 0
+    bad = 0
+    pos = 0
+    n = len(buf)
+    while True:
+        pos = buf.find(PACKET_HEADER, pos)
+        if pos < 0:
+            pos = n
+            break
+        if n - pos < size:
+            break
+        _h, speed, battery, state, checksum, ender = TELEMETRY.unpack_from(buf, pos)
+        if ender != PACKET_ENDER or (sum(buf[pos + 1:pos + size - 2]) & 0xFF) != checksum:
+            # 帧头是误匹配或数据损坏：跳过这个字节重新找帧头
+            bad += 1
+            pos += 1
+            continue
+        latest = Telemetry(t, speed * TELEMETRY_SPEED_SCALE, battery / 1000.0, state)
+        frames += 1
+        pos += size
+    del buf[:pos]
+    return latest, frames, bad
+
+
 def receive_data(uart):
     if not uart or not uart.is_open:
         return
@@ -90,26 +156,53 @@ def receive_data(uart):
 # ==============================================================================
 
 class Chassis:
-    def __init__(self):
+    """底盘串口写线程：目标变化时立即发送，目标不变时按 keepalive_hz 重发。"""
+
+    def __init__(self, keepalive_hz: float = KEEPALIVE_HZ, port: str = None):
+        self.port = port or CHASSIS_PORT
         self.uart = None
         self.last_error = ""
-        
+        self.keepalive_hz = keepalive_hz
+
         self._running = False
         self._thread = None
         self._lock = threading.Lock()
-        
+        self._wake = threading.Event()
+
         # 共享控制变量
         self.target_motor = 0.0
         self.target_servo = CENTER_POSITION
         self.target_mode = SCS_MODE_ACKERMAN
         self.target_light = HEADLIGHT_OFF
-        
+
+        # 量化后的协议字段及其设置时间，None 表示还没发过
+        self._fields = None
+        self._fields_t = 0.0
+        self._unsent = False
+        self._buf = bytearray(PACKET.size)
+
+        # 回传：读线程整体替换引用，读取方不加锁
+        self.telemetry = None
+        self.telemetry_frames = 0
+        self.telemetry_errors = 0
+        self._reader = None
+
+        # 统计
+        self.packets = 0
+        self.keepalives = 0
+        self.superseded = 0
+        self.pps = 0.0
+        self.write_latency = 0.0
+        self.out_waiting = 0
 
     def open(self):
         if self.uart and self.uart.is_open:
             return True
+        if self.uart is not None:
+            # 读写线程出错时已关掉串口：先收掉旧线程再重开
+            self.close()
         try:
-            self.uart = serial.Serial(CHASSIS_PORT, MMWR_BAUD_RATE, timeout=0.1)
+            self.uart = serial.Serial(self.port, MMWR_BAUD_RATE, timeout=0.1)
             self._start_loop()
             return True
         except Exception as e:
@@ -121,39 +214,156 @@ class Chassis:
 
     def close(self):
         self._running = False
+        self._wake.set()
         if self._thread:
             self._thread.join(timeout=1.0)
+        if self._reader:
+            self._reader.join(timeout=1.0)
+            self._reader = None
         if self.uart:
             self.uart.close()
             self.uart = None
 
     def send(self, motor, servo, mode, light):
+        fields = _packet_fields(motor, servo, mode, light)
         with self._lock:
             self.target_motor = motor
             self.target_servo = servo
             self.target_mode = mode
             self.target_light = light
+            if fields == self._fields:
+                return
+            if self._unsent:
+                # 上一个目标还没写出就被新目标覆盖
+                self.superseded += 1
+            self._fields = fields
+            self._fields_t = metrics.now()
+            self._unsent = True
+        # 量化后真的变了才唤醒写线程
+        self._wake.set()
+
+    def latest_telemetry(self, max_age: float = TELEMETRY_MAX_AGE):
+        """最近一帧回传；没有或已超过 max_age 秒时返回 None。"""
+        tel = self.telemetry
+        if tel is None or metrics.now() - tel.t > max_age:
+            return None
+        return tel
+
+    def stats(self):
+        tel = self.telemetry
+        return {
+            "chassis_packets": self.packets,
+            "chassis_pps": round(self.pps, 1),
+            "chassis_write_ms": round(self.write_latency * 1e3, 3),
+            "chassis_out_bytes": self.out_waiting,
+            "chassis_last_error": self.last_error,
+            "speed_measured": tel.speed if tel else None,
+            "battery_v": tel.battery if tel else None,
+            "chassis_state": tel.state if tel else None,
+            "telemetry_age_ms": round((metrics.now() - tel.t) * 1e3, 1) if tel else None,
+            "telemetry_frames": self.telemetry_frames,
+            "telemetry_errors": self.telemetry_errors,
+        }
 
     def _start_loop(self):
         if self._thread and self._thread.is_alive():
             return
         self._running = True
-        self._thread = threading.Thread(target=self._demo_loop_worker, daemon=True)
+        self.telemetry = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
         self._thread.start()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _writer(self):
+        uart = self.uart
+        sent_fields = None
+        last_write = 0.0
+        window_start = metrics.now()
+        window_packets = 0
+
+        while self._running and uart.is_open:
+            period = 1.0 / self.keepalive_hz if self.keepalive_hz > 0 else None
+            if period is not None and self._fields is not None:
+                self._wake.wait(max(0.0, last_write + period - metrics.now()))
+            else:
+                # 还没有控制量（或不保活）时只等 send() / close() 唤醒
+                self._wake.wait(0.5)
+            self._wake.clear()
+            if not self._running:
+                break
 
-    def _demo_loop_worker(self):
-        # print(">>> 底盘后台线程启动")
-        while self._running and self.uart and self.uart.is_open:
             with self._lock:
-                m = self.target_motor
-                s = self.target_servo
-                md = self.target_mode
-                lt = self.target_light
-            
-            send_data_import(self.uart, m, s, md, lt)
-            receive_data(self.uart)
-            time.sleep(0.002)
+                fields = self._fields
+                fields_t = self._fields_t
+                self._unsent = False
+            if fields is None:
+                continue
+            changed = fields != sent_fields
+            t0 = metrics.now()
+            if not changed and (period is None or t0 - last_write < period):
+                continue
+
+            pack_packet(self._buf, fields)
+            try:
+                uart.write(self._buf)
+            except Exception as e:
+                self._fail(uart, e)
+                break
+            t1 = metrics.now()
+            metrics.observe("chassis.write", t1 - t0)
+            self.write_latency = t1 - t0
+            if changed:
+                # 控制量交给 send() 到写进串口的延迟
+                metrics.observe("chassis.cmd_to_wire", t1 - fields_t)
+            else:
+                self.keepalives += 1
+            try:
+                self.out_waiting = uart.out_waiting
+            except Exception:
+                self.out_waiting = 0
+
+            sent_fields = fields
+            last_write = t1
+            self.packets += 1
+            window_packets += 1
+            if t1 - window_start >= 1.0:
+                self.pps = window_packets / (t1 - window_start)
+                window_start = t1
+                window_packets = 0
+
+    def _fail(self, uart, e: Exception):
+        """串口读写出错：记下错误并关掉串口，is_open() 变为 False，由执行线程走重开流程。"""
+        self.last_error = str(e)
+        try:
+            uart.close()
+        except Exception:
+            pass
+
+    def _read_loop(self):
+        """读线程：阻塞读（串口超时 0.1 s）进接收缓冲，按帧解析后发布最新回传。"""
+        uart = self.uart
+        buf = bytearray()
+        while self._running and uart.is_open:
+            try:
+                data = uart.read(max(1, uart.in_waiting))
+            except Exception as e:
+                self._fail(uart, e)
+                break
+            if not data:
+                continue
+            t = metrics.now()
+            buf += data
+            latest, frames, bad = parse_telemetry(buf, t)
+            self.telemetry_frames += frames
+            self.telemetry_errors += bad
+            if latest is not None:
+                self.telemetry = latest
+                metrics.observe("chassis.parse", metrics.now() - t)
+            # 长时间收不到合法帧时不让缓冲无限增长
+            if len(buf) > 4096:
+                del buf[:-TELEMETRY.size]
 
 
 # 全局单例
-chassis = Chassis()
\ No newline at end of file
+chassis = Chassis()
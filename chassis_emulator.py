@@ -0,0 +1,294 @@
+"""
+伪终端底盘模拟器：不接小车也能跑通并测量串口链路。
+
+    python3 chassis_emulator.py --telemetry-hz 50            # 打印伪终端路径后常驻
+    CHASSIS_PORT=/dev/pts/5 python3 app.py                   # 让后端连到模拟器
+    python3 chassis_emulator.py --bench --baud 115200 --jitter 0.002 --loss 0.001
+
+模拟器在 Linux 伪终端上按 send_data_import 的协议（FF … FE，9 字节）解析下发帧，
+可按波特率限速、加随机延迟和丢字节，并可按 chassis.TELEMETRY 格式回传轮速/电压/状态
+（轮速按一阶惯性跟随下发占空比）。--bench 用 Chassis 写线程以固定频率下发指令，
+统计指令到模拟器收到的延迟分布以及丢失、损坏的包数。每条指令的 (方向, 占空比, 舵机) 组合各不相同，
+一次测试最多 BENCH_MAX_COMMANDS 条（--rate * --duration 超过时直接报错）。
+"""
+import argparse
+import json
+import os
+import random
+import struct
+import threading
+import time
+import tty
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from chassis import (
+    MAX_DUTY,
+    MAX_POSITION,
+    MIN_POSITION,
+    PACKET,
+    PACKET_ENDER,
+    PACKET_HEADER,
+    TELEMETRY,
+    TELEMETRY_SPEED_SCALE,
+    Chassis,
+)
+
+# 轮速跟随占空比的时间常数（秒）
+SPEED_TAU = 0.3
+BATTERY_MV = 7400
+
+
+class ChassisEmulator:
+    """在伪终端主端收发，从端路径 port 交给 Chassis 打开。
+
+    baud：按 10 bit/字节 限速（0 不限速）；jitter：每批字节额外的随机延迟上限（秒）；
+    loss：每个字节被丢掉的概率；telemetry_hz：回传频率（0 不回传）。
+    """
+
+    def __init__(self, baud: int = 0, jitter: float = 0.0, loss: float = 0.0, telemetry_hz: float = 0.0,
+                 seed: int = 0):
+        self.baud = baud
+        self.jitter = jitter
+        self.loss = loss
+        self.telemetry_hz = telemetry_hz
+        self._rng = random.Random(seed)
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        # (收到时间, (方向, 占空比*100, 舵机, 模式, 车灯))
+        self.received: List[Tuple[float, Tuple[int, int, int, int, int]]] = []
+        self.packets = 0
+        self.garbled = 0
+        self.bytes_lost = 0
+        self.telemetry_sent = 0
+        self.last_command: Optional[Tuple[int, int, int, int, int]] = None
+
+        self._running = False
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> "ChassisEmulator":
+        self._running = True
+        self._threads = [threading.Thread(target=self._rx_loop, daemon=True)]
+        if self.telemetry_hz > 0:
+            self._threads.append(threading.Thread(target=self._tx_loop, daemon=True))
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        # 写一个字节把阻塞在 read 上的接收线程叫醒
+        try:
+            os.write(self._slave, b"\x00")
+        except OSError:
+            pass
+        for t in self._threads:
+            t.join(timeout=1.0)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _rx_loop(self):
+        buf = bytearray()
+        wire_free = 0.0
+        while self._running:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            if not self._running:
+                break
+            now = metrics.now()
+
+            # 波特率限速：这批字节要在上一批发完之后才能“到达”
+            if self.baud > 0:
+                wire_free = max(wire_free, now) + len(data) * 10.0 / self.baud
+                arrive = wire_free
+            else:
+                arrive = now
+            if self.jitter > 0:
+                arrive += self._rng.uniform(0.0, self.jitter)
+            delay = arrive - metrics.now()
+            if delay > 0:
+                time.sleep(delay)
+
+            if self.loss > 0:
+                kept = bytearray(b for b in data if self._rng.random() >= self.loss)
+                self.bytes_lost += len(data) - len(kept)
+                data = kept
+            buf += data
+            self._parse(buf, metrics.now())
+
+    def _parse(self, buf: bytearray, t: float):
+        size = PACKET.size
+        pos = 0
+        n = len(buf)
+        while True:
+            pos = buf.find(PACKET_HEADER, pos)
+            if pos < 0:
+                pos = n
+                break
+            if n - pos < size:
+                break
+            _h, sign, motor, servo, mode, light, ender = PACKET.unpack_from(buf, pos)
+            if ender != PACKET_ENDER or not MIN_POSITION <= servo <= MAX_POSITION:
+                self.garbled += 1
+                pos += 1
+                continue
+            fields = (sign, motor, servo, mode, light)
+            self.received.append((t, fields))
+            self.last_command = fields
+            self.packets += 1
+            pos += size
+        del buf[:pos]
+
+    def _tx_loop(self):
+        period = 1.0 / self.telemetry_hz
+        speed = 0.0
+        last = metrics.now()
+        while self._running:
+            time.sleep(period)
+            now = metrics.now()
+            cmd = self.last_command
+            target = 0.0
+            if cmd is not None:
+                target = (-1 if cmd[0] else 1) * cmd[1] / 100.0
+            speed += (target - speed) * min(1.0, (now - last) / SPEED_TAU)
+            last = now
+            raw = int(round(speed / TELEMETRY_SPEED_SCALE))
+            body = struct.pack("<hHB", raw, BATTERY_MV, 0)
+            frame = TELEMETRY.pack(PACKET_HEADER, raw, BATTERY_MV, 0, sum(body) & 0xFF, PACKET_ENDER)
+            try:
+                os.write(self._master, frame)
+            except OSError:
+                break
+            self.telemetry_sent += 1
+
+
+# bench 的指令编号 -> (方向, 占空比*100, 舵机) 组合；舵机每条都变，相邻指令一定不同
+_BENCH_SERVOS = MAX_POSITION - MIN_POSITION + 1
+_BENCH_DUTIES = int(MAX_DUTY * 100) + 1
+BENCH_MAX_COMMANDS = 2 * _BENCH_DUTIES * _BENCH_SERVOS
+
+
+def _bench_command(i: int) -> Tuple[float, int, Tuple[int, int, int]]:
+    """第 i 条测试指令的 (电机值, 舵机值, 协议字段键)；i < BENCH_MAX_COMMANDS 时各不相同。"""
+    servo = MIN_POSITION + i % _BENCH_SERVOS
+    duty, sign = (i // _BENCH_SERVOS) % _BENCH_DUTIES, i // (_BENCH_SERVOS * _BENCH_DUTIES)
+    # 取量化区间的中点，int(x * 100) 不会因浮点误差落到相邻档
+    motor = (duty + 0.5) / 100.0
+    return (-motor if sign else motor), servo, (sign, duty, servo)
+
+
+def bench(rate: float = 200.0, duration: float = 5.0, baud: int = 115200, jitter: float = 0.0, loss: float = 0.0,
+          telemetry_hz: float = 50.0, keepalive_hz: float = 20.0, seed: int = 0) -> Dict[str, Any]:
+    """以 rate Hz 下发互不相同的指令（方向 + 占空比 + 舵机组合编号），按协议字段把下发和收到的包对上。
+
+    rate * duration 超过 BENCH_MAX_COMMANDS 时编号会重复、统计不再可靠，直接报 ValueError。
+    """
+    period = 1.0 / rate
+    n = int(duration * rate)
+    if n > BENCH_MAX_COMMANDS:
+        raise ValueError(f"rate * duration = {n} exceeds {BENCH_MAX_COMMANDS} distinct commands")
+    emu = ChassisEmulator(baud, jitter, loss, telemetry_hz, seed).start()
+    ch = Chassis(keepalive_hz=keepalive_hz, port=emu.port)
+    if not ch.open():
+        emu.stop()
+        raise RuntimeError(f"open {emu.port} failed: {ch.last_error}")
+
+    sent: Dict[Tuple[int, int, int], float] = {}
+    try:
+        start = metrics.now()
+        for i in range(n):
+            target = start + i * period
+            delay = target - metrics.now()
+            if delay > 0:
+                time.sleep(delay)
+            motor, servo, key = _bench_command(i)
+            sent[key] = metrics.now()
+            ch.send(motor, servo, 0, 0)
+        time.sleep(0.2 + jitter)
+    finally:
+        ch.close()
+        emu.stop()
+
+    # 同一条指令只取第一次收到的（之后的是保活重发）
+    latencies = []
+    seen = set()
+    for t, fields in emu.received:
+        key = tuple(fields[:3])
+        if key in sent and key not in seen:
+            seen.add(key)
+            latencies.append(t - sent[key])
+    ms = np.array(latencies) * 1e3 if latencies else np.zeros(1)
+    return {
+        "commands": len(sent),
+        "received": len(seen),
+        # 还没写出就被下一条指令覆盖的不算丢失
+        "superseded": ch.superseded,
+        "missing": max(0, len(sent) - len(seen) - ch.superseded),
+        "packets": emu.packets,
+        "keepalives": ch.keepalives,
+        "garbled": emu.garbled,
+        "bytes_lost": emu.bytes_lost,
+        "telemetry_sent": emu.telemetry_sent,
+        "telemetry_frames": ch.telemetry_frames,
+        "telemetry_errors": ch.telemetry_errors,
+        "latency_ms": {
+            "mean": float(np.mean(ms)),
+            "p50": float(np.percentile(ms, 50)),
+            "p95": float(np.percentile(ms, 95)),
+            "p99": float(np.percentile(ms, 99)),
+            "max": float(np.max(ms)),
+        },
+        "config": {"rate": rate, "duration": duration, "baud": baud, "jitter": jitter, "loss": loss,
+                   "telemetry_hz": telemetry_hz, "keepalive_hz": keepalive_hz},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="伪终端底盘模拟器 / 串口链路延迟测试")
+    parser.add_argument("--baud", type=int, default=115200, help="按该波特率限速，0 不限速")
+    parser.add_argument("--jitter", type=float, default=0.0, help="每批字节的随机延迟上限（秒）")
+    parser.add_argument("--loss", type=float, default=0.0, help="每个字节的丢失概率")
+    parser.add_argument("--telemetry-hz", type=float, default=0.0, help="回传频率，0 不回传")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--bench", action="store_true", help="跑延迟测试后退出")
+    parser.add_argument("--rate", type=float, default=200.0, help="测试时的下发频率（Hz）")
+    parser.add_argument("--duration", type=float, default=5.0, help="测试时长（秒）")
+    parser.add_argument("--keepalive-hz", type=float, default=20.0)
+    parser.add_argument("--out", help="测试结果 JSON 文件")
+    args = parser.parse_args()
+
+    if args.bench:
+        report = bench(args.rate, args.duration, args.baud, args.jitter, args.loss,
+                       args.telemetry_hz or 50.0, args.keepalive_hz, args.seed)
+        text = json.dumps(report, indent=2)
+        print(text)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+        return
+
+    emu = ChassisEmulator(args.baud, args.jitter, args.loss, args.telemetry_hz, args.seed).start()
+    print(f"chassis emulator on {emu.port}  (CHASSIS_PORT={emu.port} python3 app.py)")
+    try:
+        while True:
+            time.sleep(1.0)
+            print(f"packets {emu.packets}  garbled {emu.garbled}  last {emu.last_command}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,17 @@
+import atexit
+import itertools
 import json
+import os
+import sys
 import threading
+import time
 from pathlib import Path
-from typing import Any, Dict
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, List, Mapping
 
 import numpy as np
 
+import metrics
 from chassis import (
     CENTER_POSITION,
     HEADLIGHT_OFF,
@@ -13,6 +20,7 @@ from chassis import (
     MIN_POSITION,
     MIN_DUTY,
     SCS_MODE_ACKERMAN,
+    chassis,
     clamp,
 )
 from .lqr import LQRController, build_default_lqr
@@ -24,13 +32,26 @@ DEFAULT_CONFIG_PATH = ROOT / "config" / "defaults.json"
 LAST_CONFIG_PATH = ROOT / "config" / "last.json"
 LAST_CONFIG_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+# 参数保存的去抖窗口（秒）
+SAVE_DEBOUNCE = 0.5
+
+# 参数文件格式版本；旧版本保存的文件加载时由 _migrate_params 升级
+PARAMS_SCHEMA = 2
+
 DEFAULT_PARAMS: Dict[str, Any] = {
     # 视觉参数
-    "binary_value": 90,
+    "binary_value": 60,
     "canny_low_threshold": 68,
     "hof_threshold": 40,
     "hof_min_line_len": 20,
     "hof_max_line_gap": 10,
+    # 滑窗搜索：窗口数、窗口半宽（像素）、窗口重新居中所需的最少像素
+    "fit_nwindows": 6,
+    "fit_margin": 40,
+    "fit_minpix": 20,
+    # 处理分辨率（相对采集帧的比例）；单帧视觉耗时预算（毫秒，0 表示不自动调档）
+    "vision_scale": 1.0,
+    "frame_budget_ms": 0.0,
 
     # 模式：1=自动巡线，0=手动
     "auto_drive": 0,
@@ -61,6 +82,8 @@ DEFAULT_PARAMS: Dict[str, Any] = {
     "speed_kd": 0.02,
     "speed_dt": 0.02,
     "speed_slowdown_gain": 0.002,  # 按横向误差降速
+    # PID 的速度反馈：0=上一次输出，1=底盘回传的实测速度（回传格式未经实车确认，默认关闭）
+    "speed_feedback": 0,
 
     # 手动控制值
     "manual_motor": 0.0,
@@ -70,8 +93,14 @@ DEFAULT_PARAMS: Dict[str, Any] = {
     "scs_mode": SCS_MODE_ACKERMAN,
     "headlight": HEADLIGHT_OFF,
 
-    # ROI 顶点（规范化坐标 0-1）
+    # ROI 顶点（规范化坐标 0-1），>=4 个点时用于鸟瞰变换
     "roi_points": [],
+
+    # 相机内参（3x3）与畸变系数，留空则不做去畸变；需与采集分辨率一致
+    "camera_matrix": [],
+    "dist_coeffs": [],
+
+    "params_schema": PARAMS_SCHEMA,
 }
 
 # 参数类型
@@ -81,6 +110,11 @@ PARAM_TYPES: Dict[str, str] = {
     "hof_threshold": "int",
     "hof_min_line_len": "int",
     "hof_max_line_gap": "int",
+    "fit_nwindows": "int",
+    "fit_margin": "int",
+    "fit_minpix": "int",
+    "vision_scale": "float",
+    "frame_budget_ms": "float",
 
     "auto_drive": "int",
 
@@ -106,6 +140,7 @@ PARAM_TYPES: Dict[str, str] = {
     "speed_kd": "float",
     "speed_dt": "float",
     "speed_slowdown_gain": "float",
+    "speed_feedback": "int",
 
     "manual_motor": "float",
     "manual_servo": "int",
@@ -114,9 +149,51 @@ PARAM_TYPES: Dict[str, str] = {
     "headlight": "int",
 
     "roi_points": "list",
+    "camera_matrix": "list",
+    "dist_coeffs": "list",
 }
 
 
+def parse_param_grid(items: Iterable[str]) -> Dict[str, List[Any]]:
+    """解析命令行的 KEY=V1,V2,... 为参数取值表（只接受 PARAM_TYPES 里的数值参数），供 sim.py / tune.py 扫参。"""
+    grid: Dict[str, List[Any]] = {}
+    for item in items:
+        key, _, values = item.partition("=")
+        kind = PARAM_TYPES.get(key)
+        if kind not in ("int", "float"):
+            raise SystemExit(f"unknown numeric param: {key}")
+        cast = (lambda s: int(float(s))) if kind == "int" else float
+        grid[key] = [cast(v) for v in values.split(",") if v]
+    return grid
+
+
+def param_grid_configs(grid: Mapping[str, List[Any]]) -> List[Dict[str, Any]]:
+    """取值表的笛卡尔积，每项是一组参数覆盖；空表时为一组空覆盖（即默认参数）。"""
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))] or [{}]
+
+
+def _migrate_params(data: Dict[str, Any], source: Path = None) -> Dict[str, Any]:
+    """把旧版本保存的参数升级到当前含义，改动都打印到 stderr。
+
+    schema 1 -> 2：二值化阈值改为按 Sobel 最大值精确归一化（旧写法 255 * |s| 在 int16 里溢出，
+    阈值与边缘强度的关系不单调）。last.json 总是保存全部参数，文件里的 90 分不清是旧默认值还是特意调的：
+    一律按旧默认换成新默认 60 并提示；其他值保留原值，提示按新含义重新调。没有这个字段时直接用新默认。
+    """
+    if data.get("params_schema", 1) < 2 and "binary_value" in data:
+        name = source.name if source else "params"
+        old = data["binary_value"]
+        if old == 90:
+            data["binary_value"] = 60
+            print(f"{name}: binary_value 90 -> 60 (threshold normalisation changed in params_schema 2; "
+                  f"if 90 was tuned on purpose, re-tune it)", file=sys.stderr)
+        else:
+            print(f"{name}: keeping binary_value {old}, but the threshold normalisation changed in "
+                  f"params_schema 2; re-tune it (new default 60)", file=sys.stderr)
+    data["params_schema"] = PARAMS_SCHEMA
+    return data
+
+
 def _load_params_from_file(base: Dict[str, Any]) -> Dict[str, Any]:
     for path in (DEFAULT_CONFIG_PATH, LAST_CONFIG_PATH):
         if path.exists():
@@ -124,7 +201,7 @@ def _load_params_from_file(base: Dict[str, Any]) -> Dict[str, Any]:
                 with open(path, "r", encoding="utf-8") as f:
                     data = json.load(f)
                 if isinstance(data, dict):
-                    for k, v in data.items():
+                    for k, v in _migrate_params(data, path).items():
                         base[k] = v
             except Exception:
                 pass
@@ -132,26 +209,116 @@ def _load_params_from_file(base: Dict[str, Any]) -> Dict[str, Any]:
 
 
 def _save_params(path: Path, data: Dict[str, Any]):
+    """先写临时文件并 fsync，再原子改名，写到一半崩溃也不会留下截断的 JSON。"""
+    tmp = path.with_name(path.name + ".tmp")
     try:
         path.parent.mkdir(parents=True, exist_ok=True)
-        with open(path, "w", encoding="utf-8") as f:
+        with open(tmp, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
     except Exception:
         pass
 
 
+class _ParamSaver:
+    """后台持久化线程：去抖窗口内的多次保存合并成一次写盘，调用方从不等待磁盘。"""
+
+    def __init__(self, debounce: float = SAVE_DEBOUNCE):
+        self.debounce = debounce
+        self._cond = threading.Condition()
+        # path -> 快照；None 表示写盘时再取当前参数快照
+        self._pending: Dict[Path, Any] = {}
+        self._deadline = 0.0
+        self._thread = None
+        # flush() 和后台线程共用同一个临时文件，写盘必须串行
+        self._write_lock = threading.Lock()
+
+    def schedule(self, path: Path, snapshot: Dict[str, Any] = None):
+        with self._cond:
+            if not self._pending:
+                # 窗口从第一次请求开始计时，持续拖动滑块时也能按窗口周期落盘
+                self._deadline = time.monotonic() + self.debounce
+            self._pending[path] = dict(snapshot) if snapshot is not None else None
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def flush(self):
+        """立即写出所有待保存的内容（退出时调用）；后台线程正在写盘时等它写完。"""
+        self._write_pending()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                delay = self._deadline - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+            self._write_pending()
+
+    def _write_pending(self):
+        # 取走待写内容和写盘都在写锁内：两个写者不会交错写临时文件，先取走的也一定先落盘，旧快照不会盖掉新的
+        with self._write_lock:
+            with self._cond:
+                pending = self._pending
+                self._pending = {}
+            for path, snapshot in pending.items():
+                if snapshot is None:
+                    snapshot = dict(_snapshot.values)
+                _save_params(path, snapshot)
+
+
 def save_params(snapshot: Dict[str, Any] = None, path: Path = None):
-    """Persist parameters to config/last.json (default)."""
-    target = path or LAST_CONFIG_PATH
-    data = snapshot if snapshot is not None else params
-    _save_params(target, data)
+    """Persist parameters to config/last.json (default).
 
+    只登记保存请求，由后台线程去抖后写盘；未给 snapshot 时写盘的是当时最新的参数快照。
+    """
+    _saver.schedule(path or LAST_CONFIG_PATH, snapshot)
 
-# 共享参数（网页可调）
+
+def flush_params():
+    """把还在去抖窗口里的参数立即写盘。"""
+    _saver.flush()
+
+
+class ParamSnapshot:
+    """某一版本参数的只读快照；每次修改 params 后整体替换，读取方拿到引用即可，不加锁也不复制。"""
+
+    __slots__ = ("version", "values")
+
+    def __init__(self, version: int, values: Dict[str, Any]):
+        self.version = version
+        self.values: Mapping[str, Any] = MappingProxyType(values)
+
+
+# 共享参数（网页可调）：修改时持有 lock，改完调用 publish_params() 发布新快照
 params: Dict[str, Any] = _load_params_from_file(dict(DEFAULT_PARAMS))
+_snapshot = ParamSnapshot(1, dict(params))
+
+
+def publish_params() -> ParamSnapshot:
+    """params 修改完成后调用（调用方持有 lock），版本号加一并发布新快照。"""
+    global _snapshot
+    _snapshot = ParamSnapshot(_snapshot.version + 1, dict(params))
+    return _snapshot
+
+
+def current_params() -> ParamSnapshot:
+    """当前参数快照（引用赋值是原子的，无需加锁）。"""
+    return _snapshot
+
 
 # 共享状态
 lock = threading.Lock()
+
+_saver = _ParamSaver()
+atexit.register(flush_params)
+
 latest_frames: Dict[str, np.ndarray] = {}
 latest_status: Dict[str, Any] = {
     "fps": 0.0,
@@ -161,9 +328,36 @@ latest_status: Dict[str, Any] = {
     "running": False,
     "camera_connected": False,
     "camera_error": "",
+    "frame_source": "",
     "chassis_connected": False,
     "chassis_error": "",
     "mode": "manual",  # auto/manual
+    # 流水线各级被覆盖（丢弃）的帧数
+    "capture_dropped": 0,
+    "vision_dropped": 0,
+    # 车道拟合：沿上一帧快速跟踪 / 全图滑窗搜索的累计次数
+    "fit_tracked": 0,
+    "fit_searched": 0,
+    "vision_scale": 1.0,
+    "vision_level": 0,
+    "vision_ms": 0.0,
+    # 录制
+    "recording": False,
+    "record_frames": 0,
+    "record_dropped": 0,
+    "record_path": "",
+    # 底盘串口：累计发送包数、每秒包数、最近一次写耗时、发送缓冲中未发出的字节
+    "chassis_packets": 0,
+    "chassis_pps": 0.0,
+    "chassis_write_ms": 0.0,
+    "chassis_out_bytes": 0,
+    # 底盘回传：实测速度、电池电压 (V)、状态字、回传距今 (ms)、有效/坏帧数
+    "speed_measured": None,
+    "battery_v": None,
+    "chassis_state": None,
+    "telemetry_age_ms": None,
+    "telemetry_frames": 0,
+    "telemetry_errors": 0,
 }
 
 # 前端绘制所需的覆盖信息（由 vision 填充）
@@ -175,83 +369,134 @@ latest_overlay: Dict[str, Any] = {
     "roi_source": "default",
 }
 
+class ControlConfig:
+    """由参数快照预先解析出的控制配置，只在快照版本变化时重建。
+
+    lqr_key / pid_key 用来判断 LQR、PID 相关参数是否真的变了。
+    """
+
+    def __init__(self, snap: ParamSnapshot):
+        p = snap.values
+
+        def _f(k):
+            return float(p.get(k, DEFAULT_PARAMS[k]))
+
+        def _i(k):
+            return int(p.get(k, DEFAULT_PARAMS[k]))
+
+        self.version = snap.version
+        self.auto = _i("auto_drive") == 1
+        self.scs_mode = _i("scs_mode")
+        self.headlight = _i("headlight")
+        self.manual_motor = _f("manual_motor")
+        self.manual_servo = _i("manual_servo")
+
+        self.center = _i("steer_center")
+        self.steer_mode = _i("steer_mode")
+        self.steer_k = _f("steer_k")
+        self.inv = _i("steer_invert")
+        self.lqr_key = (_f("lqr_q1"), _f("lqr_q2"), _f("lqr_r"), _f("lqr_dt"), _f("lqr_velocity"))
+
+        self.base = _f("motor_base")
+        self.mk = _f("motor_k")
+        self.mmin = _f("motor_min")
+        self.mmax = _f("motor_max")
+
+        self.speed_mode = _i("speed_mode")
+        self.speed_feedback = _i("speed_feedback") == 1
+        self.speed_target = float(p.get("speed_target", self.base))
+        # kp, ki, kd, dt, 输出限幅, 降速系数
+        self.pid_key = (_f("speed_kp"), _f("speed_ki"), _f("speed_kd"), _f("speed_dt"),
+                        (self.mmin, self.mmax), _f("speed_slowdown_gain"))
+
+
 # 速度 PID 控制器
 _speed_pid = SpeedPIDController()
 _last_motor = 0.0
 _lqr = None
-_last_lqr_cfg = None
-
-
-def compute_control(err: float):
-    global _last_motor, _lqr, _last_lqr_cfg
-    with lock:
-        auto = int(params["auto_drive"]) == 1
-        scs_mode = int(params["scs_mode"])
-        headlight = int(params["headlight"])
-
-        if not auto:
-            motor = float(params["manual_motor"])
-            servo = int(params["manual_servo"])
-            return motor, servo, scs_mode, headlight, "manual"
-
-        center = int(params["steer_center"])
-        steer_mode = int(params.get("steer_mode", 0))
-        steer_k = float(params["steer_k"])
-        inv = int(params["steer_invert"])
-        lqr_q1 = float(params.get("lqr_q1", 5.0))
-        lqr_q2 = float(params.get("lqr_q2", 1.0))
-        lqr_r = float(params.get("lqr_r", 0.8))
-        lqr_dt = float(params.get("lqr_dt", 0.05))
-        lqr_vel = float(params.get("lqr_velocity", 0.6))
-
-        base = float(params["motor_base"])
-        mk = float(params["motor_k"])
-        mmin = float(params["motor_min"])
-        mmax = float(params["motor_max"])
-
-        speed_mode = int(params.get("speed_mode", 0))
-        speed_target = float(params.get("speed_target", base))
-        pid_kp = float(params.get("speed_kp", _speed_pid.kp))
-        pid_ki = float(params.get("speed_ki", _speed_pid.ki))
-        pid_kd = float(params.get("speed_kd", _speed_pid.kd))
-        pid_dt = float(params.get("speed_dt", _speed_pid.dt))
-        slowdown_gain = float(params.get("speed_slowdown_gain", _speed_pid.slowdown_gain))
+_cfg = None
+_pid_key = None
+
+
+def reset_control_state():
+    """清空控制器内部状态（PID 积分、LQR 缓存），用于离线回放等需要从头复现的场景。"""
+    global _last_motor, _lqr, _cfg, _pid_key
+    _speed_pid.reset()
+    _last_motor = 0.0
+    _lqr = None
+    _cfg = None
+    _pid_key = None
+
+
+def _control_config(snap: ParamSnapshot) -> ControlConfig:
+    """取与快照同版本的 ControlConfig；版本变化时重建，并按需重建 LQR / 更新 PID 参数。"""
+    global _cfg, _lqr, _pid_key
+    cfg = _cfg
+    if cfg is not None and cfg.version == snap.version:
+        return cfg
+
+    cfg = ControlConfig(snap)
+    if _cfg is None or _cfg.lqr_key != cfg.lqr_key:
+        # LQR 参数变了：丢弃旧增益，下一次 LQR 控制时按新参数重建
+        _lqr = None
+    if _pid_key != cfg.pid_key:
+        _speed_pid.kp, _speed_pid.ki, _speed_pid.kd, _speed_pid.dt, \
+            _speed_pid.output_limits, _speed_pid.slowdown_gain = cfg.pid_key
+        _pid_key = cfg.pid_key
+    _cfg = cfg
+    return cfg
+
+
+def compute_control(err: float, snapshot: ParamSnapshot = None, measured_speed: float = None):
+    """snapshot 缺省时用当前参数快照；流水线里传入视觉用的那一份，保证同一帧参数一致。
+
+    measured_speed 为底盘回传的实测速度，只在 speed_feedback=1 时使用，缺省时取 chassis 最新的新鲜回传；
+    未开启或都没有时 PID 用上一次的输出当作反馈。
+    """
+    global _last_motor, _lqr
+    t0 = metrics.now()
+    cfg = _control_config(snapshot or _snapshot)
+
+    if not cfg.auto:
+        metrics.observe("control.total", metrics.now() - t0)
+        return cfg.manual_motor, cfg.manual_servo, cfg.scs_mode, cfg.headlight, "manual"
 
     # 方向控制
     servo = None
-    if steer_mode == 1:
-        cfg = (lqr_q1, lqr_q2, lqr_r, lqr_dt, lqr_vel)
-        if _lqr is None or _last_lqr_cfg != cfg:
+    if cfg.steer_mode == 1:
+        if _lqr is None:
             try:
-                _lqr = build_default_lqr(dt=lqr_dt, velocity=lqr_vel, q_diag=(lqr_q1, lqr_q2), r=lqr_r)
-                _last_lqr_cfg = cfg
+                t1 = metrics.now()
+                q1, q2, r, dt, vel = cfg.lqr_key
+                _lqr = build_default_lqr(dt=dt, velocity=vel, q_diag=(q1, q2), r=r)
+                metrics.observe("control.lqr_build", metrics.now() - t1)
             except Exception:
                 _lqr = None
         if _lqr is not None:
             try:
                 u = _lqr.control([err, 0.0])
-                servo = int(center + inv * u)
+                servo = int(cfg.center + cfg.inv * u)
             except Exception:
                 servo = None
 
     if servo is None:
-        servo = int(center + inv * steer_k * err)
+        servo = int(cfg.center + cfg.inv * cfg.steer_k * err)
 
     servo = int(clamp(servo, MIN_POSITION, MAX_POSITION))
 
-    if speed_mode == 1:
-        _speed_pid.kp = pid_kp
-        _speed_pid.ki = pid_ki
-        _speed_pid.kd = pid_kd
-        _speed_pid.dt = pid_dt
-        _speed_pid.output_limits = (mmin, mmax)
-        _speed_pid.slowdown_gain = slowdown_gain
-        motor, _dbg = _speed_pid.compute(err, target_speed=speed_target, measured_speed=_last_motor)
+    if cfg.speed_mode == 1:
+        if not cfg.speed_feedback:
+            measured_speed = _last_motor
+        elif measured_speed is None:
+            tel = chassis.latest_telemetry()
+            measured_speed = tel.speed if tel is not None else _last_motor
+        motor, _dbg = _speed_pid.compute(err, target_speed=cfg.speed_target, measured_speed=measured_speed)
     else:
-        motor = base - mk * abs(err)
-        motor = float(clamp(motor, mmin, mmax))
+        motor = cfg.base - cfg.mk * abs(err)
+        motor = float(clamp(motor, cfg.mmin, cfg.mmax))
 
     motor = float(clamp(motor, MIN_DUTY, MAX_DUTY))
     _last_motor = motor
 
-    return motor, servo, scs_mode, headlight, "auto"
+    metrics.observe("control.total", metrics.now() - t0)
+    return motor, servo, cfg.scs_mode, cfg.headlight, "auto"
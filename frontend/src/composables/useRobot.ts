@@ -18,11 +18,16 @@ export function useRobot() {
   const status = ref<RobotStatus>({ ...DEFAULT_STATUS })
   const isConnected = ref(true)
   const params = reactive<RobotParams>({
-    binary_value: 90,
+    binary_value: 60,
     canny_low_threshold: 68,
     hof_threshold: 40,
     hof_min_line_len: 20,
     hof_max_line_gap: 10,
+    fit_nwindows: 6,
+    fit_margin: 40,
+    fit_minpix: 20,
+    vision_scale: 1.0,
+    frame_budget_ms: 0,
     auto_drive: 0,
     steer_mode: 0,
     steer_k: 8,
@@ -42,6 +47,7 @@ export function useRobot() {
     speed_kd: 0.02,
     speed_dt: 0.02,
     speed_slowdown_gain: 0.002,
+    speed_feedback: 0,
     manual_motor: 0,
     manual_servo: 1500,
     scs_mode: 0,
@@ -94,12 +100,42 @@ export function useRobot() {
   }
 
   let timer: number | undefined
+  let source: EventSource | undefined
+
+  const startPolling = () => {
+    if (timer) return
+    timer = window.setInterval(fetchStatus, 220)
+  }
+
+  // 优先用 SSE 推送（首条完整状态，之后只推变化字段），失败时退回轮询
+  const subscribeStatus = () => {
+    if (typeof EventSource === 'undefined') {
+      startPolling()
+      return
+    }
+    source = new EventSource('/api/status/stream?rate=10')
+    source.addEventListener('full', (e) => {
+      status.value = JSON.parse((e as MessageEvent).data)
+      isConnected.value = true
+    })
+    source.addEventListener('delta', (e) => {
+      status.value = { ...status.value, ...JSON.parse((e as MessageEvent).data) }
+      isConnected.value = true
+    })
+    source.onerror = () => {
+      source?.close()
+      source = undefined
+      startPolling()
+    }
+  }
+
   onMounted(async () => {
     await loadParams()
     await fetchStatus()
-    timer = window.setInterval(fetchStatus, 220)
+    subscribeStatus()
   })
   onUnmounted(() => {
+    source?.close()
     if (timer) window.clearInterval(timer)
   })
 
@@ -4,6 +4,11 @@ export interface RobotParams {
   hof_threshold: number;
   hof_min_line_len: number;
   hof_max_line_gap: number;
+  fit_nwindows: number;
+  fit_margin: number;
+  fit_minpix: number;
+  vision_scale: number;
+  frame_budget_ms: number;
 
   auto_drive: number; // 0/1
   steer_mode: number; // 0 kp, 1 lqr
@@ -26,6 +31,7 @@ export interface RobotParams {
   speed_kd: number;
   speed_dt: number;
   speed_slowdown_gain: number;
+  speed_feedback: number; // 0: last output, 1: chassis telemetry
 
   // 手动 & 底盘
   manual_motor: number;
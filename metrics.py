@@ -0,0 +1,99 @@
+"""
+各阶段耗时统计：每个阶段一个固定长度的环形缓冲，记录最近 N 次耗时（秒），
+抓取时计算 p50/p95/p99/max，以 Prometheus 文本格式从 /api/metrics 输出。
+
+    t0 = metrics.now()
+    ...
+    metrics.observe("vision.fit", metrics.now() - t0)
+
+设置环境变量 LKS_METRICS=0 可关闭，此时 observe 直接返回。
+"""
+import os
+import threading
+import time
+from typing import Dict, List
+
+RING_SIZE = 1024
+QUANTILES = (0.5, 0.95, 0.99)
+
+enabled = os.environ.get("LKS_METRICS", "1") != "0"
+
+# 单调时钟
+now = time.perf_counter
+
+
+class LatencyRing:
+    """定长环形缓冲；写入只有下标自增和一次列表赋值，不加锁。"""
+
+    def __init__(self, size: int = RING_SIZE):
+        self._buf: List[float] = [0.0] * size
+        self._size = size
+        self._next = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        i = self._next
+        self._buf[i] = seconds
+        self._next = i + 1 if i + 1 < self._size else 0
+        self.count += 1
+        self.total += seconds
+
+    def snapshot(self) -> List[float]:
+        n = min(self.count, self._size)
+        return sorted(self._buf[:n]) if n < self._size else sorted(self._buf)
+
+
+_rings: Dict[str, LatencyRing] = {}
+_rings_lock = threading.Lock()
+
+
+def observe(stage: str, seconds: float):
+    if not enabled:
+        return
+    ring = _rings.get(stage)
+    if ring is None:
+        with _rings_lock:
+            ring = _rings.setdefault(stage, LatencyRing())
+    ring.add(seconds)
+
+
+def _quantile(sorted_vals: List[float], q: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    idx = min(len(sorted_vals) - 1, int(q * len(sorted_vals)))
+    return sorted_vals[idx]
+
+
+def summary() -> Dict[str, Dict[str, float]]:
+    """每个阶段最近窗口内的分位数（秒），以及累计次数/总耗时。"""
+    out = {}
+    for stage, ring in sorted(_rings.items()):
+        vals = ring.snapshot()
+        item = {f"p{int(q * 100)}": _quantile(vals, q) for q in QUANTILES}
+        item["max"] = vals[-1] if vals else 0.0
+        item["count"] = ring.count
+        item["sum"] = ring.total
+        out[stage] = item
+    return out
+
+
+def render_prometheus(extra: Dict[str, Dict[str, float]] = None) -> str:
+    """extra 为其他进程的 summary()（如实时进程），与本进程的阶段合并输出，同名阶段以本进程为准。"""
+    stages = dict(extra or {})
+    stages.update(summary())
+    lines = [
+        "# HELP lks_stage_latency_seconds Per-stage latency over the most recent samples.",
+        "# TYPE lks_stage_latency_seconds summary",
+    ]
+    max_lines = [
+        "# HELP lks_stage_latency_max_seconds Max latency over the most recent samples.",
+        "# TYPE lks_stage_latency_max_seconds gauge",
+    ]
+    for stage, item in sorted(stages.items()):
+        for q in QUANTILES:
+            lines.append(f'lks_stage_latency_seconds{{stage="{stage}",quantile="{q}"}} {item[f"p{int(q * 100)}"]:.9f}')
+        lines.append(f'lks_stage_latency_seconds_sum{{stage="{stage}"}} {item["sum"]:.9f}')
+        lines.append(f'lks_stage_latency_seconds_count{{stage="{stage}"}} {item["count"]}')
+        max_lines.append(f'lks_stage_latency_max_seconds{{stage="{stage}"}} {item["max"]:.9f}')
+    return "\n".join(lines + max_lines) + "\n"
@@ -0,0 +1,336 @@
+"""
+帧录制与离线回放。
+
+录制：`FrameRecorder.record()` 只把帧和输出放进有界队列（满了就丢并计数），
+后台线程负责编码和写盘。每次录制是 recordings/ 下的一个目录：
+- chunk_00000.bin ...：帧数据首尾相接（JPEG 或原始 BGR），每 chunk_frames 帧换一个文件；
+  MJPEG 直通采到的帧不论哪种格式都原样保存摄像头的 JPEG（fmt 记为 mjpeg），回放时同样按直通帧处理
+- index.jsonl：每帧一行，记录所在 chunk/偏移/长度、参数版本和当时的 err/舵机/电机输出和底盘实测速度，
+  以及本帧开始处理前的视觉跟踪状态（vision：预算调档档位、处理比例、上一帧拟合、误差滤波值）
+- params.jsonl：参数变化时追加一行 {"version", "params"}
+
+回放：`python recorder.py recordings/<目录>` 把录下的帧按原参数依次送进
+vision.process_image 和 control.compute_control（默认不等待，尽快跑完），
+输出与录制时的差异统计。第一帧前、以及录制时跳过了中间视觉结果的地方恢复录制时的视觉跟踪状态，
+其余帧只固定为录制时的预算调档档位，
+所以从运行中途开始的录制、frame_budget_ms>0 时的录制也能逐帧复现（速度 PID 的积分仍从零开始）。
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from sources import JpegFrame
+
+ROOT = Path(__file__).resolve().parent
+RECORD_DIR = ROOT / "recordings"
+
+FORMATS = ("jpeg", "raw")
+
+
+class FrameRecorder:
+    def __init__(self, root: Path = RECORD_DIR, chunk_frames: int = 300, queue_size: int = 64,
+                 jpeg_quality: int = 95):
+        self.root = Path(root)
+        self.chunk_frames = chunk_frames
+        self.jpeg_quality = jpeg_quality
+        self.fmt = "jpeg"
+        self.path: Optional[Path] = None
+        self.frames = 0
+        self.last_error = ""
+        # 丢帧分两处计数，各自只由一个线程写：队列满（采集线程）和编码/写盘失败（写线程）
+        self._queue_dropped = 0
+        self._write_dropped = 0
+
+        self._queue_size = queue_size
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._active = False
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    @property
+    def dropped(self) -> int:
+        return self._queue_dropped + self._write_dropped
+
+    def start(self, fmt: str = "jpeg") -> Path:
+        if self._active:
+            return self.path
+        if fmt not in FORMATS:
+            raise ValueError(f"unknown record format: {fmt}")
+        # 上一次录制的写线程还在收尾时先等它写完，避免两个写线程同时改 frames/dropped
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.fmt = fmt
+        self.path = self._new_dir()
+        self.frames = 0
+        self._queue_dropped = 0
+        self._write_dropped = 0
+        self.last_error = ""
+        # 每次录制用新队列：stop() 之后才放进旧队列的帧不会混进下一段录制
+        self._queue = queue.Queue(maxsize=self._queue_size)
+        self._active = True
+        self._thread = threading.Thread(target=self._writer, args=(self.path, fmt, self._queue), daemon=True)
+        self._thread.start()
+        return self.path
+
+    def _new_dir(self) -> Path:
+        # 目录名精确到秒，同一秒内重新开始录制时加序号，不覆盖上一段
+        base = time.strftime("%Y%m%d-%H%M%S")
+        self.root.mkdir(parents=True, exist_ok=True)
+        n = 0
+        while True:
+            path = self.root / (base if n == 0 else f"{base}-{n}")
+            try:
+                path.mkdir()
+                return path
+            except FileExistsError:
+                n += 1
+
+    def stop(self):
+        if not self._active:
+            return
+        self._active = False
+        # 结束标记必须送到，队列满时等写线程腾位置
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join(timeout=5.0)
+            # 写线程仍在写盘时保留句柄，下次 start() 会等它结束
+            if not self._thread.is_alive():
+                self._thread = None
+
+    def record(self, t: float, frame: np.ndarray, params: Mapping[str, Any], outputs: Dict[str, Any]) -> bool:
+        """热路径调用：不阻塞，队列满时丢弃本帧。"""
+        q = self._queue
+        if not self._active:
+            return False
+        try:
+            q.put_nowait((t, frame, params, outputs))
+            return True
+        except queue.Full:
+            self._queue_dropped += 1
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "recording": self._active,
+            "record_frames": self.frames,
+            "record_dropped": self.dropped,
+            "record_path": str(self.path) if self.path else "",
+        }
+
+    def _writer(self, path: Path, fmt: str, q: "queue.Queue"):
+        index = open(path / "index.jsonl", "w", encoding="utf-8", buffering=1)
+        params_log = open(path / "params.jsonl", "w", encoding="utf-8", buffering=1)
+        chunk = None
+        chunk_id = -1
+        offset = 0
+        version = 0
+        last_params = None
+        try:
+            while True:
+                item = q.get()
+                if item is None:
+                    break
+                t, frame, p, outputs = item
+                try:
+                    # 参数快照不可变，同一对象必然相同，只有换了对象才需要比较内容
+                    if p is not last_params and p != last_params:
+                        version += 1
+                        params_log.write(json.dumps({"version": version, "params": dict(p)},
+                                                    ensure_ascii=False) + "\n")
+                    last_params = p
+
+                    frame_fmt = fmt
+                    if isinstance(frame, JpegFrame):
+                        data = frame.data
+                        frame_fmt = "mjpeg"
+                    elif fmt == "jpeg":
+                        ok, buf = cv.imencode(".jpg", frame, [int(cv.IMWRITE_JPEG_QUALITY), self.jpeg_quality])
+                        if not ok:
+                            self._write_dropped += 1
+                            continue
+                        data = buf.tobytes()
+                    else:
+                        data = np.ascontiguousarray(frame).tobytes()
+
+                    if chunk is None or self.frames % self.chunk_frames == 0:
+                        if chunk is not None:
+                            chunk.close()
+                        chunk_id += 1
+                        chunk = open(path / f"chunk_{chunk_id:05d}.bin", "wb")
+                        offset = 0
+                    chunk.write(data)
+
+                    entry = {
+                        "i": self.frames,
+                        "t": t,
+                        "chunk": chunk_id,
+                        "offset": offset,
+                        "size": len(data),
+                        "fmt": frame_fmt,
+                        "shape": list(frame.shape),
+                        "param_version": version,
+                    }
+                    entry.update(outputs)
+                    index.write(json.dumps(entry) + "\n")
+                    offset += len(data)
+                    self.frames += 1
+                except Exception as e:
+                    self.last_error = str(e)
+                    self._write_dropped += 1
+        finally:
+            if chunk is not None:
+                chunk.close()
+            index.close()
+            params_log.close()
+
+
+# 全局单例（由采集循环写入）
+recorder = FrameRecorder()
+
+
+# ==============================================================================
+# 回放
+# ==============================================================================
+
+def load_recording(path: Path) -> Tuple[List[Dict[str, Any]], Dict[int, Dict[str, Any]]]:
+    path = Path(path)
+    entries = []
+    with open(path / "index.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    versions: Dict[int, Dict[str, Any]] = {}
+    with open(path / "params.jsonl", "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                rec = json.loads(line)
+                versions[int(rec["version"])] = rec["params"]
+    return entries, versions
+
+
+def iter_frames(path: Path) -> Iterator[Tuple[Dict[str, Any], np.ndarray, Dict[str, Any]]]:
+    """依次产出 (index 条目, 帧, 当时的参数)；帧为 BGR，直通录制的为 JpegFrame。"""
+    path = Path(path)
+    entries, versions = load_recording(path)
+    chunk = None
+    chunk_id = -1
+    try:
+        for entry in entries:
+            if entry["chunk"] != chunk_id:
+                if chunk is not None:
+                    chunk.close()
+                chunk_id = entry["chunk"]
+                chunk = open(path / f"chunk_{chunk_id:05d}.bin", "rb")
+            chunk.seek(entry["offset"])
+            data = chunk.read(entry["size"])
+            if entry["fmt"] == "mjpeg":
+                frame = JpegFrame(data, entry["shape"][1], entry["shape"][0])
+            elif entry["fmt"] == "jpeg":
+                frame = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_COLOR)
+            else:
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(entry["shape"])
+            yield entry, frame, versions.get(entry["param_version"], {})
+    finally:
+        if chunk is not None:
+            chunk.close()
+
+
+def replay(path: Path, realtime: bool = False, out: Optional[Path] = None) -> Dict[str, Any]:
+    """把录制送回视觉 + 控制，返回与录制输出的差异统计。"""
+    import control
+    import vision
+
+    vision.reset_vision_state(background_rebuild=False)
+    control.reset_control_state()
+
+    outf = open(out, "w", encoding="utf-8") if out else None
+    err_diffs = []
+    servo_diffs = []
+    motor_diffs = []
+    frames = 0
+    first_t = None
+    last_t = None
+    prev_frame = None
+    start = time.perf_counter()
+    try:
+        for entry, frame, p in iter_frames(path):
+            vstate = entry.get("vision")
+            if vstate:
+                if prev_frame is None or vstate["frame"] != prev_frame + 1:
+                    # 第一帧，或录制时执行线程跳过了中间的视觉结果：整体恢复跟踪状态
+                    vision.restore_vision_state(vstate)
+                else:
+                    # 预算调档按实测耗时换档，回放机器上的耗时不同：档位照录制时的来
+                    vision.restore_vision_state({"level": vstate["level"]})
+                prev_frame = vstate["frame"]
+            if first_t is None:
+                first_t = entry["t"]
+            last_t = entry["t"]
+            if realtime:
+                delay = (entry["t"] - first_t) - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            snap = control.current_params()
+            if snap.values != p:
+                with control.lock:
+                    control.params.clear()
+                    control.params.update(p)
+                    snap = control.publish_params()
+            _imgs, err, _overlay = vision.process_image(frame, snap.values)
+            # 录制时的实测速度一并送回，PID 模式下才能复现
+            motor, servo, _scs_mode, _headlight, mode = control.compute_control(err, snap, entry.get("speed"))
+
+            err_diffs.append(abs(err - entry.get("err", err)))
+            servo_diffs.append(abs(servo - entry.get("servo", servo)))
+            motor_diffs.append(abs(motor - entry.get("motor", motor)))
+            frames += 1
+            if outf:
+                outf.write(json.dumps({"i": entry["i"], "err": err, "servo": servo,
+                                       "motor": motor, "mode": mode}) + "\n")
+    finally:
+        if outf:
+            outf.close()
+
+    elapsed = time.perf_counter() - start
+    duration = (last_t - first_t) if frames > 1 else 0.0
+    report = {
+        "frames": frames,
+        "elapsed_s": elapsed,
+        "fps": frames / elapsed if elapsed > 0 else 0.0,
+        "speedup": duration / elapsed if elapsed > 0 else 0.0,
+        "err_max_diff": max(err_diffs, default=0.0),
+        "err_mean_diff": float(np.mean(err_diffs)) if err_diffs else 0.0,
+        "servo_max_diff": max(servo_diffs, default=0),
+        "motor_max_diff": max(motor_diffs, default=0.0),
+        "frames_changed": int(sum(1 for e, s, m in zip(err_diffs, servo_diffs, motor_diffs)
+                                  if e > 1e-6 or s > 0 or m > 1e-9)),
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="回放录制的帧，复现视觉/控制输出并与录制时比较")
+    parser.add_argument("path", help="录制目录，例如 recordings/20250101-120000")
+    parser.add_argument("--realtime", action="store_true", help="按录制时的时间间隔回放")
+    parser.add_argument("--out", help="逐帧输出写入该 jsonl 文件")
+    args = parser.parse_args()
+    report = replay(Path(args.path), realtime=args.realtime, out=Path(args.out) if args.out else None)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
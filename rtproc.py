@@ -0,0 +1,454 @@
+"""
+实时进程：采集 / 视觉 / 控制 / 底盘放到独立进程里跑，Web 服务的编码、JSON 和连接处理不再和它们抢 GIL。
+
+    RT_PROCESS=1 python3 app.py
+
+实时进程把每帧的画面、状态和覆盖数据写进 multiprocessing.shared_memory 里的环形缓冲。
+普通的内存写不保证另一个进程看到的顺序（ARM 上读方可能先看到序号、后看到数据），所以每个槽位配一把
+multiprocessing.Lock，加解锁自带内存屏障：写方不等待地拿锁，拿不到（Web 进程正在拷贝这一槽）就跳过本帧，
+实时进程从不等 Web 进程；读方持锁拷贝。槽位里的序号标明存的是哪一帧，每段数据另存长度和 CRC32，
+长度或校验对不上的帧直接丢弃，不会解出撕裂的画面。环头记录最新一帧的序号，
+以及 Web 进程写入的“当前有人看的画面”位掩码。
+
+Web 进程只读共享内存：后台线程轮询最新序号，把状态转存到 latest_status / latest_overlay，
+画面交给 stream 的编码缓存；参数更新、视觉重置和录制开关经 multiprocessing 队列下发。
+Web 进程退出或被杀掉后，实时进程发现父进程不在了会先停车再退出。
+"""
+import atexit
+import json
+import multiprocessing as mp
+import os
+import queue
+import struct
+import threading
+import time
+import traceback
+import zlib
+from multiprocessing import shared_memory
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from sources import JpegFrame
+from stream import STREAM_NAMES
+
+RING_SLOTS = 4
+# 单帧状态 JSON（含覆盖数据）的上限
+STATUS_BYTES = 64 * 1024
+# Web 进程轮询最新序号的间隔（秒）
+POLL_INTERVAL = 0.003
+# 实时进程随状态附带一次各阶段耗时统计的间隔（秒）
+METRICS_INTERVAL = 1.0
+# 父进程消失后，停车指令生效前等待的时间（秒）
+STOP_GRACE = 0.2
+
+# 环头：最新一帧序号、订阅画面位掩码、实时进程 pid
+_LATEST = struct.Struct("<Q")
+_MASK = struct.Struct("<I")
+_PID = struct.Struct("<I")
+_HEAD_BYTES = 64
+
+# Web 进程拷贝一个槽位时等待写方写完的最长时间（秒）
+READ_LOCK_TIMEOUT = 0.1
+
+# 槽位：帧序号、状态 JSON 的 (长度, CRC32)，以及每路画面的 (高, 宽, 通道, 字节数, CRC32)；
+# 高为 0 表示本帧没有这路，通道为 0 表示存的是 MJPEG 直通的 JPEG 数据
+_SEQ = struct.Struct("<Q")
+_LEN = struct.Struct("<II")
+_SHAPE = struct.Struct("<HHBII")
+
+
+def _align(n: int, to: int = 64) -> int:
+    return (n + to - 1) // to * to
+
+
+class FrameRing:
+    """共享内存环形缓冲。name 为空时新建（由创建方负责 unlink）并创建每个槽位的锁，
+    否则按名字映射已有的块，locks 传创建方的 ring.locks（随 Process 参数传给子进程）。
+
+    每路画面按 width x height x 3 预留空间，超出的画面不写入。只允许一个写入方。
+    """
+
+    def __init__(self, width: int, height: int, slots: int = RING_SLOTS, name: str = None, locks=None):
+        self.width = width
+        self.height = height
+        self.slots = slots
+        self.image_bytes = width * height * 3
+        self._shape_off = _SEQ.size + _LEN.size
+        self._status_off = self._shape_off + _SHAPE.size * len(STREAM_NAMES)
+        self._image_off = _align(self._status_off + STATUS_BYTES)
+        self.slot_bytes = _align(self._image_off + self.image_bytes * len(STREAM_NAMES))
+        size = _HEAD_BYTES + self.slot_bytes * slots
+
+        self.owner = name is None
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:_HEAD_BYTES] = bytes(_HEAD_BYTES)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.locks = locks if locks is not None else [mp.get_context("spawn").Lock() for _ in range(slots)]
+        # 写方因读方占着槽位而跳过的帧数；读方因长度 / 校验不符丢弃的帧数
+        self.skipped = 0
+        self.corrupt = 0
+        self._seq = self.latest()
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    # ---- 环头 ----
+
+    def latest(self) -> int:
+        return _LATEST.unpack_from(self.buf, 0)[0]
+
+    def stream_mask(self) -> int:
+        return _MASK.unpack_from(self.buf, _LATEST.size)[0]
+
+    def set_stream_mask(self, mask: int):
+        _MASK.pack_into(self.buf, _LATEST.size, mask)
+
+    def writer_pid(self) -> int:
+        return _PID.unpack_from(self.buf, _LATEST.size + _MASK.size)[0]
+
+    def set_writer_pid(self, pid: int):
+        _PID.pack_into(self.buf, _LATEST.size + _MASK.size, pid)
+
+    # ---- 槽位 ----
+
+    def _slot(self, seq: int) -> int:
+        return _HEAD_BYTES + (seq % self.slots) * self.slot_bytes
+
+    def _image(self, off: int, i: int, shape: Tuple[int, ...]) -> np.ndarray:
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.buf, offset=off + self._image_off + i * self.image_bytes)
+
+    def write(self, imgs: Mapping[str, np.ndarray], status: bytes) -> bool:
+        """写入下一帧并把它登记为最新；status 超过 STATUS_BYTES 时本帧不带状态。
+
+        读方正占着下一个槽位时不等待，跳过本帧并返回 False。
+        """
+        buf = self.buf
+        seq = self._seq + 1
+        lock = self.locks[seq % self.slots]
+        if not lock.acquire(block=False):
+            self.skipped += 1
+            return False
+        try:
+            off = self._slot(seq)
+            for i, name in enumerate(STREAM_NAMES):
+                img = imgs.get(name)
+                shape_off = off + self._shape_off + i * _SHAPE.size
+                start = off + self._image_off + i * self.image_bytes
+                if isinstance(img, JpegFrame) and len(img.data) <= self.image_bytes:
+                    n = len(img.data)
+                    buf[start:start + n] = img.data
+                    _SHAPE.pack_into(buf, shape_off, img.height, img.width, 0, n, zlib.crc32(buf[start:start + n]))
+                    continue
+                if not isinstance(img, np.ndarray) or img.dtype != np.uint8 or img.nbytes > self.image_bytes:
+                    _SHAPE.pack_into(buf, shape_off, 0, 0, 0, 0, 0)
+                    continue
+                h, w = img.shape[:2]
+                c = img.shape[2] if img.ndim == 3 else 1
+                self._image(off, i, img.shape)[...] = img
+                _SHAPE.pack_into(buf, shape_off, h, w, c, img.nbytes, zlib.crc32(buf[start:start + img.nbytes]))
+
+            if len(status) > STATUS_BYTES:
+                status = b""
+            _LEN.pack_into(buf, off + _SEQ.size, len(status), zlib.crc32(status))
+            buf[off + self._status_off:off + self._status_off + len(status)] = status
+            _SEQ.pack_into(buf, off, seq)
+        finally:
+            lock.release()
+        # 槽位锁释放之后才登记：读方看到新序号时，拿锁就一定能看到完整的数据
+        _LATEST.pack_into(buf, 0, seq)
+        self._seq = seq
+        return True
+
+    def read(self, seq: int) -> Optional[Tuple[Dict[str, np.ndarray], bytes]]:
+        """拷贝第 seq 帧；该槽位已被更新的帧覆盖、一直被占着或数据校验不符时返回 None。"""
+        lock = self.locks[seq % self.slots]
+        if not lock.acquire(timeout=READ_LOCK_TIMEOUT):
+            return None
+        try:
+            return self._read_locked(seq)
+        finally:
+            lock.release()
+
+    def _read_locked(self, seq: int) -> Optional[Tuple[Dict[str, np.ndarray], bytes]]:
+        buf = self.buf
+        off = self._slot(seq)
+        if _SEQ.unpack_from(buf, off)[0] != seq:
+            return None
+
+        imgs: Dict[str, np.ndarray] = {}
+        for i, name in enumerate(STREAM_NAMES):
+            h, w, c, nbytes, crc = _SHAPE.unpack_from(buf, off + self._shape_off + i * _SHAPE.size)
+            if not h:
+                continue
+            start = off + self._image_off + i * self.image_bytes
+            if nbytes > self.image_bytes or (c and nbytes != h * w * c):
+                self.corrupt += 1
+                return None
+            if c == 0:
+                img = JpegFrame(bytes(buf[start:start + nbytes]), w, h)
+                data = img.data
+            else:
+                img = self._image(off, i, (h, w, c) if c > 1 else (h, w)).copy()
+                data = img
+            if zlib.crc32(data) != crc:
+                self.corrupt += 1
+                return None
+            imgs[name] = img
+        n, crc = _LEN.unpack_from(buf, off + _SEQ.size)
+        if n > STATUS_BYTES:
+            self.corrupt += 1
+            return None
+        status = bytes(buf[off + self._status_off:off + self._status_off + n])
+        if zlib.crc32(status) != crc:
+            self.corrupt += 1
+            return None
+        return imgs, status
+
+
+def _mask_of(names) -> int:
+    return sum(1 << i for i, name in enumerate(STREAM_NAMES) if name in names)
+
+
+# ==============================================================================
+# 实时进程一侧
+# ==============================================================================
+
+class _RingPublisher:
+    """camera_loop 的发布方：每帧把画面和完整状态写进环形缓冲，订阅集合从环头读。"""
+
+    def __init__(self, ring: FrameRing):
+        self.ring = ring
+        self._mask = -1
+        self._active = frozenset()
+        self._metrics_t = 0.0
+
+    def active_streams(self):
+        mask = self.ring.stream_mask()
+        if mask != self._mask:
+            self._mask = mask
+            self._active = frozenset(name for i, name in enumerate(STREAM_NAMES) if mask >> i & 1)
+        return self._active
+
+    def wants_status(self) -> bool:
+        # Web 进程的 /api/status 也靠它更新，每帧都要
+        return True
+
+    def publish(self, imgs, status):
+        now = metrics.now()
+        if now - self._metrics_t >= METRICS_INTERVAL:
+            status["_metrics"] = metrics.summary()
+            self._metrics_t = now
+        status["ring_skipped"] = self.ring.skipped
+        t0 = metrics.now()
+        self.ring.write(imgs, json.dumps(status, ensure_ascii=False).encode("utf-8"))
+        metrics.observe("rt.publish", metrics.now() - t0)
+
+
+def _stop_and_exit():
+    """切到手动零速，等执行线程把停车指令发出去，关串口后退出。"""
+    from chassis import CENTER_POSITION, chassis
+    from control import lock, params, publish_params
+
+    with lock:
+        params["auto_drive"] = 0
+        params["manual_motor"] = 0.0
+        params["manual_servo"] = CENTER_POSITION
+        publish_params()
+    time.sleep(STOP_GRACE)
+    chassis.close()
+    os._exit(0)
+
+
+def _command_loop(commands, parent_pid: int):
+    import vision
+    from control import lock, params, publish_params
+    from recorder import recorder
+
+    while True:
+        try:
+            kind, arg = commands.get(timeout=0.5)
+        except queue.Empty:
+            if os.getppid() != parent_pid:
+                _stop_and_exit()
+            continue
+        except (EOFError, OSError):
+            _stop_and_exit()
+
+        try:
+            if kind == "params":
+                with lock:
+                    params.clear()
+                    params.update(arg)
+                    publish_params()
+            elif kind == "vision_reset":
+                vision.reset_vision_state()
+            elif kind == "record":
+                if arg:
+                    recorder.start(arg)
+                else:
+                    recorder.stop()
+            elif kind == "stop":
+                recorder.stop()
+                _stop_and_exit()
+        except Exception:
+            traceback.print_exc()
+
+
+def _rt_main(ring_name: str, width: int, height: int, slots: int, commands, parent_pid: int, locks):
+    from camera import camera_loop
+    from sources import make_source
+
+    ring = FrameRing(width, height, slots, name=ring_name, locks=locks)
+    ring.set_writer_pid(os.getpid())
+    threading.Thread(target=_command_loop, args=(commands, parent_pid), daemon=True).start()
+
+    source = make_source(width=width, height=height)
+    camera_loop(width=width, height=height, source=source, publisher=_RingPublisher(ring))
+
+
+# ==============================================================================
+# Web 进程一侧
+# ==============================================================================
+
+class RealtimeClient:
+    """Web 进程里的实时进程句柄：启动/停止子进程、下发指令，并把共享内存里的最新帧转存到本进程。"""
+
+    def __init__(self):
+        self.active = False
+        self.process: Optional[mp.Process] = None
+        self.ring: Optional[FrameRing] = None
+        self.frames = 0
+        # 读线程处理单帧出错（跳过该帧继续）的次数
+        self.read_errors = 0
+        # 实时进程最近一次带回来的各阶段耗时统计
+        self.metrics: Dict[str, Dict[str, float]] = {}
+        self._commands = None
+        self._reader: Optional[threading.Thread] = None
+
+    def start(self, width: int = None, height: int = None, slots: int = RING_SLOTS):
+        """width/height 缺省取 FRAME_SIZE 环境变量；帧源按 FRAME_SOURCE / FRAME_PACING 在子进程里构造。"""
+        from control import current_params
+        from sources import parse_size
+
+        if self.active:
+            return
+        if width is None or height is None:
+            width, height = parse_size(os.environ.get("FRAME_SIZE", ""))
+
+        # spawn：子进程是干净的解释器，不继承 Flask 和其他线程
+        ctx = mp.get_context("spawn")
+        self.ring = FrameRing(width, height, slots)
+        self._commands = ctx.Queue()
+        self.process = ctx.Process(target=_rt_main, name="lks-realtime", daemon=True,
+                                   args=(self.ring.name, width, height, slots, self._commands, os.getpid(),
+                                         self.ring.locks))
+        self.process.start()
+        self.active = True
+        self.send_params(current_params().values)
+
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self._commands.put(("stop", None))
+        self.process.join(timeout=1.0 + STOP_GRACE)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout=1.0)
+        if self._reader:
+            self._reader.join(timeout=1.0)
+        self.ring.close()
+
+    def send_params(self, values: Mapping[str, Any]):
+        if self.active:
+            self._commands.put(("params", dict(values)))
+
+    def reset_vision(self):
+        if self.active:
+            self._commands.put(("vision_reset", None))
+
+    def record(self, fmt: str = None):
+        """fmt 为录制格式时开始录制，为 None 时停止。"""
+        if self.active:
+            self._commands.put(("record", fmt))
+
+    def _read_loop(self):
+        from control import latest_frames, latest_overlay, latest_status, lock
+        from stream import active_streams, publish_frames, publish_status, status_wanted
+
+        ring = self.ring
+        seq = ring.latest()
+        mask = -1
+        next_check = 0.0
+        while self.active:
+            try:
+                wanted = _mask_of(active_streams())
+                if wanted != mask:
+                    ring.set_stream_mask(wanted)
+                    mask = wanted
+
+                now = time.monotonic()
+                if now >= next_check:
+                    next_check = now + 1.0
+                    if not self.process.is_alive():
+                        with lock:
+                            latest_status["running"] = False
+                            latest_status["camera_connected"] = False
+                            latest_status["camera_error"] = f"realtime process exited ({self.process.exitcode})"
+
+                latest = ring.latest()
+                if latest == seq:
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                item = ring.read(latest)
+                if item is None:
+                    # 槽位正被覆盖，下一轮直接读更新的那帧
+                    continue
+                seq = latest
+                self.frames += 1
+                imgs, raw = item
+
+                status = json.loads(raw) if raw else {}
+                overlay = status.pop("overlay", None)
+                remote = status.pop("_metrics", None)
+                if remote is not None:
+                    self.metrics = remote
+                snapshot = None
+                with lock:
+                    latest_status.update(status)
+                    latest_status["realtime_corrupt_frames"] = ring.corrupt
+                    if overlay:
+                        latest_overlay.update(overlay)
+                    latest_frames.update(imgs)
+                    if status_wanted():
+                        snapshot = dict(latest_status)
+                        snapshot["overlay"] = dict(latest_overlay)
+                if snapshot is not None:
+                    publish_status(snapshot)
+                publish_frames(imgs)
+            except Exception as e:
+                # 单帧出错（状态 JSON、发布等）不能让读线程退出，否则网页状态和画面会冻结而车还在跑
+                self.read_errors += 1
+                with lock:
+                    latest_status["camera_error"] = f"realtime reader: {e}"
+                    latest_status["realtime_read_errors"] = self.read_errors
+                time.sleep(POLL_INTERVAL)
+
+
+realtime = RealtimeClient()
@@ -0,0 +1,296 @@
+"""
+闭环仿真：运动学自行车模型 + 赛道俯视图渲染，直接驱动真实的 vision.process_image 和
+control.compute_control，按仿真时间步进（不等待），比实时快得多。
+
+    python3 sim.py                                              # 默认参数跑一圈
+    python3 sim.py --set steer_k=6,8,10 --set motor_base=0.08,0.1 --workers 8 --out sweep.json
+    python3 sim.py --set steer_mode=1 --set lqr_q1=2,5,10 --set lqr_r=0.4,0.8
+
+赛道是一个椭圆环（两段直道 + 两段半圆），先在世界坐标下画成一张俯视大图；每一步由车辆位姿
+拼出 “俯视大图 -> 鸟瞰图 -> 相机图像” 的单应矩阵，一次 warpPerspective 得到相机画面，
+与 vision 的默认鸟瞰标定一致。--set 给出的参数做网格组合，用进程池并行，每个组合输出
+单圈时间、最大横向误差（米）和控制量（舵机变化）。
+"""
+import argparse
+import json
+import math
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from calibration import default_src_points, dst_points
+from chassis import CENTER_POSITION, MAX_POSITION
+from synthetic import FLOOR_COLOR, LINE_COLOR, WALL_COLOR
+
+# 赛道（米）
+STRAIGHT = 3.0
+RADIUS = 2.5
+LANE_WIDTH = 0.45
+LINE_WIDTH = 0.02
+MAP_MARGIN = 0.8
+
+# 车辆
+WHEELBASE = 0.26
+MAX_STEER = math.radians(28)       # 舵机打满（MAX_POSITION）时的前轮转角
+SPEED_PER_DUTY = 10.0              # 占空比 -> 稳态车速（m/s）
+SPEED_TAU = 0.3                    # 车速跟随的时间常数（秒）
+CAMERA_SETBACK = 0.12              # 鸟瞰图底边到后轴的距离（米）
+
+# 图像
+W, H = 320, 240
+FPS = 30.0
+
+
+def _bird_scale(w: int) -> float:
+    """鸟瞰图每米的像素数：两条车道线在鸟瞰图里相距 0.6w（dst_points 的 0.2w~0.8w）。"""
+    return 0.6 * w / LANE_WIDTH
+
+
+class Track:
+    """椭圆环赛道的中心线（逆时针），以及按鸟瞰分辨率画好的俯视大图。"""
+
+    def __init__(self, scale: float, step: float = 0.01):
+        self.scale = scale
+        pts = []
+        # 下直道 -> 右半圆 -> 上直道 -> 左半圆，起点在下直道中点
+        n_s = int(STRAIGHT / step)
+        n_c = int(math.pi * RADIUS / step)
+        for i in range(n_s // 2, n_s):
+            pts.append((-STRAIGHT / 2 + i * step, -RADIUS))
+        for i in range(n_c):
+            a = -math.pi / 2 + math.pi * i / n_c
+            pts.append((STRAIGHT / 2 + RADIUS * math.cos(a), RADIUS * math.sin(a)))
+        for i in range(n_s):
+            pts.append((STRAIGHT / 2 - i * step, RADIUS))
+        for i in range(n_c):
+            a = math.pi / 2 + math.pi * i / n_c
+            pts.append((-STRAIGHT / 2 + RADIUS * math.cos(a), RADIUS * math.sin(a)))
+        for i in range(0, n_s // 2):
+            pts.append((-STRAIGHT / 2 + i * step, -RADIUS))
+        self.center = np.array(pts, dtype=np.float64)
+        seg = np.diff(np.vstack([self.center, self.center[:1]]), axis=0)
+        self.seg_len = np.hypot(seg[:, 0], seg[:, 1])
+        self.length = float(self.seg_len.sum())
+        self.s = np.concatenate([[0.0], np.cumsum(self.seg_len)[:-1]])
+        self.tangent = seg / self.seg_len[:, None]
+
+        self.x_min = -STRAIGHT / 2 - RADIUS - MAP_MARGIN
+        self.y_max = RADIUS + MAP_MARGIN
+        mw = int((STRAIGHT + 2 * RADIUS + 2 * MAP_MARGIN) * scale)
+        mh = int((2 * RADIUS + 2 * MAP_MARGIN) * scale)
+        self.image = np.full((mh, mw, 3), FLOOR_COLOR, dtype=np.uint8)
+        normal = np.stack([-self.tangent[:, 1], self.tangent[:, 0]], axis=1)
+        thick = max(1, int(round(LINE_WIDTH * scale)))
+        for side in (-1, 1):
+            line = self.center + side * (LANE_WIDTH / 2) * normal
+            px = self.world_to_map(line).astype(np.int32)
+            cv.polylines(self.image, [px], True, LINE_COLOR, thick, cv.LINE_AA)
+
+    def world_to_map(self, xy: np.ndarray) -> np.ndarray:
+        return np.stack([(xy[:, 0] - self.x_min) * self.scale, (self.y_max - xy[:, 1]) * self.scale], axis=1)
+
+    def map_from_world(self) -> np.ndarray:
+        """世界坐标（米）-> 俯视大图像素的仿射矩阵。"""
+        return np.array([[self.scale, 0, -self.x_min * self.scale],
+                         [0, -self.scale, self.y_max * self.scale],
+                         [0, 0, 1]], dtype=np.float64)
+
+    def locate(self, x: float, y: float, hint: int, window: int = 60) -> Tuple[int, float]:
+        """在 hint 附近找最近的中心线点，返回 (下标, 有符号横向误差：左正)。"""
+        n = len(self.center)
+        idx = (np.arange(hint - window, hint + window) % n)
+        d = self.center[idx] - (x, y)
+        k = int(idx[np.argmin(d[:, 0] ** 2 + d[:, 1] ** 2)])
+        t = self.tangent[k]
+        rx, ry = x - self.center[k, 0], y - self.center[k, 1]
+        return k, float(t[0] * ry - t[1] * rx)
+
+
+class Camera:
+    """由车辆位姿拼出俯视大图 -> 相机图像的单应矩阵并渲染。"""
+
+    def __init__(self, track: Track, w: int = W, h: int = H):
+        self.track = track
+        self.w = w
+        self.h = h
+        self.scale = _bird_scale(w)
+        # 鸟瞰 -> 相机图像
+        self.cam_from_bird = cv.getPerspectiveTransform(dst_points(w, h), default_src_points(w, h))
+        # 地平线以上（齐次坐标分母 <= 0）的行映射到车后方，渲染后涂成墙色
+        bird_from_cam = np.linalg.inv(self.cam_from_bird)
+        ys, xs = np.mgrid[0:h, 0:w]
+        denom = bird_from_cam[2, 0] * xs + bird_from_cam[2, 1] * ys + bird_from_cam[2, 2]
+        bad_rows = np.flatnonzero((denom <= 1e-6).any(axis=1))
+        self.sky_rows = int(bad_rows.max()) + 1 if bad_rows.size else 0
+
+    def render(self, x: float, y: float, theta: float) -> np.ndarray:
+        w, h, s = self.w, self.h, self.scale
+        c, si = math.cos(theta), math.sin(theta)
+        # 鸟瞰像素 (u, v) -> 车体坐标：前 f = (h + setback - v)/s，左 l = (w/2 - u)/s
+        # -> 世界坐标：(x, y) + f * (c, si) + l * (-si, c)
+        off = h + CAMERA_SETBACK * s
+        world_from_bird = np.array([
+            [si / s, -c / s, x + (c * off - si * w / 2) / s],
+            [-c / s, -si / s, y + (si * off + c * w / 2) / s],
+            [0, 0, 1],
+        ], dtype=np.float64)
+        map_from_bird = self.track.map_from_world() @ world_from_bird
+        cam_from_map = self.cam_from_bird @ np.linalg.inv(map_from_bird)
+        frame = cv.warpPerspective(self.track.image, cam_from_map, (w, h), flags=cv.INTER_LINEAR,
+                                   borderMode=cv.BORDER_CONSTANT, borderValue=WALL_COLOR)
+        frame[:self.sky_rows] = WALL_COLOR
+        return frame
+
+
+def _noise_bank(shape, sigma: float, rng, n: int = 8):
+    """预先生成 n 组 (加, 减) 噪声，逐帧用饱和加减施加，避免每帧生成浮点噪声。"""
+    bank = []
+    for _ in range(n):
+        z = rng.normal(0, sigma, shape)
+        bank.append((np.clip(z, 0, 255).astype(np.uint8), np.clip(-z, 0, 255).astype(np.uint8)))
+    return bank
+
+
+def run_episode(overrides: Dict[str, Any], laps: float = 1.0, max_time: float = 120.0, fps: float = FPS,
+                substeps: int = 4, noise: float = 2.0, seed: int = 0) -> Dict[str, Any]:
+    """用 overrides 覆盖默认参数（并强制 auto_drive=1）闭环跑 laps 圈，返回指标。"""
+    import control
+    import vision
+
+    cv.setNumThreads(1)
+    rng = np.random.default_rng(seed)
+
+    with control.lock:
+        control.params.clear()
+        control.params.update(control.DEFAULT_PARAMS)
+        control.params.update(overrides)
+        control.params["auto_drive"] = 1
+        snap = control.publish_params()
+    vision.reset_vision_state(background_rebuild=False)
+    control.reset_control_state()
+
+    track = Track(_bird_scale(W))
+    cam = Camera(track)
+    bank = _noise_bank((H, W, 3), noise, rng) if noise > 0 else None
+    x, y = track.center[0]
+    theta = math.atan2(track.tangent[0, 1], track.tangent[0, 0])
+    v = 0.0
+    k = 0
+    travelled = 0.0
+    servo_prev = CENTER_POSITION
+    target = laps * track.length
+
+    dt = 1.0 / fps
+    t = 0.0
+    max_lat = 0.0
+    effort = 0.0
+    sq_lat = 0.0
+    steps = 0
+    off_track = False
+    wall_start = time.perf_counter()
+    while t < max_time:
+        frame = cam.render(x, y, theta)
+        if bank:
+            plus, minus = bank[steps % len(bank)]
+            frame = cv.subtract(cv.add(frame, plus), minus)
+        _imgs, err, _overlay = vision.process_image(frame, snap.values)
+        motor, servo, _mode, _light, _m = control.compute_control(err, snap, v / SPEED_PER_DUTY)
+
+        # 舵机高于中位 = 左转（与 err = 画面中心 - 车道中心 的符号约定一致）
+        delta = (servo - CENTER_POSITION) / (MAX_POSITION - CENTER_POSITION) * MAX_STEER
+        effort += abs(servo - servo_prev)
+        servo_prev = servo
+        h = dt / substeps
+        for _ in range(substeps):
+            v += (motor * SPEED_PER_DUTY - v) * min(1.0, h / SPEED_TAU)
+            x += v * math.cos(theta) * h
+            y += v * math.sin(theta) * h
+            theta += v / WHEELBASE * math.tan(delta) * h
+        t += dt
+        steps += 1
+
+        k_new, lat = track.locate(x, y, k)
+        ds = track.s[k_new] - track.s[k]
+        if ds < -track.length / 2:
+            ds += track.length
+        elif ds > track.length / 2:
+            ds -= track.length
+        travelled += ds
+        k = k_new
+        max_lat = max(max_lat, abs(lat))
+        sq_lat += lat * lat
+        if abs(lat) > LANE_WIDTH / 2:
+            off_track = True
+            break
+        if travelled >= target:
+            break
+
+    wall = time.perf_counter() - wall_start
+    finished = bool(not off_track and travelled >= target)
+    return {
+        "params": overrides,
+        "finished": finished,
+        "off_track": off_track,
+        "lap_time": t / laps if finished else None,
+        "distance": float(travelled),
+        "max_lateral_error": max_lat,
+        "rms_lateral_error": math.sqrt(sq_lat / steps) if steps else 0.0,
+        "servo_effort": effort / t if t > 0 else 0.0,
+        "sim_time": t,
+        "wall_time": wall,
+        "speedup": t / wall if wall > 0 else 0.0,
+    }
+
+
+def _run_one(args):
+    overrides, kwargs = args
+    return run_episode(overrides, **kwargs)
+
+
+def sweep(grid: Dict[str, List[Any]], workers: Optional[int] = None, **kwargs) -> List[Dict[str, Any]]:
+    """对 grid 的笛卡尔积并行仿真，结果按（完成优先）单圈时间、最大横向误差排序。"""
+    import control
+
+    configs = control.param_grid_configs(grid)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_run_one, [(c, kwargs) for c in configs]))
+    results.sort(key=lambda r: (not r["finished"], r["lap_time"] or math.inf, r["max_lateral_error"]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="闭环仿真与参数扫描")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=V1,V2",
+                        help="参数取值，可多次给出，做网格组合")
+    parser.add_argument("--laps", type=float, default=1.0)
+    parser.add_argument("--max-time", type=float, default=120.0, help="单次仿真的最长仿真时间（秒）")
+    parser.add_argument("--fps", type=float, default=FPS)
+    parser.add_argument("--noise", type=float, default=2.0, help="图像高斯噪声标准差")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认 CPU 核数")
+    parser.add_argument("--out", help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    import control
+
+    grid = control.parse_param_grid(args.set)
+    t0 = time.perf_counter()
+    results = sweep(grid, args.workers, laps=args.laps, max_time=args.max_time, fps=args.fps,
+                    noise=args.noise, seed=args.seed)
+    elapsed = time.perf_counter() - t0
+
+    for r in results:
+        lap = f"{r['lap_time']:7.2f}s" if r["finished"] else ("   off " if r["off_track"] else " timeout")
+        print(f"{lap}  max_lat {r['max_lateral_error'] * 100:6.1f}cm  rms {r['rms_lateral_error'] * 100:5.1f}cm  "
+              f"effort {r['servo_effort']:7.0f}/s  x{r['speedup']:5.1f}  {r['params']}")
+    print(f"{len(results)} configs in {elapsed:.1f}s")
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"grid": grid, "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
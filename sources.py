@@ -0,0 +1,426 @@
+"""
+帧源：摄像头、视频文件、图片目录和合成车道，统一成 open/read/close 接口供 camera_loop 使用。
+
+用环境变量选择（默认 camera:0）：
+
+    FRAME_SOURCE=camera:0                 # 摄像头编号
+    FRAME_SOURCE=mjpeg:0                  # 摄像头 MJPEG 直通：不解码，原样交给视觉和 /stream/raw
+    FRAME_SOURCE=video:run1.mp4           # 视频文件，播完从头循环
+    FRAME_SOURCE=images:frames/           # 图片目录，按文件名排序循环
+    FRAME_SOURCE=synthetic:curve          # 合成车道（场景见 synthetic.SCENES）
+    FRAME_PACING=fast                     # 不按帧率等待，尽快出帧（默认 realtime）
+    FRAME_SIZE=320x240
+
+非摄像头源在 realtime 模式下按源帧率（视频取文件自带帧率，其余默认 30）出帧；
+fast 模式下不等待，用来测整条流水线的最大吞吐，也便于在没有摄像头的机器上跑服务。
+"""
+import abc
+import os
+import platform
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+DEFAULT_FPS = 30.0
+
+# JPEG 帧头（SOF0..SOF15，除去 DHT / JPG / DAC）
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def _dht(table: int, bits: List[int], vals: bytes) -> bytes:
+    body = bytes([table]) + bytes(bits) + vals
+    return b"\xff\xc4" + (len(body) + 2).to_bytes(2, "big") + body
+
+
+# ITU T.81 附录 K.3 的标准 Huffman 表（亮度 / 色度的 DC、AC）。UVC 摄像头的 MJPEG 帧按 AVI1 约定省略 DHT，
+# 解码器默认用这组表；转发给浏览器等外部解码器时补回去
+_STANDARD_DHT = b"".join((
+    _dht(0x00, [0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0], bytes(range(12))),
+    _dht(0x10, [0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7D], bytes.fromhex(
+        "01020300041105122131410613516107227114328191a1082342b1c11552d1f0"
+        "2433627282090a161718191a25262728292a3435363738393a43444546474849"
+        "4a535455565758595a636465666768696a737475767778797a83848586878889"
+        "8a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3c4c5"
+        "c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8"
+        "f9fa")),
+    _dht(0x01, [0, 3, 1, 1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0], bytes(range(12))),
+    _dht(0x11, [0, 2, 1, 2, 4, 4, 3, 4, 7, 5, 4, 4, 0, 1, 2, 0x77], bytes.fromhex(
+        "000102031104052131061241510761711322328108144291a1b1c109233352f0"
+        "156272d10a162434e125f11718191a262728292a35363738393a434445464748"
+        "494a535455565758595a636465666768696a737475767778797a828384858687"
+        "88898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6b7b8b9bac2c3"
+        "c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae2e3e4e5e6e7e8e9eaf2f3f4f5f6f7f8"
+        "f9fa")),
+))
+
+
+def _scan_header(data: bytes) -> Optional[Tuple[int, int, bool, int]]:
+    """解析 JPEG 头到扫描数据之前：返回 (宽, 高, 是否带 Huffman 表, SOS 段偏移)，不是完整的 JPEG 头时返回 None。"""
+    if data[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    n = len(data)
+    size = None
+    dht = False
+    sos = -1
+    while pos + 4 <= n:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xDA:
+            sos = pos
+            break
+        if marker == 0xC4:
+            dht = True
+        elif marker in _SOF_MARKERS and pos + 9 <= n:
+            size = (int.from_bytes(data[pos + 7:pos + 9], "big"), int.from_bytes(data[pos + 5:pos + 7], "big"))
+        pos += 2 + int.from_bytes(data[pos + 2:pos + 4], "big")
+    if size is None or sos < 0:
+        return None
+    return size[0], size[1], dht, sos
+
+
+def jpeg_info(data: bytes) -> Optional[Tuple[int, int, bool]]:
+    """返回 (宽, 高, 是否带 Huffman 表)，不是完整的 JPEG 头时返回 None。"""
+    info = _scan_header(data)
+    return info[:3] if info is not None else None
+
+
+def with_huffman_tables(data: bytes) -> bytes:
+    """不带 DHT 的 JPEG 在 SOS 前插入标准 Huffman 表，得到任何解码器都能解的独立 JPEG；已带表的原样返回。"""
+    info = _scan_header(data)
+    if info is None or info[2]:
+        return data
+    sos = info[3]
+    return data[:sos] + _STANDARD_DHT + data[sos:]
+
+
+class JpegFrame:
+    """摄像头原样送来的一帧 MJPEG：data 为 JPEG 字节，width / height 为图像尺寸。
+
+    视觉只解码需要的亮度通道（可用 IMREAD_REDUCED_* 直接解出缩小的图），/stream/raw 转发 standalone()。
+    dht=False 表示 data 省略了 Huffman 表（UVC 摄像头的常见做法），OpenCV 能解，浏览器不一定能。
+    """
+
+    __slots__ = ("data", "width", "height", "dht")
+
+    def __init__(self, data: bytes, width: int, height: int, dht: bool = True):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.dht = dht
+
+    def standalone(self) -> bytes:
+        """可以直接发给浏览器的 JPEG：缺 Huffman 表时补上标准表。"""
+        return self.data if self.dht else with_huffman_tables(self.data)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return self.height, self.width, 3
+
+    def decode(self, flags: int = cv.IMREAD_COLOR) -> Optional[np.ndarray]:
+        return cv.imdecode(np.frombuffer(self.data, dtype=np.uint8), flags)
+
+
+def _open_capture(preferred_index, width, height):
+    """Try a couple of camera indices/backends and return the first opened capture."""
+    tried = []
+    for idx in ([preferred_index] + ([0] if preferred_index != 0 else [])):
+        # Try with V4L2 first on Linux, otherwise skip to default backend.
+        if platform.system().lower() == "linux":
+            cap = cv.VideoCapture(idx, cv.CAP_V4L2)
+            tried.append(f"{idx}(v4l2)")
+            if cap.isOpened():
+                cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
+                cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+                cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*"MJPG"))
+                return cap, idx, tried
+            cap.release()
+        # macOS: AVFoundation backend
+        if platform.system().lower() == "darwin":
+            cap = cv.VideoCapture(idx, cv.CAP_AVFOUNDATION)
+            tried.append(f"{idx}(avfoundation)")
+            if cap.isOpened():
+                cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
+                cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+                cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*"MJPG"))
+                return cap, idx, tried
+            cap.release()
+        cap = cv.VideoCapture(idx)
+        tried.append(f"{idx}(default)")
+        if cap.isOpened():
+            cap.set(cv.CAP_PROP_FRAME_WIDTH, width)
+            cap.set(cv.CAP_PROP_FRAME_HEIGHT, height)
+            cap.set(cv.CAP_PROP_FOURCC, cv.VideoWriter_fourcc(*"MJPG"))
+            return cap, idx, tried
+        cap.release()
+    return None, None, tried
+
+
+class FrameSource(abc.ABC):
+    """帧源基类。read() 返回 (ok, BGR 帧)；finished 为 True 表示不循环的源已经读完。
+    子类必须实现 _read()，漏掉时构造就会报 TypeError，而不是到采集线程里才出错。
+
+    realtime=True 时 read() 按 fps 等到下一帧的时间点再返回；摄像头本身就按硬件帧率出帧，不额外等待。
+    live 表示帧会过期（摄像头），采集端应只保留最新帧而不是等下游。
+    """
+
+    live = False
+
+    def __init__(self, width: int = 320, height: int = 240, realtime: bool = True, fps: float = DEFAULT_FPS):
+        self.width = width
+        self.height = height
+        self.realtime = realtime
+        self.fps = fps
+        self.error = ""
+        self.finished = False
+        self._next_t = 0.0
+
+    def describe(self) -> str:
+        return type(self).__name__
+
+    def open(self) -> bool:
+        return True
+
+    def read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        self._pace()
+        return self._read()
+
+    @abc.abstractmethod
+    def _read(self) -> Tuple[bool, Optional[np.ndarray]]:
+        """取一帧，不做节拍等待。"""
+
+    def close(self):
+        pass
+
+    def _pace(self):
+        if not self.realtime or self.fps <= 0:
+            return
+        now = time.perf_counter()
+        if self._next_t > now:
+            time.sleep(self._next_t - now)
+            now = self._next_t
+        # 落后超过一帧时不补帧，从当前时间重新计时
+        self._next_t = max(self._next_t + 1.0 / self.fps, now)
+
+    def _fit(self, frame: np.ndarray) -> np.ndarray:
+        if frame.ndim == 2:
+            frame = cv.cvtColor(frame, cv.COLOR_GRAY2BGR)
+        if frame.shape[1] != self.width or frame.shape[0] != self.height:
+            frame = cv.resize(frame, (self.width, self.height), interpolation=cv.INTER_AREA)
+        return frame
+
+
+class CameraSource(FrameSource):
+    """摄像头。passthrough=True 时关掉 OpenCV 的解码（CAP_PROP_CONVERT_RGB=0），read() 返回 JpegFrame；
+    后端不支持（送来的仍是 BGR 或不是 JPEG）时自动退回解码模式。
+    不带 Huffman 表的帧照常直通，推流时再补标准表。
+    """
+
+    live = True
+
+    def __init__(self, index: int = 0, width: int = 320, height: int = 240, passthrough: bool = False):
+        super().__init__(width, height, realtime=False)
+        self.index = index
+        self.passthrough = passthrough
+        self.cap = None
+        self._checked = False
+        self._dht = True
+
+    def describe(self) -> str:
+        return f"{'mjpeg' if self.passthrough else 'camera'}:{self.index}"
+
+    def open(self) -> bool:
+        cap, used_idx, tried = _open_capture(self.index, self.width, self.height)
+        if cap is None or not cap.isOpened():
+            self.error = f"open camera failed, tried: {', '.join(tried)}"
+            return False
+        self.cap = cap
+        self.index = used_idx
+        if self.passthrough:
+            cap.set(cv.CAP_PROP_CONVERT_RGB, 0)
+            self._checked = False
+        return True
+
+    def _read(self):
+        if self.cap is None:
+            return False, None
+        ok, buf = self.cap.read()
+        if not ok or buf is None or not self.passthrough:
+            return ok, buf
+        if buf.ndim == 3:
+            # 后端忽略了 CONVERT_RGB，送来的已经是 BGR
+            self._fallback()
+            return True, buf
+
+        data = buf.tobytes()
+        if not self._checked:
+            info = jpeg_info(data)
+            if info is None:
+                self._fallback()
+                return False, None
+            self.width, self.height, self._dht = info
+            self._checked = True
+        return True, JpegFrame(data, self.width, self.height, self._dht)
+
+    def _fallback(self):
+        self.passthrough = False
+        self.error = "mjpeg passthrough unavailable, decoding frames"
+        self.cap.set(cv.CAP_PROP_CONVERT_RGB, 1)
+
+    def close(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+
+class VideoSource(FrameSource):
+    def __init__(self, path: str, width: int = 320, height: int = 240, realtime: bool = True, loop: bool = True):
+        super().__init__(width, height, realtime)
+        self.path = path
+        self.loop = loop
+        self.cap = None
+
+    def describe(self) -> str:
+        return f"video:{self.path}"
+
+    def open(self) -> bool:
+        cap = cv.VideoCapture(str(self.path))
+        if not cap.isOpened():
+            self.error = f"open video failed: {self.path}"
+            return False
+        fps = cap.get(cv.CAP_PROP_FPS)
+        if fps and fps > 0:
+            self.fps = fps
+        self.cap = cap
+        return True
+
+    def _read(self):
+        if self.cap is None:
+            return False, None
+        ok, frame = self.cap.read()
+        if not ok and self.loop:
+            self.cap.set(cv.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.cap.read()
+        if not ok:
+            self.finished = not self.loop
+            return False, None
+        return True, self._fit(frame)
+
+    def close(self):
+        if self.cap is not None:
+            self.cap.release()
+            self.cap = None
+
+
+class ImageDirSource(FrameSource):
+    def __init__(self, path: str, width: int = 320, height: int = 240, realtime: bool = True,
+                 fps: float = DEFAULT_FPS, loop: bool = True):
+        super().__init__(width, height, realtime, fps)
+        self.path = Path(path)
+        self.loop = loop
+        self.files: List[Path] = []
+        self._i = 0
+
+    def describe(self) -> str:
+        return f"images:{self.path}"
+
+    def open(self) -> bool:
+        if self.path.is_dir():
+            self.files = sorted(p for p in self.path.iterdir() if p.suffix.lower() in IMAGE_EXTS)
+        if not self.files:
+            self.error = f"no images in {self.path}"
+            return False
+        self._i = 0
+        return True
+
+    def _read(self):
+        if self._i >= len(self.files):
+            if not self.loop:
+                self.finished = True
+                return False, None
+            self._i = 0
+        path = self.files[self._i]
+        self._i += 1
+        frame = cv.imread(str(path), cv.IMREAD_COLOR)
+        if frame is None:
+            self.error = f"decode failed: {path.name}"
+            return False, None
+        return True, self._fit(frame)
+
+
+class SyntheticSource(FrameSource):
+    """合成车道：车道中心缓慢左右摆动、虚线随时间前进。
+
+    预先渲染 cycle 帧循环播放，出帧本身几乎不占 CPU，fast 模式测到的是流水线而不是渲染的吞吐。
+    """
+
+    def __init__(self, scene: str = "curve", width: int = 320, height: int = 240, realtime: bool = True,
+                 fps: float = DEFAULT_FPS, cycle: int = 120, seed: int = 0):
+        super().__init__(width, height, realtime, fps)
+        self.scene = scene
+        self.cycle = cycle
+        self.seed = seed
+        self._frames: List[np.ndarray] = []
+        self._i = 0
+
+    def describe(self) -> str:
+        return f"synthetic:{self.scene}"
+
+    def open(self) -> bool:
+        from synthetic import render_lane_frame
+        try:
+            self._frames = [
+                render_lane_frame(self.scene, self.width, self.height,
+                                  offset=20.0 * np.sin(2 * np.pi * i / self.cycle), phase=6.0 * i,
+                                  seed=self.seed + i)
+                for i in range(self.cycle)
+            ]
+        except ValueError as e:
+            self.error = str(e)
+            return False
+        self._i = 0
+        return True
+
+    def _read(self):
+        frame = self._frames[self._i]
+        self._i = (self._i + 1) % len(self._frames)
+        return True, frame
+
+
+def parse_size(text: str, default: Tuple[int, int] = (320, 240)) -> Tuple[int, int]:
+    try:
+        w, h = text.lower().split("x")
+        return int(w), int(h)
+    except (AttributeError, ValueError):
+        return default
+
+
+def make_source(spec: str = None, width: int = None, height: int = None, realtime: bool = None) -> FrameSource:
+    """按 "类型:参数" 构造帧源，缺省项取 FRAME_SOURCE / FRAME_SIZE / FRAME_PACING 环境变量。"""
+    spec = spec or os.environ.get("FRAME_SOURCE", "camera:0")
+    if width is None or height is None:
+        width, height = parse_size(os.environ.get("FRAME_SIZE", ""))
+    if realtime is None:
+        realtime = os.environ.get("FRAME_PACING", "realtime").lower() != "fast"
+
+    kind, _, arg = spec.partition(":")
+    kind = kind.strip().lower()
+    if kind == "camera":
+        return CameraSource(int(arg or 0), width, height)
+    if kind == "mjpeg":
+        return CameraSource(int(arg or 0), width, height, passthrough=True)
+    if kind == "video":
+        return VideoSource(arg, width, height, realtime)
+    if kind == "images":
+        return ImageDirSource(arg, width, height, realtime)
+    if kind == "synthetic":
+        return SyntheticSource(arg or "curve", width, height, realtime)
+    raise ValueError(f"unknown frame source: {spec}")
@@ -0,0 +1,428 @@
+import itertools
+import json
+import struct
+import threading
+import time
+from typing import Any, Dict, FrozenSet, List, Optional, Tuple
+
+import cv2 as cv
+import numpy as np
+
+import metrics
+from sources import JpegFrame
+
+STREAM_NAMES = ("raw", "gray", "blur", "canny", "roi", "processed")
+JPEG_QUALITY = 80
+
+# 视频流客户端：默认/最大帧率，自动降档时的质量阶梯和最低帧率
+STREAM_MAX_FPS = 30.0
+STREAM_MIN_FPS = 2.0
+STREAM_QUALITY_STEPS = (80, 65, 50, 35)
+# 写一帧的耗时占帧间隔的比例：高于 SLOW_BUSY 视为慢客户端降一档，持续低于 FAST_BUSY 才升一档
+SLOW_BUSY = 0.5
+FAST_BUSY = 0.2
+# 两次降档的最短间隔、升档前需要持续顺畅的时间（秒）
+ADAPT_COOLDOWN = 1.0
+RECOVER_AFTER = 3.0
+# 内核发送队列里未发出的数据超过这么多帧时跳过本帧并降档
+STREAM_BACKLOG_FRAMES = 2.0
+# Linux 上 socket 的 SIOCOUTQ 与 TIOCOUTQ 同值：发送队列里还没被对端确认的字节数；
+# 非 POSIX 平台没有 fcntl/termios，只靠写耗时判断慢客户端
+try:
+    import fcntl
+    import termios
+    _SIOCOUTQ = getattr(termios, "TIOCOUTQ", None)
+except ImportError:
+    fcntl = None
+    _SIOCOUTQ = None
+
+# 状态推送：每个客户端默认/允许的最大推送频率（Hz）
+STATUS_DEFAULT_RATE = 10.0
+STATUS_MAX_RATE = 30.0
+# 无变化时发送 SSE 注释保活的间隔
+STATUS_KEEPALIVE = 15.0
+
+
+class _StreamCache:
+    """单路视频流的编码缓存：每一代帧按 (质量, 缩放) 最多编码一次，同一档位的客户端共享。
+
+    发布的是 JpegFrame（MJPEG 直通）时，原尺寸、不要求降质量的客户端直接拿摄像头的 JPEG（缺 Huffman 表时补上标准表），不解码也不编码。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._cond = threading.Condition()
+        self._encode_lock = threading.Lock()
+        self._generation = 0
+        self._frame = None
+        # (quality, scale) -> (generation, jpeg)
+        self._jpgs: Dict[Tuple[int, float], Tuple[int, bytes]] = {}
+
+    def publish(self, img):
+        with self._cond:
+            self._frame = img
+            self._generation += 1
+            self._cond.notify_all()
+
+    def wait_next(self, last_gen: int, timeout: float = 1.0, quality: int = JPEG_QUALITY,
+                  scale: float = 1.0) -> Tuple[int, Optional[bytes]]:
+        """等待比 last_gen 更新的一代帧，返回 (generation, jpeg)；超时返回 (last_gen, None)。"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._generation != last_gen, timeout)
+            gen = self._generation
+            frame = self._frame
+        if gen == last_gen:
+            return last_gen, None
+        if frame is None:
+            return gen, _placeholder_jpeg(self.name)
+
+        if isinstance(frame, JpegFrame) and scale >= 1.0 and quality >= JPEG_QUALITY:
+            return gen, frame.standalone()
+
+        # 编码在条件变量外进行，避免阻塞发布方；编码锁保证同一代同一档位只编码一次
+        key = (quality, scale)
+        with self._encode_lock:
+            cached = self._jpgs.get(key)
+            if cached is not None and cached[0] >= gen:
+                return cached
+            t0 = metrics.now()
+            if isinstance(frame, JpegFrame):
+                # 要缩小时让解码器直接解出 1/2 尺寸
+                if scale <= 0.5:
+                    frame = frame.decode(cv.IMREAD_REDUCED_COLOR_2)
+                    scale *= 2.0
+                else:
+                    frame = frame.decode()
+                if frame is None:
+                    return gen, None
+            if scale < 1.0:
+                h, w = frame.shape[:2]
+                size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+                frame = cv.resize(frame, size, interpolation=cv.INTER_AREA)
+            ok, jpg = cv.imencode(".jpg", frame, [int(cv.IMWRITE_JPEG_QUALITY), quality])
+            metrics.observe("stream.encode", metrics.now() - t0)
+            if not ok:
+                return gen, None
+            cached = (gen, jpg.tobytes())
+            self._jpgs[key] = cached
+            return cached
+
+
+_caches: Dict[str, _StreamCache] = {name: _StreamCache(name) for name in STREAM_NAMES}
+_placeholders: Dict[str, bytes] = {}
+
+# 订阅登记：每路流当前连接的客户端数，视觉只生成有人看的画面
+_subscribers: Dict[str, int] = {name: 0 for name in STREAM_NAMES}
+_subscribers_lock = threading.Lock()
+_active: FrozenSet[str] = frozenset()
+
+
+def _subscribe(name: str, delta: int):
+    global _active
+    with _subscribers_lock:
+        _subscribers[name] = max(0, _subscribers[name] + delta)
+        _active = frozenset(n for n, c in _subscribers.items() if c > 0)
+
+
+def active_streams() -> FrozenSet[str]:
+    """当前至少有一个客户端在看的流名集合（无锁读取）。"""
+    return _active
+
+
+def _placeholder_jpeg(name: str) -> bytes:
+    jpg = _placeholders.get(name)
+    if jpg is None:
+        placeholder = np.zeros((240, 320, 3), dtype=np.uint8)
+        cv.putText(placeholder, f"Waiting: {name}", (10, 120),
+                   cv.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 2)
+        _, buf = cv.imencode(".jpg", placeholder, [int(cv.IMWRITE_JPEG_QUALITY), JPEG_QUALITY])
+        jpg = buf.tobytes()
+        _placeholders[name] = jpg
+    return jpg
+
+
+def publish_frames(imgs: Dict[str, np.ndarray]):
+    """由采集循环调用：登记新一代帧并唤醒等待中的客户端（不做编码）；帧可以是 ndarray 或 JpegFrame。"""
+    for name, img in imgs.items():
+        cache = _caches.get(name)
+        if cache is not None:
+            cache.publish(img)
+
+
+def _unsent_bytes(fd: int) -> Optional[int]:
+    """socket 发送队列里尚未发出的字节数；拿不到 socket 或平台不支持时返回 None。"""
+    if fd < 0 or _SIOCOUTQ is None:
+        return None
+    try:
+        return struct.unpack("i", fcntl.ioctl(fd, _SIOCOUTQ, b"\0\0\0\0"))[0]
+    except OSError:
+        return None
+
+
+def _part(jpg: bytes) -> bytes:
+    return (b"--frame\r\n"
+            b"Content-Type: image/jpeg\r\n\r\n" + jpg + b"\r\n")
+
+
+class _StreamClient:
+    """一个视频流连接的发送节奏与自适应状态。
+
+    生成器 yield 之后要等服务器把这一帧写进 socket 才会继续，yield 前后的耗时就是写一帧的时间；
+    它占帧间隔的比例高说明链路跟不上：先逐档降 JPEG 质量，降到底再把帧率减半，
+    持续顺畅后按相反顺序恢复。来不及发的帧直接跳过，只影响这一个客户端。
+
+    写耗时只反映数据进了内核发送缓冲区，缓冲区自动增长到几 MB 之后才会变慢；
+    拿得到 socket 时每帧发送前再查一次发送队列深度，积压超过 STREAM_BACKLOG_FRAMES 帧就跳过本帧并降档。
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, name: str, fps: float = None, quality: int = None, scale: float = None, peer: str = "",
+                 sock=None):
+        self.id = next(self._ids)
+        self.name = name
+        self.peer = peer
+        self.target_fps = min(max(float(fps or STREAM_MAX_FPS), STREAM_MIN_FPS), STREAM_MAX_FPS)
+        cap = min(max(int(quality or JPEG_QUALITY), 10), 95)
+        self.qualities = [cap] + [q for q in STREAM_QUALITY_STEPS if q < cap]
+        self.scale = min(max(float(scale or 1.0), 0.1), 1.0)
+        self.quality_level = 0
+        self.fps_level = 0
+
+        self.delivered = 0
+        self.dropped = 0
+        self.fps = 0.0
+        self.write_avg = 0.0
+        self.backlog = 0
+        self.next_t = 0.0
+        try:
+            self._fd = sock.fileno() if sock is not None else -1
+        except (OSError, ValueError):
+            self._fd = -1
+        self._window_t = time.monotonic()
+        self._window_frames = 0
+        self._adapted_t = 0.0
+        self._smooth_since: Optional[float] = None
+
+    @property
+    def quality(self) -> int:
+        return self.qualities[self.quality_level]
+
+    @property
+    def current_fps(self) -> float:
+        return max(self.target_fps / (2 ** self.fps_level), STREAM_MIN_FPS)
+
+    def sent(self, write_s: float):
+        """记录一帧写完的耗时，更新实际帧率并按链路繁忙程度调档。"""
+        now = time.monotonic()
+        self.delivered += 1
+        self._window_frames += 1
+        if now - self._window_t >= 1.0:
+            self.fps = self._window_frames / (now - self._window_t)
+            self._window_t = now
+            self._window_frames = 0
+
+        self.write_avg += (write_s - self.write_avg) * 0.3
+        interval = 1.0 / self.current_fps
+        self.next_t = max(self.next_t + interval, now)
+
+        busy = self.write_avg / interval
+        if busy > SLOW_BUSY:
+            self._smooth_since = None
+            if now - self._adapted_t >= ADAPT_COOLDOWN:
+                self._degrade(now)
+        elif busy < FAST_BUSY:
+            if self._smooth_since is None:
+                self._smooth_since = now
+            elif now - self._smooth_since >= RECOVER_AFTER:
+                self._recover(now)
+        else:
+            self._smooth_since = None
+
+    def backlogged(self, size: int) -> bool:
+        """发送前调用：发送队列里积压超过 STREAM_BACKLOG_FRAMES 帧（按本帧大小估算）时记一次跳帧、降档并返回 True。"""
+        unsent = _unsent_bytes(self._fd)
+        if unsent is None:
+            # 查不到发送队列（没有 socket 或平台不支持）：交给 sent() 里按写耗时调档
+            return False
+        self.backlog = unsent
+        if unsent <= size * STREAM_BACKLOG_FRAMES:
+            return False
+        now = time.monotonic()
+        self.dropped += 1
+        self._smooth_since = None
+        if now - self._adapted_t >= ADAPT_COOLDOWN:
+            self._degrade(now)
+        self.next_t = now + 1.0 / self.current_fps
+        return True
+
+    def _degrade(self, now: float):
+        if self.quality_level < len(self.qualities) - 1:
+            self.quality_level += 1
+        elif self.current_fps > STREAM_MIN_FPS:
+            self.fps_level += 1
+        self._adapted_t = now
+
+    def _recover(self, now: float):
+        if self.fps_level > 0:
+            self.fps_level -= 1
+        elif self.quality_level > 0:
+            self.quality_level -= 1
+        self._adapted_t = now
+        self._smooth_since = now
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "stream": self.name,
+            "peer": self.peer,
+            "fps": round(self.fps, 1),
+            "target_fps": round(self.current_fps, 1),
+            "quality": self.quality,
+            "scale": self.scale,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "write_ms": round(self.write_avg * 1e3, 2),
+            "backlog_kb": round(self.backlog / 1024, 1),
+        }
+
+
+_clients: Dict[int, _StreamClient] = {}
+_clients_lock = threading.Lock()
+
+
+def client_stats() -> List[Dict[str, Any]]:
+    """当前每个视频流连接的实际帧率、档位、写一帧的平均耗时和跳过的帧数。"""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return [c.stats() for c in clients]
+
+
+def mjpeg_stream(name: str, fps: float = None, quality: int = None, scale: float = None, peer: str = "",
+                 sock=None):
+    """fps / quality / scale 为客户端要求的上限，链路跟不上时在此基础上自动降档；
+    sock 为该连接的 socket（可选），用来查询发送队列的积压。"""
+    cache = _caches[name]
+    client = _StreamClient(name, fps, quality, scale, peer, sock)
+    with _clients_lock:
+        _clients[client.id] = client
+    _subscribe(name, 1)
+    try:
+        gen, jpg = cache.wait_next(-1, timeout=0, quality=client.quality, scale=client.scale)
+        if jpg is None:
+            jpg = _placeholder_jpeg(name)
+        t0 = time.monotonic()
+        yield _part(jpg)
+        client.sent(time.monotonic() - t0)
+
+        while True:
+            # 按本客户端的帧率等待，期间发布的帧直接跳过
+            delay = client.next_t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            new_gen, jpg = cache.wait_next(gen, quality=client.quality, scale=client.scale)
+            if jpg is None:
+                continue
+            if new_gen > gen + 1:
+                client.dropped += new_gen - gen - 1
+            gen = new_gen
+            if client.backlogged(len(jpg)):
+                continue
+            t0 = time.monotonic()
+            yield _part(jpg)
+            client.sent(time.monotonic() - t0)
+    finally:
+        # 客户端断开时 Flask 会关闭生成器
+        _subscribe(name, -1)
+        with _clients_lock:
+            _clients.pop(client.id, None)
+
+
+# ==============================================================================
+# 状态推送（SSE）
+# ==============================================================================
+
+class _StatusChannel:
+    """采集循环发布状态快照，SSE 客户端等待新版本，不碰全局锁。"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._version = 0
+        self._snapshot: Dict[str, Any] = {}
+        self.subscribers = 0
+
+    def publish(self, snapshot: Dict[str, Any]):
+        with self._cond:
+            self._snapshot = snapshot
+            self._version += 1
+            self._cond.notify_all()
+
+    def wait_next(self, last_version: int, timeout: float) -> Tuple[int, Dict[str, Any]]:
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != last_version, timeout)
+            return self._version, self._snapshot
+
+    def subscribe(self, delta: int):
+        with self._cond:
+            self.subscribers = max(0, self.subscribers + delta)
+
+
+_status = _StatusChannel()
+_MISSING = object()
+
+
+def status_wanted() -> bool:
+    """有 SSE 客户端时采集循环才需要构造状态快照。"""
+    return _status.subscribers > 0
+
+
+def publish_status(snapshot: Dict[str, Any]):
+    _status.publish(snapshot)
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def status_events(initial: Dict[str, Any], max_rate: float = STATUS_DEFAULT_RATE):
+    """SSE 生成器：先推一次完整状态（event: full），之后只推变化的字段（event: delta），
+    两次推送间隔不小于 1 / max_rate，期间的中间版本直接合并。
+
+    delta 只按顶层字段比较，值（如 overlay、stream_clients）变了就整个重发；客户端把 delta 合并进已有状态，
+    表达不了“某个字段没了”，所以快照里少了字段时改推一次 full，让客户端整体替换。
+    """
+    max_rate = min(max(float(max_rate), 0.5), STATUS_MAX_RATE)
+    interval = 1.0 / max_rate
+    _status.subscribe(1)
+    try:
+        version, _ = _status.wait_next(-1, timeout=0)
+        sent = dict(initial)
+        sent["stream_clients"] = client_stats()
+        yield _sse("full", sent)
+        next_t = time.monotonic() + interval
+
+        while True:
+            delay = next_t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            new_version, snapshot = _status.wait_next(version, timeout=STATUS_KEEPALIVE)
+            if new_version == version:
+                yield ": keepalive\n\n"
+                continue
+            version = new_version
+            # 视频流连接在本进程登记（实时进程模式下状态快照里没有）
+            snapshot = dict(snapshot)
+            snapshot["stream_clients"] = client_stats()
+            if not sent.keys() <= snapshot.keys():
+                sent = snapshot
+                yield _sse("full", sent)
+                next_t = time.monotonic() + interval
+                continue
+            delta = {k: v for k, v in snapshot.items() if sent.get(k, _MISSING) != v}
+            if not delta:
+                continue
+            sent.update(delta)
+            yield _sse("delta", delta)
+            next_t = time.monotonic() + interval
+    finally:
+        _status.subscribe(-1)
@@ -0,0 +1,93 @@
+"""
+合成车道图像：先在鸟瞰平面画车道线，再用默认标定的逆透视投到相机视角，
+与 vision 的鸟瞰假设一致。用于基准测试和无摄像头运行。
+
+场景：straight（直道）、curve（弯道）、dashed（右侧虚线）、glare（反光斑）、clutter（杂物/噪点）。
+"""
+from typing import Tuple
+
+import cv2 as cv
+import numpy as np
+
+from calibration import default_src_points, dst_points
+
+SCENES = ("straight", "curve", "dashed", "glare", "clutter")
+
+FLOOR_COLOR = (90, 90, 90)
+WALL_COLOR = (40, 45, 50)
+LINE_COLOR = (235, 235, 235)
+
+
+def _camera_homography(w: int, h: int, ox: int, oy: int) -> np.ndarray:
+    """鸟瞰画布（原点平移 ox, oy）到相机图像的单应矩阵。"""
+    M_inv = cv.getPerspectiveTransform(dst_points(w, h), default_src_points(w, h))
+    shift = np.array([[1, 0, -ox], [0, 1, -oy], [0, 0, 1]], dtype=np.float64)
+    return M_inv @ shift
+
+
+def render_bird_view(w: int, h: int, offset: float = 0.0, curvature: float = 0.0, lane_width: float = None,
+                     dashed: bool = False, phase: float = 0.0, margin: Tuple[int, int] = (0, 0)) -> np.ndarray:
+    """在鸟瞰平面画左右车道线。
+
+    offset：车道中心相对图像中线的横向偏移（像素，正值向右）
+    curvature：x = 中心 + curvature * d^2，d 为离图像底部的距离（像素）
+    phase：虚线相位（像素），随时间增加即可模拟前进
+    margin：画布在左右 / 上方额外扩展的像素，避免投影后出现空白
+    """
+    mx, my = margin
+    canvas = np.full((h + my, w + 2 * mx, 3), FLOOR_COLOR, dtype=np.uint8)
+    lane_width = lane_width if lane_width is not None else w * 0.5
+
+    ys = np.arange(-my, h, 2, dtype=np.float64)
+    d = (h - 1) - ys
+    center = w / 2.0 + offset + curvature * d ** 2
+    for side in (-1, 1):
+        xs = center + side * lane_width / 2.0
+        pts = np.stack([xs + mx, ys + my], axis=1).astype(np.int32)
+        if dashed and side == 1:
+            period, on = 48, 28
+            keep = ((d + phase) % period) < on
+            # 按连续的“画”段分别绘制
+            starts = np.flatnonzero(keep & ~np.r_[False, keep[:-1]])
+            ends = np.flatnonzero(keep & ~np.r_[keep[1:], False])
+            for a, b in zip(starts, ends):
+                cv.polylines(canvas, [pts[a:b + 1]], False, LINE_COLOR, 6)
+        else:
+            cv.polylines(canvas, [pts], False, LINE_COLOR, 6)
+    return canvas
+
+
+def render_lane_frame(scene: str = "straight", w: int = 320, h: int = 240, offset: float = 0.0,
+                      curvature: float = None, phase: float = 0.0, seed: int = 0) -> np.ndarray:
+    """生成一帧 BGR 相机图像。"""
+    if scene not in SCENES:
+        raise ValueError(f"unknown scene: {scene}")
+    rng = np.random.default_rng(seed)
+    if curvature is None:
+        curvature = 0.0015 if scene == "curve" else 0.0
+
+    mx, my = w, 2 * h
+    bird = render_bird_view(w, h, offset, curvature, dashed=(scene == "dashed"), phase=phase, margin=(mx, my))
+    H = _camera_homography(w, h, mx, my)
+    frame = cv.warpPerspective(bird, H, (w, h), flags=cv.INTER_LINEAR,
+                               borderMode=cv.BORDER_CONSTANT, borderValue=WALL_COLOR)
+
+    if scene == "glare":
+        glare = np.zeros((h, w), dtype=np.float32)
+        cx = int(rng.integers(w // 4, 3 * w // 4))
+        cy = int(rng.integers(int(h * 0.65), h - 20))
+        cv.ellipse(glare, (cx, cy), (40, 18), float(rng.uniform(0, 180)), 0, 360, 1.0, -1)
+        glare = cv.GaussianBlur(glare, (0, 0), 9)
+        frame = np.clip(frame + glare[:, :, None] * 150, 0, 255).astype(np.uint8)
+    elif scene == "clutter":
+        for _ in range(25):
+            x = int(rng.integers(0, w))
+            y = int(rng.integers(int(h * 0.6), h))
+            color = tuple(int(c) for c in rng.integers(150, 255, size=3))
+            if rng.random() < 0.5:
+                cv.circle(frame, (x, y), int(rng.integers(2, 6)), color, -1)
+            else:
+                cv.rectangle(frame, (x, y), (x + int(rng.integers(3, 15)), y + int(rng.integers(2, 8))), color, -1)
+
+    noise = rng.normal(0, 4, frame.shape)
+    return np.clip(frame + noise, 0, 255).astype(np.uint8)
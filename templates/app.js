@@ -1,5 +1,6 @@
 const keys = [
   "binary_value","canny_low_threshold","hof_threshold","hof_min_line_len","hof_max_line_gap",
+  "fit_nwindows","fit_margin","fit_minpix","vision_scale","frame_budget_ms",
   "auto_drive","steer_k","steer_invert",
   "speed_mode","motor_base","motor_k",
   "speed_target","speed_slowdown_gain","speed_kp","speed_ki","speed_kd","speed_dt",
@@ -285,10 +286,15 @@ const ui = (() => {
       payload["hof_max_line_gap"] = parseInt(payload["hof_max_line_gap"], 10);
       payload["binary_value"] = parseInt(payload["binary_value"], 10);
       payload["canny_low_threshold"] = parseInt(payload["canny_low_threshold"], 10);
+      payload["fit_nwindows"] = parseInt(payload["fit_nwindows"], 10);
+      payload["fit_margin"] = parseInt(payload["fit_margin"], 10);
+      payload["fit_minpix"] = parseInt(payload["fit_minpix"], 10);
       payload["manual_servo"] = parseInt(payload["manual_servo"], 10);
       payload["scs_mode"] = parseInt(payload["scs_mode"], 10);
       payload["headlight"] = parseInt(payload["headlight"], 10);
 
+      payload["vision_scale"] = parseFloat(payload["vision_scale"]);
+      payload["frame_budget_ms"] = parseFloat(payload["frame_budget_ms"]);
       payload["steer_k"] = parseFloat(payload["steer_k"]);
       payload["motor_base"] = parseFloat(payload["motor_base"]);
       payload["motor_k"] = parseFloat(payload["motor_k"]);
@@ -443,55 +449,88 @@ const ui = (() => {
       });
     }
 
-  async function pollStatus() {
-    try {
-      const s = await api.loadStatus();
-      const chassisOk = !!s.chassis_connected;
-      const statusHtml = `
-        <div class="status-grid">
-          <div class="stat-box">
-            <span class="stat-label">MODE</span>
-            <span class="stat-value">${(s.mode || "auto").toString().toUpperCase()}</span>
-          </div>
-          <div class="stat-box">
-            <span class="stat-label">FPS</span>
-            <span class="stat-value">${Number(s.fps).toFixed(1)}</span>
-          </div>
-          <div class="stat-box">
-            <span class="stat-label">OFFSET</span>
-            <span class="stat-value">${Number(s.err).toFixed(2)}</span>
-          </div>
-          <div class="stat-box">
-            <span class="stat-label">STEERING</span>
-            <span class="stat-value">${s.servo_position}</span>
-          </div>
-          <div class="stat-box">
-            <span class="stat-label">THROTTLE</span>
-            <span class="stat-value">${Number(s.motor_duty).toFixed(2)}</span>
-          </div>
-          <div class="status-row ${chassisOk ? "" : "error"}" title="${chassisOk ? "Chassis Connected" : (s.chassis_error || "Connection Failed")}">
-            <div class="status-text">
-              <span class="title">Chassis</span>
-              <span class="desc">${chassisOk ? "Connected" : "Connection Failed"}</span>
-            </div>
-            <div class="status-indicator ${chassisOk ? "green" : "red"}"></div>
+  function renderStatus(s) {
+    const chassisOk = !!s.chassis_connected;
+    const statusHtml = `
+      <div class="status-grid">
+        <div class="stat-box">
+          <span class="stat-label">MODE</span>
+          <span class="stat-value">${(s.mode || "auto").toString().toUpperCase()}</span>
+        </div>
+        <div class="stat-box">
+          <span class="stat-label">FPS</span>
+          <span class="stat-value">${Number(s.fps).toFixed(1)}</span>
+        </div>
+        <div class="stat-box">
+          <span class="stat-label">OFFSET</span>
+          <span class="stat-value">${Number(s.err).toFixed(2)}</span>
+        </div>
+        <div class="stat-box">
+          <span class="stat-label">STEERING</span>
+          <span class="stat-value">${s.servo_position}</span>
+        </div>
+        <div class="stat-box">
+          <span class="stat-label">THROTTLE</span>
+          <span class="stat-value">${Number(s.motor_duty).toFixed(2)}</span>
+        </div>
+        <div class="stat-box">
+          <span class="stat-label">SPEED</span>
+          <span class="stat-value">${s.speed_measured == null ? "--" : Number(s.speed_measured).toFixed(3)}</span>
+        </div>
+        <div class="stat-box">
+          <span class="stat-label">BATTERY</span>
+          <span class="stat-value">${s.battery_v == null ? "--" : Number(s.battery_v).toFixed(2) + "V"}</span>
+        </div>
+        <div class="status-row ${chassisOk ? "" : "error"}" title="${chassisOk ? "Chassis Connected" : (s.chassis_error || "Connection Failed")}">
+          <div class="status-text">
+            <span class="title">Chassis</span>
+            <span class="desc">${chassisOk ? "Connected" : "Connection Failed"}</span>
           </div>
+          <div class="status-indicator ${chassisOk ? "green" : "red"}"></div>
         </div>
-      `;
-      document.getElementById("status").innerHTML = statusHtml;
-      backendOverlay = s.overlay || null;
-      updateCameraIndicator(s);
-      updateIsland(s.err || 0);
-      pushHistory(errHistory, Number(s.err) || 0);
-      pushHistory(speedHistory, Number(s.motor_duty) || 0);
-      drawSparkline(errChart, errHistory, { min: -40, max: 40, color: "#00c7be" });
-      drawSparkline(speedChart, speedHistory, { min: 0, max: 0.2, color: "#ff9f0a" });
-      resizeCanvas();
-      drawOverlay();
+      </div>
+    `;
+    document.getElementById("status").innerHTML = statusHtml;
+    backendOverlay = s.overlay || null;
+    updateCameraIndicator(s);
+    updateIsland(s.err || 0);
+    pushHistory(errHistory, Number(s.err) || 0);
+    pushHistory(speedHistory, Number(s.motor_duty) || 0);
+    drawSparkline(errChart, errHistory, { min: -40, max: 40, color: "#00c7be" });
+    drawSparkline(speedChart, speedHistory, { min: 0, max: 0.2, color: "#ff9f0a" });
+    resizeCanvas();
+    drawOverlay();
+  }
+
+  async function pollStatus() {
+    try {
+      renderStatus(await api.loadStatus());
     } catch (e) {}
     setTimeout(pollStatus, 220);
   }
 
+  // 优先用 SSE 推送（首条完整状态，之后只推变化字段），不支持或连接失败时退回轮询
+  function subscribeStatus() {
+    if (!window.EventSource) {
+      pollStatus();
+      return;
+    }
+    let current = {};
+    const es = new EventSource("/api/status/stream?rate=10");
+    es.addEventListener("full", (e) => {
+      current = JSON.parse(e.data);
+      renderStatus(current);
+    });
+    es.addEventListener("delta", (e) => {
+      Object.assign(current, JSON.parse(e.data));
+      renderStatus(current);
+    });
+    es.onerror = () => {
+      es.close();
+      pollStatus();
+    };
+  }
+
   async function init(){
     streamSelect = document.getElementById("streamSelect");
     streamImage = document.getElementById("streamImage");
@@ -514,7 +553,7 @@ const ui = (() => {
     bindROI();
     updateStream();
     await loadParams();
-    pollStatus();
+    subscribeStatus();
     resizeCanvas();
   }
 
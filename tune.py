@@ -0,0 +1,178 @@
+"""
+离线视觉调参：在一组帧上对二值化阈值和滑窗参数做网格搜索，多进程并行。
+
+    python3 tune.py frames/ --set binary_value=60,90,120 --set fit_nwindows=6,9,12 \\
+        --set fit_margin=30,40,60 --set fit_minpix=10,20,40 --workers 8 --out tune.json
+    python3 tune.py recordings/20250101-120000 --set binary_value=70,90
+
+帧来源可以是图片目录，也可以是 recorder 录制的目录；帧只解码一次放进共享内存，
+各进程直接映射使用。每组参数按帧顺序跑 vision.process_image（保留帧间跟踪状态），统计：
+- jitter_px：相邻帧左右拟合曲线在底 / 中 / 顶三行的横向位置变化均值（鸟瞰像素）
+- fallback_rate：至少一侧没有从本帧像素拟合出来、沿用上一帧或默认曲线的帧比例
+- width_bad_rate：最终车道宽度超出合理范围的帧比例
+- ms_per_frame：单帧 process_image 耗时（首帧含映射表构建，不计入）
+不稳定度 instability = jitter_px + w_fallback * fallback_rate + w_width * width_bad_rate，
+最后输出“不稳定度 vs 耗时”的 Pareto 前沿。
+"""
+import argparse
+import json
+import time
+from multiprocessing import Pool, shared_memory
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+from sources import IMAGE_EXTS, JpegFrame
+
+# 工作进程里映射好的帧数组
+_frames = None
+_shm = None
+
+
+def load_frames(path: Path) -> np.ndarray:
+    """读取图片目录或录制目录，返回 (N, H, W, 3) uint8；尺寸不一致的帧缩放到第一帧的尺寸。
+
+    MJPEG 直通录制的帧和线上一样只解亮度通道，返回 (N, H, W)，视觉按亮度而不是红通道二值化。
+    直通中途退回解码模式的录制混有 JpegFrame 和 BGR 帧，这时 JpegFrame 全部解成 BGR，统一按红通道。
+    """
+    path = Path(path)
+    frames: List[np.ndarray] = []
+    if (path / "index.jsonl").exists():
+        from recorder import iter_frames
+        recorded = [f for _entry, f, _p in iter_frames(path)]
+        if all(isinstance(f, JpegFrame) for f in recorded):
+            decoded = (f.decode(cv.IMREAD_GRAYSCALE) for f in recorded)
+        else:
+            decoded = (f.decode() if isinstance(f, JpegFrame) else np.ascontiguousarray(f) for f in recorded)
+        frames = [f for f in decoded if f is not None]
+    else:
+        for p in sorted(q for q in path.iterdir() if q.suffix.lower() in IMAGE_EXTS):
+            img = cv.imread(str(p), cv.IMREAD_COLOR)
+            if img is not None:
+                frames.append(img)
+    if not frames:
+        raise SystemExit(f"no frames in {path}")
+    h, w = frames[0].shape[:2]
+    out = np.empty((len(frames),) + frames[0].shape, dtype=np.uint8)
+    for i, f in enumerate(frames):
+        out[i] = f if f.shape[:2] == (h, w) else cv.resize(f, (w, h), interpolation=cv.INTER_AREA)
+    return out
+
+
+def _attach(name: str, shape: Tuple[int, ...]):
+    global _frames, _shm
+    cv.setNumThreads(1)
+    _shm = shared_memory.SharedMemory(name=name)
+    _frames = np.ndarray(shape, dtype=np.uint8, buffer=_shm.buf)
+
+
+def evaluate(overrides: Dict[str, Any], frames: np.ndarray = None) -> Dict[str, Any]:
+    """在 frames（缺省为共享内存里的帧）上按顺序跑一遍，返回该组参数的统计。"""
+    import control
+    import vision
+
+    frames = _frames if frames is None else frames
+    params = dict(control.DEFAULT_PARAMS)
+    params.update(overrides)
+    vision.reset_vision_state(background_rebuild=False)
+
+    n, h = len(frames), frames.shape[1]
+    rows = np.array([h - 1, h / 2, 0], dtype=np.float64)
+    times = np.empty(n, dtype=np.float64)
+    jitter = []
+    prev = None
+    for i in range(n):
+        t0 = time.perf_counter()
+        vision.process_image(frames[i], params)
+        times[i] = time.perf_counter() - t0
+
+        left, right = vision.last_fit()
+        xs = np.concatenate([np.polyval(left, rows), np.polyval(right, rows)])
+        if prev is not None:
+            jitter.append(float(np.mean(np.abs(xs - prev))))
+        prev = xs
+
+    stats = vision.fit_stats()
+    cost = times[1:] if n > 1 else times
+    return {
+        "params": overrides,
+        "frames": n,
+        "jitter_px": float(np.mean(jitter)) if jitter else 0.0,
+        "fallback_rate": stats["fallback"] / n,
+        "width_bad_rate": stats["width_bad"] / n,
+        "search_rate": stats["search"] / n,
+        "ms_per_frame": float(np.mean(cost) * 1e3),
+        "p95_ms": float(np.percentile(cost, 95) * 1e3),
+    }
+
+
+def pareto_front(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """按耗时升序扫描，只保留不稳定度比所有更快配置都低的点。"""
+    front = []
+    best = float("inf")
+    for r in sorted(results, key=lambda r: (r["ms_per_frame"], r["instability"])):
+        if r["instability"] < best:
+            front.append(r)
+            best = r["instability"]
+    return front
+
+
+def tune(frames: np.ndarray, grid: Dict[str, List[Any]], workers: int = None, w_fallback: float = 20.0,
+         w_width: float = 20.0) -> Dict[str, Any]:
+    import control
+
+    configs = control.param_grid_configs(grid)
+
+    shm = shared_memory.SharedMemory(create=True, size=frames.nbytes)
+    try:
+        np.ndarray(frames.shape, dtype=np.uint8, buffer=shm.buf)[:] = frames
+        with Pool(processes=workers, initializer=_attach, initargs=(shm.name, frames.shape)) as pool:
+            results = pool.map(evaluate, configs)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    for r in results:
+        r["instability"] = r["jitter_px"] + w_fallback * r["fallback_rate"] + w_width * r["width_bad_rate"]
+    results.sort(key=lambda r: r["instability"])
+    return {"results": results, "pareto": pareto_front(results)}
+
+
+def _row(r: Dict[str, Any]) -> str:
+    return (f"instab {r['instability']:7.2f}  jitter {r['jitter_px']:6.2f}px  fallback {r['fallback_rate']:5.1%}  "
+            f"width {r['width_bad_rate']:5.1%}  {r['ms_per_frame']:6.2f}ms  {r['params']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线视觉调参（多进程网格搜索 + Pareto 前沿）")
+    parser.add_argument("path", help="图片目录或录制目录")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=V1,V2",
+                        help="参数取值，可多次给出，做网格组合")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认 CPU 核数")
+    parser.add_argument("--w-fallback", type=float, default=20.0, help="回退帧比例在不稳定度里的权重")
+    parser.add_argument("--w-width", type=float, default=20.0, help="宽度异常帧比例在不稳定度里的权重")
+    parser.add_argument("--out", help="结果 JSON 文件")
+    args = parser.parse_args()
+
+    import control
+
+    grid = control.parse_param_grid(args.set)
+    frames = load_frames(Path(args.path))
+    t0 = time.perf_counter()
+    report = tune(frames, grid, args.workers, args.w_fallback, args.w_width)
+    elapsed = time.perf_counter() - t0
+
+    for r in report["results"]:
+        print(_row(r))
+    print(f"\n{len(report['results'])} settings x {len(frames)} frames in {elapsed:.1f}s; Pareto front:")
+    for r in report["pareto"]:
+        print(_row(r))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"grid": grid, **report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,107 +1,452 @@
 import time
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Iterable, Mapping, Tuple
 
 import cv2 as cv
 import numpy as np
 
-# 透视矩阵缓存
-_M = None
-_M_inv = None
-_src_pts = None
-
-# 上一帧拟合系数
-_prev_left_fit: Tuple[float, float, float] = ()
-_prev_right_fit: Tuple[float, float, float] = ()
-
-# 误差简单滤波
-_filter_val = 0.0
-
-
-def reset_vision_state():
-    """清空缓存，避免卡死时需要重启。"""
-    global _M, _M_inv, _src_pts, _prev_left_fit, _prev_right_fit, _filter_val
-    _M = None
-    _M_inv = None
-    _src_pts = None
-    _prev_left_fit = ()
-    _prev_right_fit = ()
-    _filter_val = 0.0
-
-
-def _get_perspective_matrices(w: int, h: int):
-    """计算鸟瞰变换矩阵，只算一次后缓存。"""
-    global _M, _M_inv, _src_pts
-    if _M is None or _M_inv is None or _src_pts is None:
-        src = np.float32([
-            [w * 0.1, h],
-            [w * 0.9, h],
-            [w * 0.4, h * 0.6],
-            [w * 0.6, h * 0.6],
-        ])
-        dst = np.float32([
-            [w * 0.2, h],
-            [w * 0.8, h],
-            [w * 0.2, 0],
-            [w * 0.8, 0],
-        ])
-        _M = cv.getPerspectiveTransform(src, dst)
-        _M_inv = cv.getPerspectiveTransform(dst, src)
-        _src_pts = src
-    return _M, _M_inv, _src_pts
-
-
-def _fast_binary(image_bgr: np.ndarray, thresh: int) -> np.ndarray:
-    """使用红通道 + Sobel X 提取垂直边缘并二值化。"""
+import metrics
+from calibration import WarpMapCache, WarpMaps, make_key
+from sources import JpegFrame
+
+# 裁剪二值化时四周多算的像素：闭、开运算的影响半径各 2，再留余量
+_BINARY_PAD = 6
+
+# 处理分辨率的下限（相对采集帧）
+MIN_SCALE = 0.25
+
+# 预算调档：耗时指数平均的系数；连续超预算多少帧降一档；
+# 预计升档后的耗时低于预算的 GOVERNOR_HEADROOM 倍并保持多少帧才升一档
+GOVERNOR_ALPHA = 0.2
+GOVERNOR_DOWN_FRAMES = 5
+GOVERNOR_UP_FRAMES = 30
+GOVERNOR_HEADROOM = 0.8
+# 档位：(处理比例, 是否生成可视化画面)，从上到下越来越省
+GOVERNOR_LEVELS = ((1.0, True), (0.75, True), (0.5, True), (0.5, False))
+# 关掉可视化后再打开，预计耗时按这个倍数估计
+GOVERNOR_VISUAL_COST = 1.5
+
+# 形态学去噪用的 3x3 结构元
+_KERNEL = np.ones((3, 3), np.uint8)
+
+
+class VisionConfig:
+    """由参数快照解析出的视觉配置；同一份快照只解析一次。"""
+
+    def __init__(self, params: Mapping[str, Any]):
+        self.source = params
+        self.thresh = int(params.get("binary_value", 40))
+        self.nwindows = max(1, int(params.get("fit_nwindows", 6)))
+        self.margin = max(1, int(params.get("fit_margin", 40)))
+        self.minpix = max(0, int(params.get("fit_minpix", 20)))
+        self.roi_points = params.get("roi_points") or None
+        self.camera_matrix = params.get("camera_matrix") or None
+        self.dist_coeffs = params.get("dist_coeffs") or None
+        self.scale = min(1.0, max(MIN_SCALE, float(params.get("vision_scale", 1.0))))
+        self.budget = max(0.0, float(params.get("frame_budget_ms", 0.0))) / 1000.0
+        self._keys: Dict[Tuple[int, int], Any] = {}
+        self._matrices: Dict[float, Any] = {}
+
+    def camera_matrix_at(self, scale: float):
+        """按处理分辨率换算的内参：fx / fy / cx / cy 随像素坐标同比缩放，畸变系数不变。"""
+        if scale == 1.0 or self.camera_matrix is None:
+            return self.camera_matrix
+        K = self._matrices.get(scale)
+        if K is None:
+            try:
+                K = (np.array(self.camera_matrix, dtype=np.float64).reshape(3, 3) * [[scale], [scale], [1.0]]).tolist()
+            except ValueError:
+                K = self.camera_matrix
+            self._matrices[scale] = K
+        return K
+
+    def warp_key(self, w: int, h: int, scale: float = 1.0):
+        key = self._keys.get((w, h))
+        if key is None:
+            key = make_key(w, h, self.roi_points, self.camera_matrix_at(scale), self.dist_coeffs)
+            self._keys[(w, h)] = key
+        return key
+
+
+class FrameBudgetGovernor:
+    """按实测单帧视觉耗时在 GOVERNOR_LEVELS 的档位间升降，把耗时压在预算内。
+
+    耗时做指数平均：连续 GOVERNOR_DOWN_FRAMES 帧超预算降一档；按像素数估计升档后的耗时，
+    连续 GOVERNOR_UP_FRAMES 帧都留有余量才升一档。换档后重新计均值。预算为 0 时固定在最高档。
+    """
+
+    def __init__(self):
+        self.level = 0
+        self.avg = 0.0
+        self._samples = 0
+        self._over = 0
+        self._under = 0
+
+    def mode(self, cfg: VisionConfig) -> Tuple[float, bool]:
+        """当前档位的 (处理比例, 是否生成可视化画面)，比例不超过 vision_scale。"""
+        if cfg.budget <= 0:
+            return cfg.scale, True
+        scale, visual = GOVERNOR_LEVELS[self.level]
+        return min(scale, cfg.scale), visual
+
+    def update(self, seconds: float, cfg: VisionConfig):
+        if cfg.budget <= 0:
+            if self.level:
+                self._step(-self.level)
+            self.avg = seconds
+            return
+        self.avg = seconds if self._samples == 0 else self.avg + (seconds - self.avg) * GOVERNOR_ALPHA
+        self._samples += 1
+
+        if self.avg > cfg.budget:
+            self._over += 1
+            self._under = 0
+        elif self.level > 0 and self._predict_up(cfg) < cfg.budget * GOVERNOR_HEADROOM:
+            self._under += 1
+            self._over = 0
+        else:
+            self._over = self._under = 0
+
+        if self._over >= GOVERNOR_DOWN_FRAMES and self.level < len(GOVERNOR_LEVELS) - 1:
+            self._step(1)
+        elif self._under >= GOVERNOR_UP_FRAMES:
+            self._step(-1)
+
+    def _predict_up(self, cfg: VisionConfig) -> float:
+        scale, visual = self.mode(cfg)
+        up_scale, up_visual = GOVERNOR_LEVELS[self.level - 1]
+        up_scale = min(up_scale, cfg.scale)
+        cost = self.avg * (up_scale / scale) ** 2
+        if up_visual and not visual:
+            cost *= GOVERNOR_VISUAL_COST
+        return cost
+
+    def _step(self, delta: int):
+        self.level += delta
+        self._samples = 0
+        self._over = self._under = 0
+
+
+class _FrameBuffers:
+    """逐帧复用的中间结果缓冲：按名字保留数组，尺寸或类型变了才重新分配。
+
+    只放不离开检测器的中间结果；交给推流 / 录制的画面会被其他线程延后读取，每帧仍新分配。
+    """
+
+    def __init__(self):
+        self._bufs: Dict[str, np.ndarray] = {}
+
+    def get(self, name: str, shape: Tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        buf = self._bufs.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+            self._bufs[name] = buf
+        return buf
+
+    def vector(self, name: str, n: int, dtype=np.float64) -> np.ndarray:
+        """长度随帧变化的一维缓冲：容量不够时按倍数增长，返回前 n 个元素的视图。"""
+        buf = self._bufs.get(name)
+        if buf is None or buf.dtype != dtype or buf.size < n:
+            size = max(n, 2 * buf.size if buf is not None else 0, 1024)
+            buf = np.empty(size, dtype=dtype)
+            self._bufs[name] = buf
+        return buf[:n]
+
+
+class _DetectorState:
+    """一个检测器的全部可变状态；重置时整体换成新对象，正在处理的帧继续用旧对象算完。"""
+
+    def __init__(self, background_rebuild: bool = True):
+        # 鸟瞰映射表缓存（按帧尺寸 / ROI / 内参构建，ROI 变化时后台重建），每个处理分辨率一份
+        self.background_rebuild = background_rebuild
+        self.warp_caches: Dict[Tuple[int, int], WarpMapCache] = {}
+        self.cfg: VisionConfig = None
+        self.governor = FrameBudgetGovernor()
+        # 当前处理比例；prev_*_fit 是这个比例下鸟瞰图的坐标
+        self.scale = 1.0
+        # 上一帧拟合系数
+        self.prev_left_fit: Tuple[float, float, float] = ()
+        self.prev_right_fit: Tuple[float, float, float] = ()
+        # 上一帧拟合是否可信（可信时下一帧走沿上一帧曲线搜索的快速路径）
+        self.track_ok = False
+        # 两条搜索路径各自的运行次数；fallback：至少一侧沿用上一帧/默认曲线的帧数，width_bad：最终车道宽度不合理的帧数
+        self.stats: Dict[str, int] = {"track": 0, "search": 0, "fallback": 0, "width_bad": 0}
+        # 最近一帧用于计算误差的左右拟合系数
+        self.last_fit: Tuple = ()
+        # 误差简单滤波
+        self.filter_val = 0.0
+        # 已处理的帧数；回放靠它判断录制里有没有跳过中间的帧
+        self.frames = 0
+        # 二值化 / 鸟瞰 / 可视化的中间缓冲，稳态下每帧不再分配整幅图像
+        self.bufs = _FrameBuffers()
+
+    def config(self, params: Mapping[str, Any]) -> VisionConfig:
+        """params 按快照对待：与上次是同一个对象时直接复用解析结果，不要原地修改后再传入。"""
+        cfg = self.cfg
+        if cfg is None or cfg.source is not params:
+            cfg = VisionConfig(params)
+            self.cfg = cfg
+        return cfg
+
+    def warp_maps(self, w: int, h: int, params: Mapping[str, Any], scale: float = 1.0) -> WarpMaps:
+        cfg = self.config(params)
+        cache = self.warp_caches.get((w, h))
+        if cache is None:
+            cache = self.warp_caches.setdefault((w, h), WarpMapCache(background=self.background_rebuild))
+        return cache.get(w, h, cfg.roi_points, cfg.camera_matrix_at(scale), cfg.dist_coeffs,
+                         key=cfg.warp_key(w, h, scale))
+
+    def frame_state(self) -> Dict[str, Any]:
+        """下一帧开始时会用到的跟踪状态（已处理帧数、预算调档档位、处理比例、上一帧拟合、误差滤波），可直接写进 JSON。"""
+        return {
+            "frame": self.frames,
+            "level": int(self.governor.level),
+            "scale": float(self.scale),
+            "left": [float(c) for c in self.prev_left_fit],
+            "right": [float(c) for c in self.prev_right_fit],
+            "track": bool(self.track_ok),
+            "filter": float(self.filter_val),
+        }
+
+    def restore(self, state: Mapping[str, Any]):
+        """按 frame_state() 的结果恢复；只给 level 时只固定预算调档档位，其余跟踪状态不动。"""
+        if "level" in state:
+            self.governor.level = int(state["level"])
+        if "scale" in state:
+            self.scale = float(state["scale"])
+            self.prev_left_fit = np.asarray(state["left"], dtype=np.float64) if state["left"] else ()
+            self.prev_right_fit = np.asarray(state["right"], dtype=np.float64) if state["right"] else ()
+            self.track_ok = bool(state["track"])
+            self.filter_val = float(state["filter"])
+
+    def rescale(self, scale: float):
+        """处理比例变了：把上一帧拟合换算到新比例的鸟瞰坐标，帧间跟踪不断。"""
+        ratio = scale / self.scale
+        if len(self.prev_left_fit):
+            self.prev_left_fit = _rescale_fit(self.prev_left_fit, ratio)
+        if len(self.prev_right_fit):
+            self.prev_right_fit = _rescale_fit(self.prev_right_fit, ratio)
+        self.scale = scale
+
+
+def _fast_binary(image_bgr: np.ndarray, thresh: int, bounds: Tuple[int, int, int, int] = None,
+                 bufs: _FrameBuffers = None) -> np.ndarray:
+    """使用红通道 + Sobel X 提取垂直边缘并二值化。
+
+    Sobel 和归一化用的最大值总在整幅上算（ROI 外的强边缘同样影响归一化）；给定 bounds 时
+    阈值和形态学只处理该矩形（四周多算 _BINARY_PAD 像素保证结果与整幅一致），返回 bounds 范围内的二值图。
+    给定 bufs 时中间结果和返回的二值图都在其中复用，下一帧会被覆盖。
+    """
+    if bufs is None:
+        bufs = _FrameBuffers()
+    h, w = image_bgr.shape[:2]
+    x0, y0, x1, y1 = bounds if bounds is not None else (0, 0, w, h)
+    px0 = max(x0 - _BINARY_PAD, 0)
+    py0 = max(y0 - _BINARY_PAD, 0)
+    px1 = min(x1 + _BINARY_PAD, w)
+    py1 = min(y1 + _BINARY_PAD, h)
+    size = (py1 - py0, px1 - px0)
+
     if image_bgr.ndim == 3:
-        _, _, r = cv.split(image_bgr)
+        r = cv.extractChannel(image_bgr, 2, dst=bufs.get("red", (h, w)))
     else:
         r = image_bgr
-    sobelx = cv.Sobel(r, cv.CV_16S, 1, 0)
-    abs_sobelx = np.absolute(sobelx)
-    maxv = np.max(abs_sobelx) or 1
-    scaled = np.uint8(255 * abs_sobelx / maxv)
-    _, binary = cv.threshold(scaled, thresh, 255, cv.THRESH_BINARY)
+    sobelx = cv.Sobel(r, cv.CV_16S, 1, 0, dst=bufs.get("sobel", (h, w), np.int16))
+    abs_full = np.absolute(sobelx, out=sobelx)
+    maxv = int(cv.minMaxLoc(abs_full)[1]) or 1
+    abs_sobelx = abs_full[py0:py1, px0:px1]
+    # 归一化到 0~255 后 > thresh，即 floor(255 * |s| / maxv) > thresh，等价于整数比较
+    # |s| >= ceil((thresh + 1) * maxv / 255)：不做浮点归一化，也没有中间的 8 位图
+    level = -(-(thresh + 1) * maxv // 255)
+    binary = cv.compare(abs_sobelx, float(level), cv.CMP_GE, dst=bufs.get("edge", size))
     # 形态学去噪：先闭运算连接断点，再开运算去掉孤立噪点
-    kernel = np.ones((3, 3), np.uint8)
-    binary = cv.morphologyEx(binary, cv.MORPH_CLOSE, kernel, iterations=1)
-    binary = cv.morphologyEx(binary, cv.MORPH_OPEN, kernel, iterations=1)
-    return binary
+    binary = cv.morphologyEx(binary, cv.MORPH_CLOSE, _KERNEL, dst=bufs.get("close", size), iterations=1)
+    binary = cv.morphologyEx(binary, cv.MORPH_OPEN, _KERNEL, dst=bufs.get("open", size), iterations=1)
+    return binary[y0 - py0:y1 - py0, x0 - px0:x1 - px0]
+
+
+def _downscale(image: np.ndarray, scale: float, bufs: _FrameBuffers = None) -> np.ndarray:
+    """缩到处理分辨率：0.5 用 pyrDown（先高斯平滑再隔点取样），其他比例用 INTER_AREA。"""
+    h, w = image.shape[:2]
+    if scale == 0.5:
+        size = ((w + 1) // 2, (h + 1) // 2)
+    else:
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    dst = bufs.get("small", (size[1], size[0]) + image.shape[2:]) if bufs is not None else None
+    if scale == 0.5:
+        return cv.pyrDown(image, dst=dst, dstsize=size)
+    return cv.resize(image, size, dst=dst, interpolation=cv.INTER_AREA)
+
+
+def _decode_jpeg(frame: JpegFrame, scale: float, bufs: _FrameBuffers = None) -> np.ndarray:
+    """只解亮度通道；处理比例不超过 1/2、1/4 时让解码器直接按 DCT 缩小输出，再补剩下的缩放。"""
+    if scale <= 0.25:
+        flags, base = cv.IMREAD_REDUCED_GRAYSCALE_4, 0.25
+    elif scale <= 0.5:
+        flags, base = cv.IMREAD_REDUCED_GRAYSCALE_2, 0.5
+    else:
+        flags, base = cv.IMREAD_GRAYSCALE, 1.0
+    image = frame.decode(flags)
+    if image is None:
+        raise ValueError("jpeg decode failed")
+    if scale < base:
+        image = _downscale(image, scale / base, bufs)
+    return image
+
+
+def _upscale(image: np.ndarray, w: int, h: int) -> np.ndarray:
+    """可视化画面放大回采集帧尺寸，尺寸相同时原样返回。"""
+    if image.shape[1] == w and image.shape[0] == h:
+        return image
+    return cv.resize(image, (w, h), interpolation=cv.INTER_NEAREST)
+
+
+def _rescale_fit(fit, ratio: float) -> np.ndarray:
+    """x = f(y) 的二次拟合在坐标整体缩放 ratio 倍后的系数。"""
+    return np.array([fit[0] / ratio, fit[1], fit[2] * ratio])
+
+
+def _lane_width_ok(left_fit, right_fit, h: int, w: int) -> bool:
+    """底部车道宽度是否在期望范围内，防止抓到旁边车道。"""
+    base_y = h - 1
+    width = _poly_points(right_fit, base_y) - _poly_points(left_fit, base_y)
+    return int(w * 0.25) <= width <= int(w * 0.7)
+
+
+def _x_range_inds(xs: np.ndarray, low: int, width: int) -> np.ndarray:
+    """xs 中落在 [low, low + width) 的下标；差值按无符号比较，一次比较完成区间判断。"""
+    return ((xs - low).view(np.uintp) < width).nonzero()[0]
+
+
+def _poly_points(fit, y_vals):
+    return fit[0] * y_vals ** 2 + fit[1] * y_vals + fit[2]
 
 
-def _sliding_window_fit(binary_warped: np.ndarray):
-    """滑动窗口寻找左右车道并二次拟合。"""
-    global _prev_left_fit, _prev_right_fit
+def _render_bird(warped: np.ndarray, left_fit, right_fit, bufs: _FrameBuffers = None,
+                 out: np.ndarray = None) -> np.ndarray:
+    """鸟瞰二值图上叠加拟合车道区域与左右曲线；给定 out 时结果写进去，底图和叠加层在 bufs 中复用。"""
+    if bufs is None:
+        bufs = _FrameBuffers()
+    h, w = warped.shape
+    ploty = np.linspace(0, h - 1, h)
+    left_fitx = _poly_points(left_fit, ploty)
+    right_fitx = _poly_points(right_fit, ploty)
+
+    color_warp = bufs.get("color_warp", (h, w, 3))
+    color_warp.fill(0)
+    pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
+    pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
+    pts = np.hstack((pts_left, pts_right))
+    cv.fillPoly(color_warp, np.int_([pts]), (0, 255, 0))
+    cv.polylines(color_warp, np.int_([pts_left]), False, (0, 0, 255), 4)
+    cv.polylines(color_warp, np.int_([pts_right]), False, (255, 0, 0), 4)
+    warped_bgr = cv.cvtColor(warped, cv.COLOR_GRAY2BGR, dst=bufs.get("warped_bgr", (h, w, 3)))
+    return cv.addWeighted(warped_bgr, 1, color_warp, 0.3, 0, dst=out)
+
+
+def _nonzero(binary: np.ndarray, bufs: _FrameBuffers) -> Tuple[np.ndarray, np.ndarray]:
+    """与 binary.nonzero() 相同的 (行, 列) 下标（按行优先、int64），写进复用的缓冲。"""
+    n = cv.countNonZero(binary)
+    nonzeroy = bufs.vector("nonzeroy", n, np.int64)
+    nonzerox = bufs.vector("nonzerox", n, np.int64)
+    if n:
+        pts = cv.findNonZero(binary, bufs.vector("nonzero_pts", 2 * n, np.int32).reshape(n, 1, 2))
+        np.copyto(nonzerox, pts[:, 0, 0])
+        np.copyto(nonzeroy, pts[:, 0, 1])
+    return nonzeroy, nonzerox
+
+
+def _band_mask(fit, nonzerox: np.ndarray, nonzeroy: np.ndarray, nonzeroy_sq: np.ndarray, margin: int,
+               bufs: _FrameBuffers, name: str) -> np.ndarray:
+    """|x - _poly_points(fit, y)| < margin，运算顺序与 _poly_points 相同，临时数组都在缓冲里。"""
+    n = len(nonzerox)
+    center = np.multiply(nonzeroy_sq, fit[0], out=bufs.vector("band_center", n))
+    tmp = np.multiply(nonzeroy, fit[1], out=bufs.vector("band_tmp", n))
+    center += tmp
+    center += fit[2]
+    np.subtract(nonzerox, center, out=tmp)
+    np.absolute(tmp, out=tmp)
+    return np.less(tmp, margin, out=bufs.vector(name, n, np.bool_))
+
+
+def _polyfit_rows(y: np.ndarray, x: np.ndarray, h: int, weights: np.ndarray = None) -> np.ndarray:
+    """二次最小二乘拟合 x = f(y)，结果与 np.polyfit(y, x, 2) 相同（到浮点舍入）。
+
+    y 是 [0, h) 内的行号：先按行累加点数和 x 之和（weights 为 0/1 时只算选中的点，不用切出子数组，
+    weights 会被改写），再用 h 行的矩解 3x3 正规方程，只分配 h 长度的小数组。行坐标归一化到 [0, 1] 让方程良态。
+    """
+    cnt = np.bincount(y, weights=weights, minlength=h)
+    if weights is not None:
+        x = np.multiply(weights, x, out=weights)
+    sx = np.bincount(y, weights=x, minlength=h)
+    t = np.vander(np.arange(len(cnt)) / h, 3)
+    a = t.T @ (t * cnt[:, None])
+    b = t.T @ sx
+    coef = np.linalg.lstsq(a, b, rcond=None)[0]
+    return np.array([coef[0] / (h * h), coef[1] / h, coef[2]])
+
+
+def _track_prev_fit(st: _DetectorState, nonzerox: np.ndarray, nonzeroy: np.ndarray, h: int, w: int,
+                    margin: int = 40, minpix: int = 20):
+    """沿上一帧曲线左右 margin 带内一次性选点拟合；某侧点数不超过 minpix 或车道宽度不合格时返回 None。"""
+    bufs = st.bufs
+    nonzeroy_sq = np.multiply(nonzeroy, nonzeroy, out=bufs.vector("nonzeroy_sq", len(nonzeroy), np.int64))
+    left_inds = _band_mask(st.prev_left_fit, nonzerox, nonzeroy, nonzeroy_sq, margin, bufs, "left_band")
+    right_inds = _band_mask(st.prev_right_fit, nonzerox, nonzeroy, nonzeroy_sq, margin, bufs, "right_band")
+
+    if np.count_nonzero(left_inds) <= minpix or np.count_nonzero(right_inds) <= minpix:
+        return None
+
+    weights = bufs.vector("fit_weights", len(nonzerox))
+    np.copyto(weights, left_inds)
+    left_fit = _polyfit_rows(nonzeroy, nonzerox, h, weights)
+    np.copyto(weights, right_inds)
+    right_fit = _polyfit_rows(nonzeroy, nonzerox, h, weights)
+    if not _lane_width_ok(left_fit, right_fit, h, w):
+        return None
+    return left_fit, right_fit
+
+
+def _sliding_window_fit(st: _DetectorState, binary_warped: np.ndarray, nwindows: int = 6, margin: int = 40,
+                        minpix: int = 20, allow_track: bool = True, scale: float = 1.0):
+    """左右车道二次拟合：上一帧可信时沿其曲线搜索，否则直方图 + 滑动窗口全图搜索。
+
+    nwindows / margin / minpix 为滑窗数、窗口半宽和窗口重新居中所需的最少像素（已按处理比例换算）；
+    跟踪路径用同一组 margin（带宽）和 minpix（每侧最少点数）。allow_track=False 时总是走全图搜索。
+    scale 为处理比例，用来换算全图搜索判定“找到车道”的固定点数门限。
+    """
     h, w = binary_warped.shape
 
+    nonzeroy, nonzerox = _nonzero(binary_warped, st.bufs)
+
+    if allow_track and st.track_ok and len(st.prev_left_fit) and len(st.prev_right_fit):
+        fits = _track_prev_fit(st, nonzerox, nonzeroy, h, w, margin, minpix)
+        if fits is not None:
+            st.stats["track"] += 1
+            st.prev_left_fit, st.prev_right_fit = fits
+            return fits
+    st.stats["search"] += 1
+
     # 只看图像下半区，且聚焦中间 80% 区域，避免旁车道/墙角干扰
-    hist_region = binary_warped[h // 2:, :].copy()
+    histogram = np.sum(binary_warped[h // 2:, :], axis=0)
     edge_margin = int(w * 0.1)
-    hist_region[:, :edge_margin] = 0
-    hist_region[:, w - edge_margin:] = 0
-    histogram = np.sum(hist_region, axis=0)
+    histogram[:edge_margin] = 0
+    histogram[w - edge_margin:] = 0
 
     midpoint = int(w // 2)
     leftx_base = int(np.argmax(histogram[:midpoint]))
     rightx_base = int(np.argmax(histogram[midpoint:]) + midpoint)
 
-    nwindows = 6
     window_height = int(h // nwindows)
-    margin = 40
-    minpix = 20
-
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
 
     # 期望车道宽度限制，防止抓到旁边车道
     lane_width_min = int(w * 0.25)
     lane_width_max = int(w * 0.7)
     if (rightx_base - leftx_base) < lane_width_min or (rightx_base - leftx_base) > lane_width_max:
         # 若宽度异常，使用上一帧中心或默认中心对称
-        if len(_prev_left_fit) and len(_prev_right_fit):
+        if len(st.prev_left_fit) and len(st.prev_right_fit):
             base_y = h - 1
-            leftx_base = int(_poly_points(_prev_left_fit, base_y))
-            rightx_base = int(_poly_points(_prev_right_fit, base_y))
+            leftx_base = int(_poly_points(st.prev_left_fit, base_y))
+            rightx_base = int(_poly_points(st.prev_right_fit, base_y))
         else:
             offset = int(w * 0.18)
             leftx_base = midpoint - offset
@@ -111,29 +456,30 @@ def _sliding_window_fit(binary_warped: np.ndarray):
     rightx_current = rightx_base
 
     # 若有上一帧拟合，限制窗口初始位置的漂移
-    if len(_prev_left_fit) and len(_prev_right_fit):
+    if len(st.prev_left_fit) and len(st.prev_right_fit):
         base_y = h - 1
-        prev_left = int(_poly_points(_prev_left_fit, base_y))
-        prev_right = int(_poly_points(_prev_right_fit, base_y))
+        prev_left = int(_poly_points(st.prev_left_fit, base_y))
+        prev_right = int(_poly_points(st.prev_right_fit, base_y))
         drift = int(w * 0.15)
         leftx_current = int(np.clip(leftx_current, prev_left - drift, prev_left + drift))
         rightx_current = int(np.clip(rightx_current, prev_right - drift, prev_right + drift))
 
+    # nonzero() 按行优先输出，nonzeroy 有序：row_start[y] 是第 y 行第一个像素的下标，
+    # 每个窗口只需切出自己那几行
+    row_start = np.searchsorted(nonzeroy, np.arange(h + 1))
+
     left_lane_inds = []
     right_lane_inds = []
 
     for window in range(nwindows):
         win_y_low = h - (window + 1) * window_height
         win_y_high = h - window * window_height
-        win_xleft_low = leftx_current - margin
-        win_xleft_high = leftx_current + margin
-        win_xright_low = rightx_current - margin
-        win_xright_high = rightx_current + margin
+        lo = int(row_start[max(win_y_low, 0)])
+        hi = int(row_start[win_y_high])
+        band_x = nonzerox[lo:hi]
 
-        good_left_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) &
-                          (nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]
-        good_right_inds = ((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) &
-                           (nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]
+        good_left_inds = _x_range_inds(band_x, leftx_current - margin, 2 * margin) + lo
+        good_right_inds = _x_range_inds(band_x, rightx_current - margin, 2 * margin) + lo
 
         left_lane_inds.append(good_left_inds)
         right_lane_inds.append(good_right_inds)
@@ -151,108 +497,253 @@ def _sliding_window_fit(binary_warped: np.ndarray):
     rightx = nonzerox[right_lane_inds]
     righty = nonzeroy[right_lane_inds]
 
-    left_fit = _prev_left_fit if len(_prev_left_fit) else None
-    right_fit = _prev_right_fit if len(_prev_right_fit) else None
+    left_fit = st.prev_left_fit if len(st.prev_left_fit) else None
+    right_fit = st.prev_right_fit if len(st.prev_right_fit) else None
 
-    if len(leftx) > 50:
-        left_fit = np.polyfit(lefty, leftx, 2)
-        _prev_left_fit = left_fit
-    if len(rightx) > 50:
-        right_fit = np.polyfit(righty, rightx, 2)
-        _prev_right_fit = right_fit
+    # 二值图是边缘，像素数随线长按比例线性变化
+    left_found = len(leftx) > 50 * scale
+    right_found = len(rightx) > 50 * scale
+    if left_found:
+        left_fit = _polyfit_rows(lefty, leftx, h)
+        st.prev_left_fit = left_fit
+    if right_found:
+        right_fit = _polyfit_rows(righty, rightx, h)
+        st.prev_right_fit = right_fit
+
+    if not (left_found and right_found):
+        st.stats["fallback"] += 1
+
+    # 两侧都由本帧像素拟合且宽度合理，下一帧才走快速跟踪
+    st.track_ok = left_found and right_found and _lane_width_ok(left_fit, right_fit, h, w)
 
     return left_fit, right_fit
 
 
-def _poly_points(fit, y_vals):
-    return fit[0] * y_vals ** 2 + fit[1] * y_vals + fit[2]
+class LaneDetector:
+    """车道检测器：自带映射表缓存、参数解析缓存、帧间跟踪状态、统计和误差滤波。
+
+    每个实例互不影响，前后两路摄像头或两组参数对比可以各用一个实例并行跑；
+    同一个实例只应由一个线程调用 process。reset() 整体替换内部状态，可以在其他线程调用。
+    """
+
+    def __init__(self, background_rebuild: bool = True):
+        self._state = _DetectorState(background_rebuild)
+
+    def reset(self, background_rebuild: bool = True):
+        """清空缓存和跟踪状态。
+
+        background_rebuild=False 时映射表改为同步重建，离线回放用它保证逐帧可复现。
+        """
+        self._state = _DetectorState(background_rebuild)
+
+    def fit_stats(self) -> Dict[str, int]:
+        """快速跟踪 / 全图滑窗两条路径的累计运行次数，以及回退、宽度异常的帧数。"""
+        return dict(self._state.stats)
+
+    def governor_stats(self) -> Dict[str, Any]:
+        """当前处理比例、预算调档档位和单帧视觉耗时的平均值（毫秒）。"""
+        st = self._state
+        return {
+            "vision_scale": st.scale,
+            "vision_level": st.governor.level,
+            "vision_ms": st.governor.avg * 1e3,
+        }
+
+    def last_fit(self) -> Tuple:
+        """最近一帧的 (左, 右) 二次拟合系数，尚未处理过帧时为空元组。"""
+        return self._state.last_fit
+
+    def frame_state(self) -> Dict[str, Any]:
+        """下一帧将从什么状态开始处理；录制时随帧保存，回放用 restore() 复现同样的输出。"""
+        return self._state.frame_state()
+
+    def restore(self, state: Mapping[str, Any]):
+        """恢复 frame_state() 保存的状态，与 process 在同一线程调用。"""
+        self._state.restore(state)
+
+    def warp_maps(self, w: int, h: int, params: Mapping[str, Any]) -> WarpMaps:
+        """取当前参数对应的鸟瞰映射表（ROI 取自 roi_points，可选镜头内参/畸变）。"""
+        return self._state.warp_maps(w, h, params)
+
+    def binary_bounds(self, w: int, h: int, params: Mapping[str, Any] = None) -> Tuple[int, int, int, int]:
+        """二值化实际需要的原图范围 (x0, y0, x1, y1)，可用于设置采集端裁剪。"""
+        return self.warp_maps(w, h, params or {}).bounds
+
+    def fit_lanes(self, binary_warped: np.ndarray, nwindows: int = 6, margin: int = 40, minpix: int = 20,
+                  allow_track: bool = True):
+        """在鸟瞰二值图上拟合左右车道，并更新帧间跟踪状态。"""
+        return _sliding_window_fit(self._state, binary_warped, nwindows, margin, minpix, allow_track)
+
+    def process(self, frame_bgr: np.ndarray, params: Mapping[str, Any],
+                outputs: Iterable[str] = ()) -> Tuple[Dict[str, np.ndarray], float, Dict[str, Any]]:
+        """滑窗+鸟瞰+二次拟合的车道检测，输出误差、覆盖数据以及 outputs 中请求的图像。
+
+        params 为参数快照（如 control.current_params().values），按对象缓存解析结果。
+        outputs 为需要的流名（raw/gray/blur/canny/roi/processed），默认只算误差和覆盖。
+        二值化和拟合在 vision_scale（或预算调档选出的）分辨率上进行，误差、覆盖和画面都换算回采集帧的像素。
+        frame_bgr 也可以是 MJPEG 直通的 JpegFrame：只解码亮度通道（代替 BGR 的红通道），raw 画面原样转发。
+        """
+        t_start = metrics.now()
+        st = self._state
+        full_h, full_w = frame_bgr.shape[:2]
+        cfg = st.config(params)
+        thresh = cfg.thresh
+        outputs = set(outputs)
+
+        scale, visual = st.governor.mode(cfg)
+        if not visual:
+            # 最省的一档：只保留不需要额外计算的原图
+            outputs &= {"raw"}
+        if isinstance(frame_bgr, JpegFrame):
+            t0 = metrics.now()
+            image = _decode_jpeg(frame_bgr, scale, st.bufs)
+            metrics.observe("vision.decode", metrics.now() - t0)
+        else:
+            image = frame_bgr if scale >= 1.0 else _downscale(frame_bgr, scale, st.bufs)
+        h, w = image.shape[:2]
+        # 实际比例按缩放后的宽度算（pyrDown 对奇数边长向上取整）
+        scale = w / full_w
+        if scale != st.scale:
+            st.rescale(scale)
+        margin = max(1, int(round(cfg.margin * scale)))
+        minpix = int(round(cfg.minpix * scale))
+
+        maps = st.warp_maps(w, h, params, scale)
+        x0, y0, x1, y1 = maps.bounds
+
+        # 1) 快速二值：只算鸟瞰变换会读到的区域
+        t0 = metrics.now()
+        binary = _fast_binary(image, thresh, maps.bounds, st.bufs)
+        t1 = metrics.now()
+        metrics.observe("vision.binary", t1 - t0)
+
+        # 2) 查表重映射成鸟瞰（表内已含透视与可选的去畸变，直接从裁剪区域采样）
+        warped = maps.warp(binary, st.bufs.get("warped", maps.map1.shape[:2]))
+        t2 = metrics.now()
+        metrics.observe("vision.warp", t2 - t1)
+
+        # 3) 滑动窗口 + 拟合
+        left_fit, right_fit = _sliding_window_fit(st, warped, cfg.nwindows, margin, minpix, scale=scale)
+        t3 = metrics.now()
+        metrics.observe("vision.fit", t3 - t2)
+        if left_fit is None:
+            left_fit = st.prev_left_fit if len(st.prev_left_fit) else [0, 0, w * 0.35]
+        if right_fit is None:
+            right_fit = st.prev_right_fit if len(st.prev_right_fit) else [0, 0, w * 0.65]
+        if not _lane_width_ok(left_fit, right_fit, h, w):
+            st.stats["width_bad"] += 1
+        if scale == 1.0:
+            st.last_fit = (left_fit, right_fit)
+        else:
+            st.last_fit = (_rescale_fit(left_fit, 1.0 / scale), _rescale_fit(right_fit, 1.0 / scale))
+
+        # 4) 误差（底部往上一点），换算回采集帧像素
+        eval_y = h - 20 * scale
+        lane_center = (_poly_points(left_fit, eval_y) + _poly_points(right_fit, eval_y)) / 2.0
+        screen_center = w / 2.0
+        err_raw = (screen_center - lane_center) / scale
+        alpha = 0.3
+        st.filter_val = st.filter_val * (1 - alpha) + err_raw * alpha
+        err = float(np.clip(st.filter_val, -120, 120))
 
+        # 5) 反投影到原图坐标用于前端覆盖
+        sample_y = np.linspace(h * 0.3, h, num=12)
+        left_pts = np.vstack([_poly_points(left_fit, sample_y), sample_y]).T.reshape(-1, 1, 2)
+        right_pts = np.vstack([_poly_points(right_fit, sample_y), sample_y]).T.reshape(-1, 1, 2)
+        left_unwarp = maps.to_source(left_pts)
+        right_unwarp = maps.to_source(right_pts)
+        src_pts = maps.src_pts
+        if scale != 1.0:
+            left_unwarp = left_unwarp / scale
+            right_unwarp = right_unwarp / scale
+            src_pts = src_pts / scale
 
-def process_image(frame_bgr: np.ndarray, params: Dict[str, Any]) -> Tuple[Dict[str, np.ndarray], float, Dict[str, Any]]:
-    """滑窗+鸟瞰+二次拟合的车道检测，输出多路图像和覆盖数据。"""
-    global _filter_val
-    h, w = frame_bgr.shape[:2]
-    thresh = int(params.get("binary_value", 40))
+        t4 = metrics.now()
+        metrics.observe("vision.overlay", t4 - t3)
 
-    # 1) 快速二值
-    binary = _fast_binary(frame_bgr, thresh)
+        # 6) 可视化：只生成有人订阅的画面，低分辨率处理时放大回采集帧尺寸。
+        # 发布出去的画面由推流线程延后编码，不能复用：全分辨率时直接新分配，
+        # 低分辨率时先画进缓冲，放大的结果本身就是新数组
+        imgs: Dict[str, np.ndarray] = {}
+        full = (w, h) == (full_w, full_h)
 
-    # 2) 透视变换成鸟瞰
-    M, M_inv, src_pts = _get_perspective_matrices(w, h)
-    warped = cv.warpPerspective(binary, M, (w, h), flags=cv.INTER_LINEAR)
+        def canvas(name: str) -> np.ndarray:
+            return np.empty((h, w, 3), dtype=np.uint8) if full else st.bufs.get(name, (h, w, 3))
 
-    # 3) 滑动窗口 + 拟合
-    left_fit, right_fit = _sliding_window_fit(warped)
-    if left_fit is None:
-        left_fit = _prev_left_fit if len(_prev_left_fit) else [0, 0, w * 0.35]
-    if right_fit is None:
-        right_fit = _prev_right_fit if len(_prev_right_fit) else [0, 0, w * 0.65]
+        if "raw" in outputs:
+            imgs["raw"] = frame_bgr
+        if outputs & {"gray", "blur", "canny"}:
+            gray_bgr = canvas("gray")
+            gray_bgr.fill(0)
+            gray_bgr[y0:y1, x0:x1] = binary[:, :, None]
+            gray_bgr = _upscale(gray_bgr, full_w, full_h)
+            for name in ("gray", "blur", "canny"):
+                if name in outputs:
+                    imgs[name] = gray_bgr
+        if "roi" in outputs:
+            # ROI 视角：鸟瞰二值
+            imgs["roi"] = _upscale(cv.cvtColor(warped, cv.COLOR_GRAY2BGR, dst=canvas("roi")), full_w, full_h)
+        if "processed" in outputs:
+            # Processed：带拟合的鸟瞰
+            bird = _render_bird(warped, left_fit, right_fit, st.bufs, canvas("processed"))
+            imgs["processed"] = _upscale(bird, full_w, full_h)
+        metrics.observe("vision.visualize", metrics.now() - t4)
 
-    ploty = np.linspace(0, h - 1, h)
-    left_fitx = _poly_points(left_fit, ploty)
-    right_fitx = _poly_points(right_fit, ploty)
+        overlay = {
+            "roi": [[int(p[0]), int(p[1])] for p in src_pts.tolist()],
+            "lines": [],  # 不再传直线段，前端专注曲线
+            "curves": {
+                "left": [[int(p[0]), int(p[1])] for p in left_unwarp.reshape(-1, 2).tolist()],
+                "right": [[int(p[0]), int(p[1])] for p in right_unwarp.reshape(-1, 2).tolist()],
+            },
+            "frame": {"w": int(full_w), "h": int(full_h)},
+            "err": float(err),
+            "roi_source": "custom" if maps.custom_roi else "birdview",
+        }
 
-    # 4) 误差（底部往上一点）
-    eval_y = h - 20
-    lane_center = (_poly_points(left_fit, eval_y) + _poly_points(right_fit, eval_y)) / 2.0
-    screen_center = w / 2.0
-    err_raw = screen_center - lane_center
-    alpha = 0.3
-    _filter_val = _filter_val * (1 - alpha) + err_raw * alpha
-    err = float(np.clip(_filter_val, -120, 120))
-
-    # 5) 鸟瞰可视化
-    warp_zero = np.zeros_like(warped).astype(np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
-    pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
-    pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
-    pts = np.hstack((pts_left, pts_right))
-    cv.fillPoly(color_warp, np.int_([pts]), (0, 255, 0))
-    cv.polylines(color_warp, np.int_([pts_left]), False, (0, 0, 255), 4)
-    cv.polylines(color_warp, np.int_([pts_right]), False, (255, 0, 0), 4)
-    processed_bird = cv.addWeighted(np.dstack([warped, warped, warped]), 1, color_warp, 0.3, 0)
-
-    # 6) 反投影到原图坐标用于前端覆盖
-    sample_y = np.linspace(h * 0.3, h, num=12)
-    left_pts = np.vstack([_poly_points(left_fit, sample_y), sample_y]).T.reshape(-1, 1, 2)
-    right_pts = np.vstack([_poly_points(right_fit, sample_y), sample_y]).T.reshape(-1, 1, 2)
-    left_unwarp = cv.perspectiveTransform(left_pts.astype(np.float32), M_inv)
-    right_unwarp = cv.perspectiveTransform(right_pts.astype(np.float32), M_inv)
-
-    def _segments_from_poly(unwarped_pts):
-        segs = []
-        pts = unwarped_pts.reshape(-1, 2)
-        for i in range(len(pts) - 1):
-            x1, y1 = pts[i]
-            x2, y2 = pts[i + 1]
-            segs.append({"x1": int(x1), "y1": int(y1), "x2": int(x2), "y2": int(y2)})
-        return segs
-
-    line_segments = _segments_from_poly(left_unwarp) + _segments_from_poly(right_unwarp)
-
-    # 输出帧
-    gray_bgr = cv.cvtColor(binary, cv.COLOR_GRAY2BGR)
-    warped_bgr = cv.cvtColor(warped, cv.COLOR_GRAY2BGR)
-
-    imgs = {
-        "raw": frame_bgr,
-        "gray": gray_bgr,
-        "blur": gray_bgr,
-        "canny": gray_bgr,
-        "roi": warped_bgr,          # ROI 视角：鸟瞰二值
-        "processed": processed_bird  # Processed：带拟合的鸟瞰
-    }
-
-    overlay = {
-        "roi": [[int(p[0]), int(p[1])] for p in _src_pts.tolist()],
-        "lines": [],  # 不再传直线段，前端专注曲线
-        "curves": {
-            "left": [[int(p[0]), int(p[1])] for p in left_unwarp.reshape(-1, 2).tolist()],
-            "right": [[int(p[0]), int(p[1])] for p in right_unwarp.reshape(-1, 2).tolist()],
-        },
-        "frame": {"w": int(w), "h": int(h)},
-        "err": float(err),
-        "roi_source": "birdview",
-    }
-
-    return imgs, err, overlay
+        st.governor.update(metrics.now() - t_start, cfg)
+        st.frames += 1
+        return imgs, err, overlay
+
+
+# 模块级默认检测器，供 process_image 等兼容接口使用
+_detector = LaneDetector()
+
+
+def reset_vision_state(background_rebuild: bool = True):
+    """清空默认检测器的缓存，避免卡死时需要重启；正在处理的帧不受影响。"""
+    _detector.reset(background_rebuild)
+
+
+def fit_stats() -> Dict[str, int]:
+    return _detector.fit_stats()
+
+
+def last_fit() -> Tuple:
+    return _detector.last_fit()
+
+
+def governor_stats() -> Dict[str, Any]:
+    return _detector.governor_stats()
+
+
+def frame_state() -> Dict[str, Any]:
+    return _detector.frame_state()
+
+
+def restore_vision_state(state: Mapping[str, Any]):
+    _detector.restore(state)
+
+
+def _get_warp_maps(w: int, h: int, params: Mapping[str, Any]) -> WarpMaps:
+    return _detector.warp_maps(w, h, params)
+
+
+def binary_bounds(w: int, h: int, params: Mapping[str, Any] = None) -> Tuple[int, int, int, int]:
+    return _detector.binary_bounds(w, h, params)
+
+
+def process_image(frame_bgr: np.ndarray, params: Mapping[str, Any],
+                  outputs: Iterable[str] = ()) -> Tuple[Dict[str, np.ndarray], float, Dict[str, Any]]:
+    """用默认检测器处理一帧，见 LaneDetector.process。"""
+    return _detector.process(frame_bgr, params, outputs)